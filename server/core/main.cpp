@@ -1,12 +1,17 @@
 #include "clang/AST/ASTConsumer.h"
 #include "clang/AST/RecursiveASTVisitor.h"
+#include "clang/AST/RecordLayout.h"
 #include "clang/Frontend/CompilerInstance.h"
 #include "clang/Frontend/FrontendActions.h"
+#include "clang/Lex/Lexer.h"
 #include "clang/Lex/PPCallbacks.h"
 #include "clang/Tooling/CommonOptionsParser.h"
 #include "clang/Tooling/Tooling.h"
 #include "clang/Index/USRGeneration.h"
 #include "llvm/ADT/SmallString.h"
+#include "llvm/ADT/DenseMap.h"
+#include "llvm/ADT/DenseSet.h"
+#include <algorithm>
 #include <iostream>
 #include "llvm/Support/FileSystem.h"
 #include "llvm/Support/Path.h"
@@ -17,6 +22,16 @@ using namespace clang::tooling;
 // 提前声明命令行类别
 static llvm::cl::OptionCategory MyToolCategory("PyClangd-Core Options");
 
+// 两阶段索引的第一遍：跳过函数体，只输出定义和 #include
+static llvm::cl::opt<bool> DefsOnly("defs-only",
+    llvm::cl::desc("Skip function bodies and only emit definitions and includes"),
+    llvm::cl::cat(MyToolCategory));
+
+// 宏展开服务用：不建索引，只把带行号标记 (# N "file") 的预处理结果打到标准输出
+static llvm::cl::opt<bool> Preprocess("preprocess",
+    llvm::cl::desc("Print the preprocessed source with line markers instead of indexing"),
+    llvm::cl::cat(MyToolCategory));
+
 // --- 1. 辅助函数：获取规范化绝对路径 (带 Size-1 缓存) ---
 std::string getAbsPath(SourceManager &SM, SourceLocation Loc) {
     static thread_local std::string lastRawPath = "";
@@ -58,22 +73,81 @@ std::string getAbsPath(SourceManager &SM, SourceLocation Loc) {
     }
 }
 
+// 引用的访问方式 (位标志，与 database.py 里的 Database.ACCESS_* 保持一致)，0 表示声明或未分类
+enum RefAccess {
+    ACCESS_READ = 1,
+    ACCESS_WRITE = 2,   // READ | WRITE 即读改写 (++、+=)
+    ACCESS_CALL = 4,
+    ACCESS_ADDR = 8,    // 取地址，函数名当作值使用 (赋给函数指针) 也算
+    ACCESS_TYPE = 16,   // 类型名、sizeof / offsetof 这类不求值的使用
+};
+
+// 类型名、注释这类任意文本放进 JSON 字符串前要转义
+std::string jsonEscape(llvm::StringRef S) {
+    std::string Out;
+    Out.reserve(S.size());
+    for (char C : S) {
+        switch (C) {
+        case '"': Out += "\\\""; break;
+        case '\\': Out += "\\\\"; break;
+        case '\n': Out += "\\n"; break;
+        case '\t': Out += "\\t"; break;
+        case '\r': break;
+        default:
+            if ((unsigned char)C < 0x20) Out += ' ';
+            else Out += C;
+        }
+    }
+    return Out;
+}
+
 // 统一 JSON 输出辅助函数
+// context: 关联的另一个符号的 USR。REF 行是引用所在的函数 (只有函数体内对函数的引用才有，用来建调用图)，
+//          IMPL 行是被赋值的函数指针成员
+// access: 引用的访问方式，只有 REF 才有
+// extra: 原样追加的 JSON 成员 (已经转义好)，比如 LAYOUT 行的 "layout":{...}
 void emitJson(const std::string &kind, const std::string &name, const std::string &usr, 
-              const std::string &file, int line, int col) {
+              const std::string &file, int line, int col, const std::string &context = "", int access = 0,
+              const std::string &extra = "") {
     std::cout << "{"
               << "\"kind\":\"" << kind << "\", "
               << "\"name\":\"" << name << "\", "
               << "\"usr\":\"" << usr << "\", "
               << "\"file\":\"" << file << "\", "
-              << "\"line\":" << line << ", \"col\":" << col
-              << "}" << std::endl;
+              << "\"line\":" << line << ", \"col\":" << col;
+    if (!context.empty())
+        std::cout << ", \"context\":\"" << context << "\"";
+    if (access)
+        std::cout << ", \"access\":" << access;
+    if (!extra.empty())
+        std::cout << ", " << extra;
+    std::cout << "}" << std::endl;
+}
+
+// EXTENT 行的结束位置 (不含)，起始位置就是行本身的 line/col
+std::string extentJson(const PresumedLoc &End) {
+    return "\"end_line\":" + std::to_string(End.getLine()) + ",\"end_col\":" + std::to_string(End.getColumn());
+}
+
+// 大纲里出现的实体：文件级的函数 / 变量 / 类型和结构体成员，局部变量、参数不算
+bool isOutlineDecl(const NamedDecl *D) {
+    if (auto *VD = dyn_cast<VarDecl>(D); VD && VD->isLocalVarDeclOrParm()) return false;
+    return isa<FunctionDecl, VarDecl, FieldDecl, TypedefNameDecl, TagDecl, EnumConstantDecl, NamespaceDecl>(D);
+}
+
+// 悬停信息里单条文本的上限，个别内核宏的展开体有几十行
+static const size_t MaxHoverText = 4096;
+
+std::string clipHoverText(std::string S) {
+    if (S.size() > MaxHoverText) S = S.substr(0, MaxHoverText) + " ...";
+    return S;
 }
 
 class IndexerPPCallbacks : public PPCallbacks {
     SourceManager &SM;
+    const LangOptions &LangOpts;
 public:
-    explicit IndexerPPCallbacks(SourceManager &SM) : SM(SM) {}
+    IndexerPPCallbacks(SourceManager &SM, const LangOptions &LangOpts) : SM(SM), LangOpts(LangOpts) {}
 
     // --- 新增：处理 #include 指令 ---
     void InclusionDirective(SourceLocation HashLoc, const Token &IncludeTok,
@@ -126,6 +200,16 @@ public:
         std::string absPath = getAbsPath(SM, MacroNameTok.getLocation());
         std::string macroUsr = std::string("c:") + absPath + "@" + MacroNameTok.getIdentifierInfo()->getName().str();
         emitJson("MACRO_DEF", MacroNameTok.getIdentifierInfo()->getName().str(), macroUsr, absPath, PLoc.getLine(), PLoc.getColumn());
+        if (const MacroInfo *MI = MD->getMacroInfo()) {
+            emitJson("HOVER", MacroNameTok.getIdentifierInfo()->getName().str(), macroUsr, absPath, PLoc.getLine(), PLoc.getColumn(),
+                     "", 0, "\"hover\":{\"sig\":\"" + jsonEscape(macroSignature(MacroNameTok, MI)) + "\"}");
+            // 大纲用的范围：宏名到定义的最后一个记号
+            SourceLocation End = Lexer::getLocForEndOfToken(MI->getDefinitionEndLoc(), 0, SM, LangOpts);
+            PresumedLoc PEnd = SM.getPresumedLoc(End);
+            if (PEnd.isValid() && SM.getFileID(End) == SM.getFileID(MacroNameTok.getLocation()))
+                emitJson("EXTENT", MacroNameTok.getIdentifierInfo()->getName().str(), macroUsr, absPath, PLoc.getLine(),
+                         PLoc.getColumn(), "", 0, extentJson(PEnd));
+        }
     }
 
     // 2. 处理普通的宏展开
@@ -149,8 +233,29 @@ public:
     }
 
 private:
+    // 悬停用的宏定义原文：#define NAME(a, b) 展开体
+    std::string macroSignature(const Token &MacroNameTok, const MacroInfo *MI) {
+        std::string Sig = "#define " + MacroNameTok.getIdentifierInfo()->getName().str();
+        if (MI->isFunctionLike()) {
+            Sig += "(";
+            for (unsigned I = 0; I < MI->getNumParams(); ++I) {
+                StringRef P = MI->params()[I]->getName();
+                if (I) Sig += ", ";
+                Sig += P == "__VA_ARGS__" ? "..." : P.str();
+            }
+            if (MI->isGNUVarargs()) Sig += "...";
+            Sig += ")";
+        }
+        if (MI->getNumTokens()) {
+            CharSourceRange Body = CharSourceRange::getTokenRange(MI->tokens_begin()->getLocation(), MI->getDefinitionEndLoc());
+            Sig += " " + Lexer::getSourceText(Body, SM, LangOpts).str();
+        }
+        return clipHoverText(Sig);
+    }
+
     // 统一处理宏引用的逻辑，确保 USR 逻辑与之前“锚定定义处”的策略一致
     void handleMacroReference(const Token &MacroNameTok, const MacroDefinition &MD) {
+        if (DefsOnly) return;
         SourceLocation UseLoc = SM.getSpellingLoc(MacroNameTok.getLocation());
         if (SM.isInSystemHeader(UseLoc)) return;
         PresumedLoc PUseLoc = SM.getPresumedLoc(UseLoc);
@@ -182,12 +287,106 @@ class IndexerVisitor : public RecursiveASTVisitor<IndexerVisitor> {
     ASTContext &Context;
 public:
     explicit IndexerVisitor(ASTContext &Context) : Context(Context) {}
+
+    // 进入带函数体的函数时记下它的 USR，函数体里的调用都记到它名下 (嵌套的 lambda 会临时覆盖)
+    bool TraverseDecl(Decl *D) {
+        auto *FD = dyn_cast_or_null<FunctionDecl>(D);
+        if (!FD || !FD->doesThisDeclarationHaveABody())
+            return RecursiveASTVisitor::TraverseDecl(D);
+
+        std::string SavedCaller = CallerUsr;
+        llvm::SmallString<128> USR;
+        CallerUsr = index::generateUSRForDecl(FD, USR) ? "" : USR.str().str();
+        bool Ret = RecursiveASTVisitor::TraverseDecl(D);
+        CallerUsr = SavedCaller;
+        return Ret;
+    }
+
     bool VisitNamedDecl(NamedDecl *D) {
         processSymbol(D, "DEF", D->getLocation());
         return true;
     }
+
+    // --- 结构体布局 (pahole 式)：每个完整定义输出一次 成员偏移 / 大小 / 空洞 / 尾部填充，都以 bit 为单位 ---
+    bool VisitRecordDecl(RecordDecl *D) {
+        if (!D->isCompleteDefinition() || D->isInvalidDecl() || D->isDependentType() || D->getName().empty())
+            return true;
+        if (auto *CXX = dyn_cast<CXXRecordDecl>(D); CXX && CXX->isLambda()) return true;
+        SourceManager &SM = Context.getSourceManager();
+        SourceLocation Loc = SM.getSpellingLoc(D->getLocation());
+        if (SM.isInSystemHeader(Loc)) return true;
+        std::string absPath = getAbsPath(SM, Loc);
+        if (absPath.empty()) return true;
+        llvm::SmallString<128> USR;
+        if (index::generateUSRForDecl(D, USR)) return true;
+
+        const ASTRecordLayout &RL = Context.getASTRecordLayout(D);
+        uint64_t Reached = 0;
+        std::string Fields = layoutFields(D, 0, Reached);
+        uint64_t Size = Context.toBits(RL.getSize());
+        std::string Layout = "\"layout\":{\"size\":" + std::to_string(RL.getSize().getQuantity()) +
+                             ",\"align\":" + std::to_string(RL.getAlignment().getQuantity()) +
+                             ",\"union\":" + (D->isUnion() ? "1" : "0") +
+                             ",\"padding\":" + std::to_string(Size > Reached ? Size - Reached : 0) +
+                             ",\"fields\":" + Fields + "}";
+        PresumedLoc PLoc = SM.getPresumedLoc(Loc);
+        emitJson("LAYOUT", D->getNameAsString(), USR.c_str(), absPath, PLoc.getLine(), PLoc.getColumn(), "", 0, Layout);
+        return true;
+    }
+
     bool VisitDeclRefExpr(DeclRefExpr *E) {
-        processSymbol(E->getFoundDecl(), "REF", E->getLocation());
+        // 没有父节点指定访问方式时：函数名当作值用就是取了它的地址，其余是读
+        int fallback = isa<FunctionDecl>(E->getDecl()) ? ACCESS_ADDR : ACCESS_READ;
+        processSymbol(E->getFoundDecl(), "REF", E->getLocation(), takeAccess(E, fallback));
+        return true;
+    }
+
+    // --- 引用分类：父节点先于子节点被访问，在这里给子表达式定好访问方式，子节点 Visit 时取走 ---
+    bool VisitBinaryOperator(BinaryOperator *E) {
+        if (E->isAssignmentOp())
+            hintAccess(E->getLHS(), E->isCompoundAssignmentOp() ? ACCESS_READ | ACCESS_WRITE : ACCESS_WRITE);
+        // ops->open = my_open：运行时装配的函数指针表
+        if (E->getOpcode() == BO_Assign)
+            if (auto *ME = dyn_cast<MemberExpr>(E->getLHS()->IgnoreParenImpCasts()))
+                recordImpl(ME->getMemberDecl(), E->getRHS());
+        return true;
+    }
+
+    // --- 函数指针实现表：struct file_operations fops = { .open = my_open } 记一条 成员 -> 函数 的边 ---
+    bool VisitInitListExpr(InitListExpr *E) {
+        // 遍历只走语法形式，这里转到语义形式：语义形式里字段和初始值按声明顺序一一对应，
+        // 位置初始化、.a.b = f 这种多级指示符都能统一处理
+        InitListExpr *Sem = E->isSemanticForm() ? E : E->getSemanticForm();
+        if (Sem) recordImplInits(Sem);
+        return true;
+    }
+
+    bool VisitUnaryOperator(UnaryOperator *E) {
+        if (E->isIncrementDecrementOp())
+            hintAccess(E->getSubExpr(), ACCESS_READ | ACCESS_WRITE);
+        else if (E->getOpcode() == UO_AddrOf)
+            hintAccess(E->getSubExpr(), ACCESS_ADDR);
+        return true;
+    }
+
+    bool VisitCallExpr(CallExpr *E) {
+        // f->f_op->read_iter(...) 的被调用者是 read_iter 这个成员，同样记成 CALL
+        hintAccess(E->getCallee(), ACCESS_CALL);
+        recordLogFormat(E);
+        return true;
+    }
+
+    bool VisitUnaryExprOrTypeTraitExpr(UnaryExprOrTypeTraitExpr *E) {
+        if (!E->isArgumentType())
+            hintAccess(E->getArgumentExpr(), ACCESS_TYPE);
+        return true;
+    }
+
+    bool VisitArraySubscriptExpr(ArraySubscriptExpr *E) {
+        // 写数组元素 (s->buf[i] = x) 算写数组本身；通过指针下标写不算写指针变量
+        Expr *Base = E->getBase()->IgnoreParenImpCasts();
+        if (Base->getType()->isArrayType())
+            hintAccess(Base, takeAccess(E, 0));
         return true;
     }
 
@@ -195,7 +394,7 @@ public:
     bool VisitMemberExpr(MemberExpr *E) {
         // E->getMemberDecl() 获取该成员的定义 (ValueDecl)
         // E->getMemberLoc() 获取成员名字在源码中的位置 (极其重要，用于坐标匹配)
-        processSymbol(E->getMemberDecl(), "REF", E->getMemberLoc());
+        processSymbol(E->getMemberDecl(), "REF", E->getMemberLoc(), takeAccess(E, ACCESS_READ));
         return true;
     }
 
@@ -213,7 +412,7 @@ public:
                     // (备用方案：如果你的特定版本连 getBeginLoc 都没有，
                     // 可以安全地使用 E->getExprLoc() 替代，它会定位到 offsetof 宏的开头)
                     
-                    processSymbol(FD, "REF", Loc);
+                    processSymbol(FD, "REF", Loc, ACCESS_TYPE);
                 }
             }
         }
@@ -232,7 +431,7 @@ public:
 
         // 🌟 极简主义：既然只做 REF 跳转，我们直接调用 processSymbol 把它当作引用记录下来
         // Desig->getFieldLoc() 能够精准获取到源码中 ".open" 那个单词的位置
-        processSymbol(FD, "REF", Desig->getFieldLoc());
+        processSymbol(FD, "REF", Desig->getFieldLoc(), ACCESS_WRITE);
         
         return true;
     }
@@ -246,20 +445,20 @@ public:
         if (auto TDTL = TL.getAs<TypedefTypeLoc>()) {
             // 直接通过 getTypePtr() 获取 TypedefType，再调用 getDecl()
             // 这种写法在 LLVM 各个版本中最为稳健
-            processSymbol(TDTL.getTypePtr()->getDecl(), "REF", TDTL.getNameLoc());
+            processSymbol(TDTL.getTypePtr()->getDecl(), "REF", TDTL.getNameLoc(), ACCESS_TYPE);
         }
         // 2. 处理 结构体/联合体/枚举 类型引用 (struct nested_dev)
         else if (auto TTL = TL.getAs<TagTypeLoc>()) {
-            processSymbol(TTL.getDecl(), "REF", TTL.getNameLoc());
+            processSymbol(TTL.getDecl(), "REF", TTL.getNameLoc(), ACCESS_TYPE);
         }
         // --- 新增：C++ 模板特化类型 (如 std::vector<int>) ---
         else if (auto TSTL = TL.getAs<TemplateSpecializationTypeLoc>()) {
             TemplateDecl *TD = TSTL.getTypePtr()->getTemplateName().getAsTemplateDecl();
-            if (TD) processSymbol(TD, "REF", TSTL.getTemplateNameLoc());
+            if (TD) processSymbol(TD, "REF", TSTL.getTemplateNameLoc(), ACCESS_TYPE);
         }
         // --- 新增：处理通过 using 引入的类型别名 ---
         else if (auto ITL = TL.getAs<InjectedClassNameTypeLoc>()) {
-            processSymbol(ITL.getDecl(), "REF", ITL.getNameLoc());
+            processSymbol(ITL.getDecl(), "REF", ITL.getNameLoc(), ACCESS_TYPE);
         }
         return true;
     }
@@ -267,7 +466,7 @@ public:
     // 拦截 C++ 构造函数调用 (比如 MyClass obj; 或者 new MyClass())
     bool VisitCXXConstructExpr(CXXConstructExpr *E) {
         if (CXXConstructorDecl *CD = E->getConstructor()) {
-            processSymbol(CD, "REF", E->getLocation());
+            processSymbol(CD, "REF", E->getLocation(), ACCESS_CALL);
         }
         return true;
     }
@@ -276,7 +475,7 @@ public:
     bool VisitCXXDeleteExpr(CXXDeleteExpr *E) {
         if (CXXRecordDecl *RD = E->getDestroyedType()->getAsCXXRecordDecl()) {
             if (CXXDestructorDecl *DD = RD->getDestructor()) {
-                processSymbol(DD, "REF", E->getBeginLoc());
+                processSymbol(DD, "REF", E->getBeginLoc(), ACCESS_CALL);
             }
         }
         return true;
@@ -288,7 +487,7 @@ public:
             if (Init->isAnyMemberInitializer()) {
                 if (FieldDecl *FD = Init->getAnyMember()) {
                     // 记录对成员变量的引用
-                    processSymbol(FD, "REF", Init->getMemberLocation());
+                    processSymbol(FD, "REF", Init->getMemberLocation(), ACCESS_WRITE);
                 }
             }
         }
@@ -298,7 +497,7 @@ public:
     // 拦截重载运算符 (如 a + b, obj->foo)
     bool VisitCXXOperatorCallExpr(CXXOperatorCallExpr *E) {
         if (FunctionDecl *FD = E->getDirectCallee()) {
-            processSymbol(FD, "REF", E->getOperatorLoc());
+            processSymbol(FD, "REF", E->getOperatorLoc(), ACCESS_CALL);
         }
         return true;
     }
@@ -306,9 +505,161 @@ public:
 
 
 private:
+    // 成员列表 [[名字, 类型, 偏移, 大小, 之后的空洞], ...]，偏移是相对最外层结构体的 bit 数；
+    // 匿名 struct/union 成员像 pahole 一样就地展开，多一列子成员列表。Reached 带回本层成员用到的最远位置 (算尾部填充)
+    std::string layoutFields(const RecordDecl *RD, uint64_t Base, uint64_t &Reached) {
+        const ASTRecordLayout &RL = Context.getASTRecordLayout(RD);
+        PrintingPolicy Policy = Context.getPrintingPolicy();
+        Policy.AnonymousTagLocations = false;  // 不要把 (unnamed struct at /abs/path:12:3) 写进库里
+
+        struct Entry { std::string Name, Type; uint64_t Off, Bits; const RecordDecl *Anon; };
+        std::vector<Entry> Entries;
+        if (auto *CXX = dyn_cast<CXXRecordDecl>(RD)) {
+            for (const CXXBaseSpecifier &B : CXX->bases()) {
+                const CXXRecordDecl *BD = B.getType()->getAsCXXRecordDecl();
+                if (B.isVirtual() || !BD || BD->isDependentType()) continue;
+                Entries.push_back({"", B.getType().getAsString(Policy), Base + Context.toBits(RL.getBaseClassOffset(BD)),
+                                   Context.toBits(Context.getASTRecordLayout(BD).getNonVirtualSize()), nullptr});
+            }
+        }
+        for (const FieldDecl *FD : RD->fields()) {
+            uint64_t Off = Base + RL.getFieldOffset(FD->getFieldIndex());
+            uint64_t Bits = FD->isBitField() ? FD->getBitWidthValue() : Context.getTypeSize(FD->getType());
+            Entries.push_back({FD->getNameAsString(), FD->getType().getAsString(Policy), Off, Bits,
+                               FD->isAnonymousStructOrUnion() ? FD->getType()->getAsRecordDecl() : nullptr});
+        }
+        std::stable_sort(Entries.begin(), Entries.end(), [](const Entry &A, const Entry &B) { return A.Off < B.Off; });
+
+        std::string Out = "[";
+        Reached = Base;
+        for (size_t I = 0; I < Entries.size(); ++I) {
+            const Entry &E = Entries[I];
+            Reached = std::max(Reached, E.Off + E.Bits);
+            // union 的成员都从同一处开始，谈不上空洞；结构体里是到下一个成员之间没用上的 bit (最后一个成员之后算尾部填充)
+            uint64_t Hole = 0;
+            if (!RD->isUnion() && I + 1 < Entries.size() && Entries[I + 1].Off > Reached)
+                Hole = Entries[I + 1].Off - Reached;
+            if (I) Out += ",";
+            Out += "[\"" + jsonEscape(E.Name) + "\",\"" + jsonEscape(E.Type) + "\"," + std::to_string(E.Off) + "," +
+                   std::to_string(E.Bits) + "," + std::to_string(Hole);
+            if (E.Anon) {
+                uint64_t Inner = 0;
+                Out += "," + layoutFields(E.Anon, E.Off, Inner);
+            }
+            Out += "]";
+        }
+        return Out + "]";
+    }
+
+    std::string CallerUsr;  // 当前所在函数的 USR，函数体外为空
+    llvm::DenseSet<const InitListExpr *> SeenInitLists;  // 已经沿语义形式处理过的初始化列表 (嵌套的会被再访问一次)
+
+    void recordImplInits(InitListExpr *ILE) {
+        if (!SeenInitLists.insert(ILE).second) return;
+        const RecordDecl *RD = ILE->getType()->getAsRecordDecl();
+        if (!RD) {
+            // 函数指针表的数组：static const struct ops tbl[] = { {...}, {...} }
+            for (Expr *Init : ILE->inits())
+                if (auto *Sub = dyn_cast_or_null<InitListExpr>(Init))
+                    recordImplInits(Sub);
+            return;
+        }
+        if (RD->isUnion()) {
+            if (FieldDecl *FD = ILE->getInitializedFieldInUnion())
+                if (ILE->getNumInits() == 1) recordImplInit(FD, ILE->getInit(0));
+            return;
+        }
+        unsigned I = 0;
+        for (FieldDecl *FD : RD->fields()) {
+            if (FD->isUnnamedBitField()) continue;
+            if (I >= ILE->getNumInits()) break;
+            recordImplInit(FD, ILE->getInit(I++));
+        }
+    }
+
+    void recordImplInit(FieldDecl *FD, Expr *Init) {
+        if (auto *Sub = dyn_cast_or_null<InitListExpr>(Init))
+            recordImplInits(Sub);
+        else if (Init)
+            recordImpl(FD, Init);
+    }
+
+    // 成员是函数指针、值是函数名 (或 &函数名) 时输出一条 IMPL：位置是函数名，context 是成员的 USR
+    void recordImpl(ValueDecl *Member, Expr *Value) {
+        auto *Field = dyn_cast_or_null<FieldDecl>(Member);
+        if (!Field || !Field->getType()->isFunctionPointerType()) return;
+        Expr *V = Value->IgnoreParenImpCasts();
+        if (auto *UO = dyn_cast<UnaryOperator>(V); UO && UO->getOpcode() == UO_AddrOf)
+            V = UO->getSubExpr()->IgnoreParenImpCasts();
+        auto *DRE = dyn_cast<DeclRefExpr>(V);
+        auto *Fn = DRE ? dyn_cast<FunctionDecl>(DRE->getDecl()) : nullptr;
+        if (!Fn) return;
+
+        SourceManager &SM = Context.getSourceManager();
+        SourceLocation Loc = SM.getSpellingLoc(DRE->getLocation());
+        if (SM.isInSystemHeader(Loc)) return;
+        std::string absPath = getAbsPath(SM, Loc);
+        if (absPath.empty()) return;
+
+        llvm::SmallString<128> FnUsr, FieldUsr;
+        if (index::generateUSRForDecl(Fn, FnUsr) || index::generateUSRForDecl(Field, FieldUsr)) return;
+        PresumedLoc PLoc = SM.getPresumedLoc(Loc);
+        emitJson("IMPL", Fn->getNameAsString(), FnUsr.c_str(), absPath, PLoc.getLine(), PLoc.getColumn(),
+                 FieldUsr.str().str());
+    }
+    // --- 内核日志：printk 家族的调用点 + 格式串，dmesg 里的一行靠它反查到源码 ---
+    // pr_err / dev_err 都是宏，展开后调到带 __printf(N, M) 属性的 _printk / _dev_err，格式串就是第 N 个参数。
+    // 位置取宏展开点 (和调试信息的 DILocation 一致)，add_kernel_pl 打进日志的 [file:line] 就能直接对上。
+    static bool isLogFunction(llvm::StringRef Name) {
+        return Name.contains("printk") || Name.starts_with("_dev_") || Name.starts_with("dev_") ||
+               Name.starts_with("netdev_") || Name.starts_with("_netdev_");
+    }
+
+    void recordLogFormat(CallExpr *E) {
+        if (DefsOnly) return;
+        FunctionDecl *Callee = E->getDirectCallee();
+        if (!Callee || !Callee->getIdentifier() || !isLogFunction(Callee->getName())) return;
+        const FormatAttr *FA = Callee->getAttr<FormatAttr>();
+        if (!FA || FA->getFormatIdx() < 1 || (unsigned)FA->getFormatIdx() > E->getNumArgs()) return;
+        auto *Fmt = dyn_cast<StringLiteral>(E->getArg(FA->getFormatIdx() - 1)->IgnoreParenImpCasts());
+        if (!Fmt || Fmt->getCharByteWidth() != 1) return;
+
+        SourceManager &SM = Context.getSourceManager();
+        SourceLocation Loc = SM.getFileLoc(E->getExprLoc());
+        if (SM.isInSystemHeader(Loc)) return;
+        std::string absPath = getAbsPath(SM, Loc);
+        if (absPath.empty()) return;
+        llvm::SmallString<128> USR;
+        if (index::generateUSRForDecl(Callee, USR)) return;
+
+        // KERN_ERR 这类级别前缀 ("\001" + 级别字符) 不会出现在 dmesg 的正文里，去掉
+        llvm::StringRef Text = Fmt->getString();
+        while (Text.size() >= 2 && Text[0] == '\001') Text = Text.drop_front(2);
+        PresumedLoc PLoc = SM.getPresumedLoc(Loc);
+        emitJson("LOGFMT", Callee->getNameAsString(), USR.c_str(), absPath, PLoc.getLine(), PLoc.getColumn(),
+                 "", 0, "\"format\":\"" + jsonEscape(Text) + "\"");
+    }
+
+    llvm::DenseMap<const Expr *, int> AccessHints;  // 父节点给子表达式预定的访问方式
+
+    void hintAccess(const Expr *E, int access) {
+        if (E && access)
+            AccessHints[E->IgnoreParenImpCasts()] |= access;
+    }
+
+    int takeAccess(const Expr *E, int fallback) {
+        auto It = AccessHints.find(E);
+        if (It == AccessHints.end()) return fallback;
+        int access = It->second;
+        AccessHints.erase(It);
+        return access;
+    }
 
     //输出usr数据到json
-    void processSymbol(NamedDecl *D, std::string role, SourceLocation Loc) {
+    void processSymbol(NamedDecl *D, std::string role, SourceLocation Loc, int access = 0) {
+        if (DefsOnly && role == "REF") return;
+        // 只有带 CALL 访问位的函数引用才算调用边 (取地址、当回调传出去、块作用域里的函数声明都不算)
+        bool isCall = role == "REF" && (access & ACCESS_CALL) && isa<FunctionDecl>(D);
         SourceManager &SM = Context.getSourceManager();
         Loc = SM.getSpellingLoc(Loc);
         if (SM.isInSystemHeader(Loc)) return;
@@ -338,9 +689,13 @@ private:
         // 其他任何奇奇怪怪的 Decl 走到这里，都会保持 isDef = true，再也不会被误伤成 REF 了！
 
         // --- 区分 声明(DECL) 与 定义(DEF) ---
-        if (role == "DEF" && !isDef) {
+        // 前向声明 (头文件里的原型、extern) 按引用入库，kind 记成 DECL_xxx：它不是使用，引用计数不算它
+        bool isDecl = role == "DEF" && !isDef;
+        if (isDecl) {
             role = "REF"; 
+            access = 0;  // 前向声明不是访问
         }
+        if (DefsOnly && role == "REF") return;
 
         // --- 核心修复 C：强制转换为绝对路径 (使用极速缓存版) ---
         std::string absPath = getAbsPath(SM, Loc);
@@ -358,7 +713,54 @@ private:
         llvm::SmallString<128> USR;
         index::generateUSRForDecl(D, USR);
         PresumedLoc PLoc = SM.getPresumedLoc(Loc);
-        emitJson(role + "_" + D->getDeclKindName(), D->getNameAsString(), USR.c_str(), absPath, PLoc.getLine(), PLoc.getColumn());
+        std::string kindPrefix = isDecl ? "DECL" : role;
+        emitJson(kindPrefix + "_" + D->getDeclKindName(), D->getNameAsString(), USR.c_str(), absPath, PLoc.getLine(), PLoc.getColumn(),
+                 isCall ? CallerUsr : "", role == "REF" ? access : 0);
+        if (role == "DEF" && isOutlineDecl(D)) {
+            emitHover(D, USR.c_str(), absPath, PLoc);
+            emitExtent(D, USR.c_str(), absPath, Loc);
+        }
+    }
+
+    // --- 定义的真实范围 (函数头到右花括号、整个结构体)，大纲靠它嵌套；名字位置仍在 DEF 行里 ---
+    void emitExtent(NamedDecl *D, const std::string &USR, const std::string &absPath, SourceLocation NameLoc) {
+        SourceManager &SM = Context.getSourceManager();
+        // 宏展开出来的定义取展开处的范围；首尾不在名字所在的文件里 (跨文件的宏拼接) 就不输出
+        CharSourceRange R = SM.getExpansionRange(D->getSourceRange());
+        SourceLocation Begin = R.getBegin();
+        SourceLocation End = R.isTokenRange() ? Lexer::getLocForEndOfToken(R.getEnd(), 0, SM, Context.getLangOpts()) : R.getEnd();
+        if (Begin.isInvalid() || End.isInvalid()) return;
+        FileID FID = SM.getFileID(NameLoc);
+        if (SM.getFileID(Begin) != FID || SM.getFileID(End) != FID) return;
+        PresumedLoc PBegin = SM.getPresumedLoc(Begin), PEnd = SM.getPresumedLoc(End);
+        if (!PBegin.isValid() || !PEnd.isValid()) return;
+        emitJson("EXTENT", D->getNameAsString(), USR, absPath, PBegin.getLine(), PBegin.getColumn(), "", 0, extentJson(PEnd));
+    }
+
+    // --- 悬停信息：定义处预先打印好签名 / 类型和文档注释，悬停时按 USR 一次读出，不在请求里解析 TU ---
+    void emitHover(NamedDecl *D, const std::string &USR, const std::string &absPath, PresumedLoc PLoc) {
+        // 局部变量和参数数量太多，悬停价值也低，只记文件级的实体和成员 (调用方已用 isOutlineDecl 过滤)
+        if (isa<NamespaceDecl>(D)) return;
+
+        std::string Sig;
+        if (auto *TD = dyn_cast<TagDecl>(D)) {
+            Sig = TD->getKindName().str() + " " + TD->getNameAsString();  // 成员列表交给大纲和布局
+        } else {
+            PrintingPolicy Policy = Context.getPrintingPolicy();
+            Policy.TerseOutput = true;           // 不打印函数体
+            Policy.SuppressInitializers = true;  // 不打印 fops = { ... } 这种初始化
+            Policy.PolishForDeclaration = true;
+            Policy.AnonymousTagLocations = false;
+            llvm::raw_string_ostream OS(Sig);
+            D->print(OS, Policy);
+        }
+
+        std::string Hover = "\"hover\":{\"sig\":\"" + jsonEscape(clipHoverText(Sig)) + "\"";
+        if (const RawComment *RC = Context.getRawCommentForAnyRedecl(D)) {
+            std::string Doc = RC->getFormattedText(Context.getSourceManager(), Context.getDiagnostics());
+            if (!Doc.empty()) Hover += ",\"doc\":\"" + jsonEscape(clipHoverText(Doc)) + "\"";
+        }
+        emitJson("HOVER", D->getNameAsString(), USR, absPath, PLoc.getLine(), PLoc.getColumn(), "", 0, Hover + "}");
     }
 };
 
@@ -371,17 +773,37 @@ public:
 
 class IndexerAction : public ASTFrontendAction {
 protected:
+    bool BeginInvocation(CompilerInstance &CI) override {
+        // 函数体里只有引用，定义阶段直接让 Sema 跳过，省掉大部分解析时间
+        if (DefsOnly) CI.getFrontendOpts().SkipFunctionBodies = true;
+        return true;
+    }
+
     void ExecuteAction() override {
-        getCompilerInstance().getPreprocessor().addPPCallbacks(std::make_unique<IndexerPPCallbacks>(getCompilerInstance().getSourceManager()));
+        getCompilerInstance().getPreprocessor().addPPCallbacks(std::make_unique<IndexerPPCallbacks>(
+            getCompilerInstance().getSourceManager(), getCompilerInstance().getLangOpts()));
         ASTFrontendAction::ExecuteAction();
     }
     std::unique_ptr<ASTConsumer> CreateASTConsumer(CompilerInstance &CI, StringRef InFile) override { return std::make_unique<IndexerConsumer>(CI.getASTContext()); }
 };
 
+// 与 clang -E 相同，但不管编译命令里的 -o，固定输出到标准输出
+class StdoutPreprocessAction : public PrintPreprocessedAction {
+protected:
+    bool BeginInvocation(CompilerInstance &CI) override {
+        CI.getFrontendOpts().OutputFile = "-";
+        CI.getPreprocessorOutputOpts().ShowCPP = 1;
+        CI.getPreprocessorOutputOpts().ShowLineMarkers = 1;
+        return PrintPreprocessedAction::BeginInvocation(CI);
+    }
+};
+
 
 int main(int argc, const char **argv) {
     auto ExpectedParser = CommonOptionsParser::create(argc, argv, MyToolCategory);
     if (!ExpectedParser) return 1;
     ClangTool Tool(ExpectedParser->getCompilations(), ExpectedParser->getSourcePathList());
+    if (Preprocess)
+        return Tool.run(newFrontendActionFactory<StdoutPreprocessAction>().get());
     return Tool.run(newFrontendActionFactory<IndexerAction>().get());
 }
\ No newline at end of file
@@ -21,11 +21,24 @@ import subprocess
 import clang_init
 import shlex
 from cindex import Index, CursorKind
+from parse_cache import ParseCache
+from preprocess_cache import PreprocessCache, invocation_end
+from log_resolver import LogResolver
+import ftrace
 import json
 import multiprocessing
 import threading
 import hashlib
-import re
+import zlib
+import collections
+import queue
+import heapq
+import itertools
+import glob
+import fnmatch
+import tarfile
+import tempfile
+import shutil
 
 # 配置日志
 logging.basicConfig(
@@ -56,17 +69,127 @@ def with_retry(base_delay=0.05):
         return wrapper
     return decorator
 
+class IndexQueue:
+    """
+    线程安全的索引优先级队列：索引线程按优先级取任务，LSP 层可以在运行时把文件提到前面。
+    提升优先级时不在堆里原地修改，而是压入一个新条目，旧条目出堆时发现已失效直接丢弃。
+    """
+    PRIORITY_OPEN = 0  # 编辑器里打开的文件
+    PRIORITY_RELATED = 1  # 打开文件的包含者、调用者/被调用者所在的文件
+    PRIORITY_NEARBY = 2  # 打开文件同目录下的文件 (同一个驱动)
+    PRIORITY_BULK = 3  # compile_commands.json 里剩下的文件
+    PRIORITY_REFS = 4  # 两阶段索引的第二遍 (补引用)，排在所有定义之后
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap = []
+        self._entries = {}  # (abs_path, phase) -> [priority, seq, cmd, phase]
+        self._wanted = {}  # 还没入队就被提升过的文件：abs_path -> priority
+        self._seq = itertools.count()
+
+    @staticmethod
+    def task_path(cmd):
+        return os.path.realpath(os.path.join(cmd.get('directory', ''), cmd.get('file', '')))
+
+    def push(self, cmd, priority=PRIORITY_BULK, phase=None):
+        path = IndexQueue.task_path(cmd)
+        phase = phase or Database.PHASE_FULL
+        with self._lock:
+            priority = min(priority, self._wanted.get(path, priority))
+            entry = [priority, next(self._seq), cmd, phase]
+            self._entries[(path, phase)] = entry
+            heapq.heappush(self._heap, entry)
+
+    def bump(self, path, priority):
+        """把文件 (所有阶段) 提到 priority (只升不降)，返回是否真的提升了"""
+        bumped = False
+        with self._lock:
+            if priority < self._wanted.get(path, IndexQueue.PRIORITY_REFS):
+                self._wanted[path] = priority
+            # 先提定义阶段，保证同一个文件的定义先于引用出队
+            for phase in (Database.PHASE_DEFS, Database.PHASE_FULL):
+                entry = self._entries.get((path, phase))
+                if entry is None or entry[0] <= priority:
+                    continue
+                entry[2], cmd = None, entry[2]  # 旧条目作废
+                entry = [priority, next(self._seq), cmd, phase]
+                self._entries[(path, phase)] = entry
+                heapq.heappush(self._heap, entry)
+                bumped = True
+        return bumped
+
+    def pop(self):
+        """取出优先级最高的任务，返回 (cmd, phase)，队列空时返回 (None, None)"""
+        with self._lock:
+            while self._heap:
+                priority, _, cmd, phase = heapq.heappop(self._heap)
+                if cmd is not None:
+                    del self._entries[(IndexQueue.task_path(cmd), phase)]
+                    return cmd, phase
+            return None, None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class IndexProfile:
+    """
+    索引范围：只有命中的编译单元才会被解析。
+    include/exclude 是相对工作区路径的 glob (fnmatch 语义，* 可以跨目录，例如 drivers/gpu/*)，
+    files 是显式列出的绝对路径 (来自 .ftrace_scope.txt 及其包含闭包)。
+    范围只决定“这次解析谁”，已经建好的文件不会被删掉，放宽范围后只会补建新命中的文件。
+    """
+    def __init__(self, include=(), exclude=(), files=None):
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self.files = set(files) if files is not None else None
+
+    @staticmethod
+    def read_config(path):
+        """从 JSON 加载：{"include": [...], "exclude": [...], "scope": ".ftrace_scope.txt"}"""
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def matches(self, abs_path):
+        rel_path = os.path.relpath(abs_path, Database._workspace_real)
+        if any(fnmatch.fnmatchcase(rel_path, pat) for pat in self.exclude):
+            return False
+        if self.files is None and not self.include:
+            return True
+        if self.files is not None and abs_path in self.files:
+            return True
+        return any(fnmatch.fnmatchcase(rel_path, pat) for pat in self.include)
+
+    def __str__(self):
+        scope = f", scope={len(self.files)} 个文件" if self.files is not None else ""
+        return f"include={self.include}, exclude={self.exclude}{scope}"
+
+
 class Database:
     _workspace_dir = None
     _core_bin_path = None
     _clang_include_path = None
     _clang_lib_path = None
+    _db_file = None  # 非空时覆盖默认的 pyclangd_index.db (分片索引时每个进程写自己的库)
+    _workspace_real = None  # 工作区的真实路径，库里工作区内的路径都相对它存储
+    _path_prefixes = ()  # 需要剥掉的工作区前缀 (realpath 与 abspath 可能不同，比如工作区是软链接)
+    _parse_cache = None  # ParseCache，命中时工人进程跳过解析直接回放结果
+    _preprocess_cache = PreprocessCache()  # 宏展开用的预处理结果，按编译单元和编译参数缓存
+    _md5_memo = {}  # 进程内的文件 md5 缓存：path -> (mtime_ns, size, md5)，头文件会被反复计算
+    SCHEMA_VERSION = 12  # PRAGMA user_version，1: 工作区内路径存为相对路径，2: files 增加 phase 列，3: symbols 按角色拆分，4: 64 位符号 ID，5: 引用计数表，6: 调用图，7: 引用访问方式，8: 函数指针实现表，9: 结构体布局表，10: 悬停信息表，11: 定义范围表，12: 日志格式串表
+    PHASE_DEFS = 1  # 只解析了定义和 #include (跳过函数体)
+    PHASE_FULL = 2  # 完整解析，引用也已入库
     commands_map = {}  #文件名 -> 编译命令
     file_md5_map = {}  #文件名 -> md5 记录文件和md5的关系在编译之前，现在检查md5是否改变
 
-    def __init__(self, workspace_dir = None, setup=False):
+    def __init__(self, workspace_dir = None, setup=False, db_file=None):
         # 如果传入了路径，就更新全局配置
         if workspace_dir:
+            Database._db_file = os.path.abspath(db_file) if db_file else None
+            Database._workspace_real = os.path.realpath(workspace_dir)
+            Database._path_prefixes = tuple(dict.fromkeys(
+                (Database._workspace_real + os.sep, os.path.abspath(workspace_dir) + os.sep)))
             Database._workspace_dir = os.path.abspath(workspace_dir)
             # 自动推导核心二进制路径
             script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -78,17 +201,212 @@ class Database:
             raise ValueError("❌ 错误：Database 尚未初始化 workspace_dir！请在程序入口处先调用 Database(path)")
 
         self.workspace_dir = Database._workspace_dir
-        self.db_path = os.path.join(self.workspace_dir, "pyclangd_index.db")
+        # 只传 db_file 不传 workspace_dir 时临时打开另一个库 (例如待导入的索引包)，不改全局配置
+        self.db_path = (os.path.abspath(db_file) if db_file else None) or Database._db_file or \
+            os.path.join(self.workspace_dir, "pyclangd_index.db")
         
-        self.conn = sqlite3.connect(self.db_path, timeout=60.0, check_same_thread=False, isolation_level="IMMEDIATE")
-        self.cursor = self.conn.cursor()
-        self.conn.execute('PRAGMA journal_mode=WAL;')
-        self.conn.execute('PRAGMA synchronous=NORMAL;')
+        self._file_cache = collections.OrderedDict()  # (用途, 库内路径) -> (索引时的 md5, 结果)，见 _cached_by_file
+        self._log_resolver = None  # (logfmts 修改代数, LogResolver)，见 log_resolver
+        self._connect()
         # 3. 只有 setup 为 True 时才检查表结构
         if setup:
             self._setup()
             self.load_commands_map()
 
+    def _connect(self):
+        while True:
+            ino = Database._inode(self.db_path)
+            self.conn = sqlite3.connect(self.db_path, timeout=60.0, check_same_thread=False, isolation_level="IMMEDIATE")
+            self.cursor = self.conn.cursor()
+            self.conn.execute('PRAGMA journal_mode=WAL;')
+            self.conn.execute('PRAGMA synchronous=NORMAL;')
+            self._db_ino = Database._inode(self.db_path)
+            if ino is None or ino == self._db_ino:
+                break
+            # 打开的同时正式库被替换了：这个连接连的是旧文件，它的 -wal/-shm 会和新库同名，关掉重连
+            self._disconnect()
+        self._log_resolver = None  # 换了库文件，修改代数不再可比
+        self.conn.create_function("usr_id", 1, Database.usr_id, deterministic=True)
+        self.conn.create_function("unpack_blob", 1, Database.unpack_blob, deterministic=True)
+
+    def _disconnect(self):
+        # 先关游标：executemany 用过的语句在游标回收前不会被释放，只关连接会留下僵尸连接，文件句柄和锁都还在
+        try:
+            self.cursor.close()
+        except sqlite3.ProgrammingError:
+            pass  # 连接已经关过了 (例如影子库交给服务器替换之后)
+        self.conn.close()
+
+    @staticmethod
+    def _inode(path):
+        try:
+            return os.stat(path).st_ino
+        except OSError:
+            return None
+
+    def reopen_if_swapped(self):
+        """库文件被影子库整体替换后 (inode 变了) 重新打开连接，返回是否发生了替换"""
+        try:
+            ino = os.stat(self.db_path).st_ino
+        except OSError:
+            return False  # 替换的瞬间路径可能不存在，下次再看
+        if ino == self._db_ino:
+            return False
+        self._disconnect()
+        self._connect()
+        return True
+
+    @staticmethod
+    def shadow_db_name(db_path):
+        """影子库放在正式库旁边，保证 rename 在同一个文件系统内是原子的"""
+        root, ext = os.path.splitext(db_path)
+        return f"{root}.shadow{ext or '.db'}"
+
+    @staticmethod
+    def shadow_ready_name(shadow_path):
+        """影子库建完但正式库还有连接时留下的就绪标记，由持有连接的服务器替换"""
+        return shadow_path + ".ready"
+
+    @staticmethod
+    def release_db_file(path, timeout=1.0):
+        """
+        把库切回 DELETE 日志模式并返回连接 (已持有排他锁)，SQLite 会自己合并并删掉 -wal/-shm。
+        WAL 模式只有唯一的连接才能切出去，所以还有别的连接 (同进程或别的进程) 在用时返回 None，什么都不改：
+        绝不能替别人删 -wal/-shm，它们是按路径找的，旧连接关闭时会把自己的 WAL 合并进 / 删掉同名的新库的 WAL。
+        """
+        conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        try:
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+            if conn.execute('PRAGMA journal_mode=DELETE;').fetchone()[0] == 'delete':
+                conn.execute('BEGIN EXCLUSIVE')
+                return conn
+        except sqlite3.OperationalError:
+            pass
+        conn.close()
+        return None
+
+    @staticmethod
+    def replace_db_file(src_path, dst_path):
+        """
+        用 src_path 原子替换 dst_path，返回是否替换了。两边都先切成不带 WAL 的单个文件，
+        dst_path 还有连接时不替换 (见 release_db_file)，由调用方决定是报错还是交给持有连接的一方稍后替换。
+        """
+        src = Database.release_db_file(src_path)
+        if src is None:
+            return False
+        src.close()
+        if not os.path.exists(dst_path):
+            os.replace(src_path, dst_path)
+            return True
+        dst = Database.release_db_file(dst_path)
+        if dst is None:
+            return False
+        try:
+            # 持有旧库的排他锁时 rename，期间新打开的连接要么等锁后发现 inode 变了重连，要么直接打开新库
+            os.replace(src_path, dst_path)
+        finally:
+            dst.close()
+        return True
+
+    def publish_shadow(self, live_path):
+        """
+        影子库建完后原子替换正式库。正式库还开着 (VS Code 服务器、后台索引) 时不替换，只留下就绪标记，
+        服务器在没有后台索引时关掉自己的连接再替换 (adopt_ready_shadow)。返回是否已经替换。
+        """
+        self.conn.commit()
+        self._disconnect()
+        if not Database.replace_db_file(self.db_path, live_path):
+            open(Database.shadow_ready_name(self.db_path), 'w').close()
+            logger.warning(f"⏳ 正式库 {live_path} 正在被使用，影子库已就绪，VS Code 服务器空闲时会自动切换")
+            return False
+        self.db_path = live_path
+        if Database._db_file:
+            Database._db_file = live_path
+        self._connect()
+        logger.info(f"🔄 影子库已原子替换为正式库: {live_path}")
+        return True
+
+    def adopt_ready_shadow(self):
+        """服务器端：旁边有就绪的影子库时关掉本连接，替换正式库后重新打开。返回是否替换了"""
+        shadow = Database.shadow_db_name(self.db_path)
+        marker = Database.shadow_ready_name(shadow)
+        if not os.path.exists(marker):
+            return False
+        self._disconnect()
+        try:
+            swapped = Database.replace_db_file(shadow, self.db_path)
+        finally:
+            self._connect()
+        if swapped:
+            os.remove(marker)
+            logger.info(f"🔄 影子库已原子替换为正式库: {self.db_path}")
+        return swapped
+
+    @staticmethod
+    def to_db_path(path):
+        """绝对路径 -> 库内路径：工作区内的文件存相对路径，工作区外 (系统头文件、O= 输出目录) 保持绝对路径"""
+        if path:
+            for prefix in Database._path_prefixes:
+                if path.startswith(prefix):
+                    return path[len(prefix):]
+        return path
+
+    @staticmethod
+    def from_db_path(path):
+        """库内路径 -> 绝对路径"""
+        if not path or os.path.isabs(path) or path.startswith('<'):
+            return path
+        return os.path.join(Database._workspace_real, path)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1 << 16)
+    def usr_id(usr):
+        """和 clangd 的 SymbolID 一样取 USR 的 SHA1 前 8 字节，转成 SQLite 能直接存的有符号 64 位整数"""
+        return int.from_bytes(hashlib.sha1(usr.encode("utf-8")).digest()[:8], "little", signed=True)
+
+    @staticmethod
+    def to_db_usr(usr, role):
+        """inc 行的 usr 是头文件路径，宏的 usr 形如 c:/abs/file.h@NAME，里面的路径同样要相对化"""
+        if role == 'inc':
+            return Database.to_db_path(usr)
+        if usr.startswith('c:/'):
+            return 'c:' + Database.to_db_path(usr[2:])
+        return usr
+
+    @staticmethod
+    def pack_blob(text):
+        """布局、悬停这类附带的大段 JSON 文本压缩后入库"""
+        return zlib.compress(text.encode("utf-8"))
+
+    @staticmethod
+    def unpack_blob(data):
+        return zlib.decompress(data).decode("utf-8") if data is not None else None
+
+    @staticmethod
+    def abs_rows(rows):
+        """把查询结果第一列 (file_path) 还原成绝对路径"""
+        return [(Database.from_db_path(r[0]),) + tuple(r[1:]) for r in rows]
+
+    @staticmethod
+    def enable_parse_cache(cache_dir=None, max_bytes=4 << 30):
+        Database._parse_cache = ParseCache(cache_dir or ParseCache.default_dir(), max_bytes)
+        logger.info(f"📦 启用解析缓存: {Database._parse_cache.cache_dir}")
+
+    @staticmethod
+    def cached_file_md5(file_path):
+        """带 (mtime, size) 校验的 md5，文件不存在返回 None"""
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        memo = Database._md5_memo.get(file_path)
+        if memo and memo[0] == st.st_mtime_ns and memo[1] == st.st_size:
+            return memo[2]
+        with open(file_path, "rb") as f:
+            md5 = hashlib.file_digest(f, "md5").hexdigest()
+        Database._md5_memo[file_path] = (st.st_mtime_ns, st.st_size, md5)
+        return md5
+
     def get_file_md5(self, file_path):
         with open(file_path, "rb") as f:
             # 直接使用 file_digest 自动处理分块逻辑
@@ -97,46 +415,413 @@ class Database:
 
     @with_retry()
     def _setup(self):
-        # 表 B：位置与引用关系 (使用 UNIQUE 防爆发)
+        # 旧库 (SCHEMA_VERSION < 3) 把 inc/def/ref 混在一张 symbols 表里，includes 表也没有位置列；
+        # v3 的 defs / refs 存的是 USR 字符串；v4 ~ v6 的 refs 主键里没有访问方式。
+        # 先把旧表改名让出位置，_migrate 再把数据搬进新表
+        legacy = self._has_table('symbols')
+        if legacy:
+            self.cursor.execute('ALTER TABLE includes RENAME TO includes_legacy')
+        elif self._has_table('defs') and 'usr' in self._table_columns('defs'):
+            legacy = 'text_usr'
+            # 视图会跟着改名指向旧表，先删掉，下面按新表重建
+            self.cursor.execute('DROP VIEW IF EXISTS symbols')
+            self.cursor.execute('ALTER TABLE defs RENAME TO defs_legacy')
+            self.cursor.execute('ALTER TABLE refs RENAME TO refs_legacy')
+        elif self._has_table('refs') and 'access' not in self._table_columns('refs'):
+            legacy = 'no_access'
+            # 旧 refs 上的触发器和索引跟着改名，随旧表一起删掉
+            self.cursor.execute('DROP VIEW IF EXISTS symbols')
+            self.cursor.execute('ALTER TABLE refs RENAME TO refs_legacy')
+
+        # 表 A：符号 ID -> 完整 USR。热表里只存 64 位哈希 ID，定长比较，行也短得多
         self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS symbols (
+            CREATE TABLE IF NOT EXISTS usrs (
+                id INTEGER PRIMARY KEY,  -- usr_id(usr)
+                usr TEXT
+            )''')
+
+        # 表 B：按角色分表，WITHOUT ROWID 的主键就是 B 树的排序键，行按最常用的查询聚簇存放
+        # 定义：按符号 ID 聚簇，跳转定义/大纲只碰这张小表
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS defs (
+                usr_id INTEGER,  -- 符号 ID，完整 USR 在 usrs 表
                 file_path TEXT,  -- 文件路径
                 s_line INTEGER,  -- 开始行
                 s_col INTEGER,  -- 开始列
                 e_line INTEGER,  -- 结束行
                 e_col INTEGER,  -- 结束列
-                usr TEXT,  -- 如果role=inc，那么usr为头文件路径，如果role=def或者role=ref，usr为符号的USR
-                role TEXT,  -- 角色, 例如: "inc", "def", "ref"
-                name TEXT,  -- 符号或文件名字
+                name TEXT,  -- 符号名字
                 kind TEXT,  -- 节点类型
-                UNIQUE(file_path, s_line, s_col, e_line, e_col, usr)
-            )''')
-        
+                PRIMARY KEY (usr_id, file_path, s_line, s_col, e_line, e_col)
+            ) WITHOUT ROWID''')
+
+        # 引用：数量是定义的几十倍，按符号 ID、访问方式再按文件聚簇。同一个符号的引用挨在一起，
+        # "谁写了 task->state" 这类按访问方式过滤的查询只读主键上匹配的那几段，不需要额外的索引
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS refs (
+                usr_id INTEGER,
+                file_path TEXT,
+                s_line INTEGER,
+                s_col INTEGER,
+                e_line INTEGER,
+                e_col INTEGER,
+                name TEXT,
+                kind TEXT,
+                caller_id INTEGER,  -- 函数体里的函数引用：所在函数的符号 ID，其余为 NULL
+                access INTEGER NOT NULL DEFAULT 0,  -- 访问方式位标志 Database.ACCESS_*，0 为声明或未分类
+                PRIMARY KEY (usr_id, access, file_path, s_line, s_col, e_line, e_col)
+            ) WITHOUT ROWID''')
+
         # 表 C：增量与状态追踪
         self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS files (
                 file_path TEXT PRIMARY KEY,
                 mtime REAL,
-                md5 TEXT
+                md5 TEXT,
+                phase INTEGER  -- 源文件的索引阶段：PHASE_DEFS / PHASE_FULL，头文件为 NULL
             )''')
-        
-        # 表 D：源码与头文件的包含关系
+
+        # 表 D：#include 指令 (原来的 inc 行)，同时就是源码与头文件的包含关系
         self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS includes (
-                source_file TEXT,
-                included_file TEXT,
-                UNIQUE(source_file, included_file)
+                source_file TEXT,  -- 写了 #include 的文件
+                included_file TEXT,  -- 被包含的头文件
+                s_line INTEGER,
+                s_col INTEGER,
+                e_line INTEGER,
+                e_col INTEGER,
+                name TEXT,  -- 头文件名
+                PRIMARY KEY (source_file, s_line, s_col, included_file)
+            ) WITHOUT ROWID''')
+
+        # 表 E：每个符号的引用数 (不计前向声明，见 counted_ref)，由 refs 上的触发器增量维护 (保存、行级差分、删文件、合并分片都经过 refs)，
+        # 显示 "N 个引用"、给 Ctrl+T 结果排序都只需一次主键读取；计数归零的行直接删掉
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS refcounts (
+                usr_id INTEGER PRIMARY KEY,
+                refs INTEGER NOT NULL
             )''')
-        
-        # # 建立高频查询索引
-        # self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_sym_name ON symbols(name);')
-        # self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_ref_usr ON refs(usr);')
-        # self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_ref_caller ON refs(caller_usr);')
-        # self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_ref_file_role ON refs(file_path, role);')
-        # self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_included_file ON includes(included_file);')
-        # self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_includes_exact ON includes(exact_path);')
+
+        # 表 F：调用图，每条 调用者 -> 被调用者 边一行 (sites 为调用点个数)，同样由 refs 上的触发器维护。
+        # 多跳展开在这张小表上做递归查询，不必反复扫 refs 里同一条边的每个调用点
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS calls (
+                caller_id INTEGER,
+                callee_id INTEGER,
+                sites INTEGER NOT NULL,
+                PRIMARY KEY (caller_id, callee_id)
+            ) WITHOUT ROWID''')
+
+        # 表 G：函数指针实现表，.open = my_open / ops->open = my_open 各一行 (成员 -> 实现函数，位置是函数名)。
+        # 按成员聚簇，对 f_op->read_iter 做 go-to-implementation 是一次主键前缀查找
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS impls (
+                field_id INTEGER,  -- 函数指针成员的符号 ID (USR 里带着所属的结构体)
+                func_id INTEGER,  -- 填进去的函数
+                file_path TEXT,
+                s_line INTEGER,
+                s_col INTEGER,
+                e_line INTEGER,
+                e_col INTEGER,
+                name TEXT,  -- 函数名
+                PRIMARY KEY (field_id, func_id, file_path, s_line, s_col, e_line, e_col)
+            ) WITHOUT ROWID''')
+
+        # 表 H：结构体布局 (pahole 式的成员偏移 / 大小 / 空洞 / 填充)，索引时按当前编译配置算好，
+        # data 是 zlib 压缩的 JSON。查 struct sk_buff 的布局是一次按符号 ID 的主键读取，不用在请求里重新解析 TU
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS layouts (
+                usr_id INTEGER,
+                file_path TEXT,
+                s_line INTEGER,
+                s_col INTEGER,
+                e_line INTEGER,
+                e_col INTEGER,
+                name TEXT,
+                data BLOB,
+                PRIMARY KEY (usr_id, file_path, s_line, s_col, e_line, e_col)
+            ) WITHOUT ROWID''')
+
+        # 表 I：悬停信息，每个定义一行：打印好的签名 / 类型 (宏是 #define 原文) 和文档注释，data 同样是压缩的 JSON。
+        # 按符号 ID 聚簇，悬停和跳转定义一样是一次主键读取
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS hovers (
+                usr_id INTEGER,
+                file_path TEXT,
+                s_line INTEGER,
+                s_col INTEGER,
+                e_line INTEGER,
+                e_col INTEGER,
+                name TEXT,
+                data BLOB,
+                PRIMARY KEY (usr_id, file_path, s_line, s_col, e_line, e_col)
+            ) WITHOUT ROWID''')
+
+        # 表 J：定义的完整范围，大纲按它嵌套 (结构体里的成员、函数)。按文件聚簇，整个文件的范围是一次主键区间读取
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS extents (
+                usr_id INTEGER,
+                file_path TEXT,
+                s_line INTEGER,
+                s_col INTEGER,
+                e_line INTEGER,
+                e_col INTEGER,
+                name TEXT,
+                PRIMARY KEY (file_path, s_line, s_col, e_line, e_col, usr_id)
+            ) WITHOUT ROWID''')
+
+        # 表 K：printk 家族的调用点和格式串 (去掉了 KERN_ 级别前缀)，usr_id 是被调用的 _printk / _dev_err。
+        # 按文件、行号聚簇，日志里的 [file:line] 前缀是一次主键读取；没有前缀的日志按格式串在内存里模糊匹配
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS logfmts (
+                usr_id INTEGER,
+                file_path TEXT,
+                s_line INTEGER,
+                s_col INTEGER,
+                e_line INTEGER,
+                e_col INTEGER,
+                name TEXT,
+                fmt TEXT,
+                PRIMARY KEY (file_path, s_line, s_col, e_line, e_col, usr_id)
+            ) WITHOUT ROWID''')
+
+        # 表 L：各表的修改代数，由触发器在每次增删改时加一。进程里的内存索引 (日志格式串) 记下建好时的代数，
+        # 代数没变就直接复用，不必每次查询前扫一遍整表，也不会因为别的表在后台索引时不停变化而反复重建
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS generations (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            ) WITHOUT ROWID''')
+        self.cursor.execute("INSERT OR IGNORE INTO generations (name, value) VALUES ('logfmts', 0)")
+
+        # 表 M / N：导入的 ftrace (function_graph) 运行时耗时，按函数和 调用者 -> 被调用者 边汇总，单位 us。
+        # 不属于任何文件的索引行，重新导入 trace 时整表替换；同名的 static 函数靠 calls 调用图区分，分不出来的不入库
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ftrace_funcs (
+                usr_id INTEGER PRIMARY KEY,
+                calls INTEGER,
+                total_us REAL,
+                self_us REAL,
+                max_us REAL
+            )''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ftrace_edges (
+                caller_id INTEGER,
+                callee_id INTEGER,
+                calls INTEGER,
+                total_us REAL,
+                max_us REAL,
+                PRIMARY KEY (caller_id, callee_id)
+            ) WITHOUT ROWID''')
+
+        self._migrate(legacy)
+
+        # refs 可能是 _migrate 刚重建的表 (旧表上的触发器已随旧表删除)，触发器和索引放在升级之后建；
+        # 升级时整表搬运也就不会逐行触发，计数由 _migrate 按需整体重算
+        self.cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS refcount_add AFTER INSERT ON refs WHEN {Database.counted_ref('NEW.')} BEGIN
+                INSERT INTO refcounts (usr_id, refs) VALUES (NEW.usr_id, 1)
+                ON CONFLICT(usr_id) DO UPDATE SET refs = refs + 1;
+            END''')
+        self.cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS refcount_del AFTER DELETE ON refs WHEN {Database.counted_ref('OLD.')} BEGIN
+                UPDATE refcounts SET refs = refs - 1 WHERE usr_id = OLD.usr_id;
+                DELETE FROM refcounts WHERE usr_id = OLD.usr_id AND refs <= 0;
+            END''')
+        self.cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS call_edge_add AFTER INSERT ON refs WHEN NEW.caller_id IS NOT NULL BEGIN
+                INSERT INTO calls (caller_id, callee_id, sites) VALUES (NEW.caller_id, NEW.usr_id, 1)
+                ON CONFLICT(caller_id, callee_id) DO UPDATE SET sites = sites + 1;
+            END''')
+        self.cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS call_edge_del AFTER DELETE ON refs WHEN OLD.caller_id IS NOT NULL BEGIN
+                UPDATE calls SET sites = sites - 1 WHERE caller_id = OLD.caller_id AND callee_id = OLD.usr_id;
+                DELETE FROM calls WHERE caller_id = OLD.caller_id AND callee_id = OLD.usr_id AND sites <= 0;
+            END''')
+
+        for event in ('INSERT', 'DELETE', 'UPDATE'):
+            self.cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS logfmts_gen_{event.lower()} AFTER {event} ON logfmts BEGIN
+                    UPDATE generations SET value = value + 1 WHERE name = 'logfmts';
+                END''')
+
+        # 按原来 symbols 表的列把三张表拼回来，只给分片仓库、调试脚本这类不在热路径上的地方用
+        self.cursor.execute('''
+            CREATE VIEW IF NOT EXISTS symbols AS
+                SELECT file_path, s_line, s_col, e_line, e_col, usr, 'def' AS role, name, kind FROM defs JOIN usrs ON id = usr_id
+                UNION ALL
+                SELECT file_path, s_line, s_col, e_line, e_col, usr, 'ref', name, kind FROM refs JOIN usrs ON id = usr_id
+                UNION ALL
+                SELECT source_file, s_line, s_col, e_line, e_col, included_file, 'inc', name, 'inc' FROM includes
+        ''')
+
+        # 按文件位置查符号 (光标处的 USR、大纲、行级差分) 走这几个索引
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_defs_pos ON defs(file_path, s_line, s_col);')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_refs_pos ON refs(file_path, s_line, s_col);')
+        # Ctrl+T 和按名字兜底查定义
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_defs_name ON defs(name);')
+        # 被调用者反查 (向上找调用者) 和 outgoing calls 的调用点；部分索引只覆盖函数体里的调用
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_calls_callee ON calls(callee_id, caller_id);')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_refs_caller ON refs(caller_id) WHERE caller_id IS NOT NULL;')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_ftrace_edges_callee ON ftrace_edges(callee_id);')
+        # 按文件删除 / 差分实现表
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_impls_file ON impls(file_path, s_line, s_col);')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_layouts_file ON layouts(file_path);')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_hovers_file ON hovers(file_path);')
+        # 按结构体名查布局
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_layouts_name ON layouts(name);')
+        # 从头文件反查包含它的源文件 (包含闭包、打开文件优先级) 依赖它
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_included_file ON includes(included_file);')
         self.conn.commit()
 
+    def _has_table(self, name):
+        self.cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+        return self.cursor.fetchone() is not None
+
+    def _table_columns(self, name):
+        self.cursor.execute(f'PRAGMA table_info({name})')
+        return [row[1] for row in self.cursor.fetchall()]
+
+    def _import_text_usr_rows(self, table, source, cond=''):
+        """把旧表里 USR 字符串形式的 def/ref 行搬进新表，同时登记 ID -> USR"""
+        self.cursor.execute(f'INSERT OR IGNORE INTO usrs (id, usr) SELECT DISTINCT usr_id(usr), usr FROM {source} {cond}')
+        self.cursor.execute(f'''INSERT OR IGNORE INTO {table} (usr_id, file_path, s_line, s_col, e_line, e_col, name, kind)
+            SELECT usr_id(usr), file_path, s_line, s_col, e_line, e_col, name, kind FROM {source} {cond}''')
+
+    def _migrate(self, legacy=False):
+        """按 PRAGMA user_version 升级旧库"""
+        self.cursor.execute('PRAGMA user_version')
+        version = self.cursor.fetchone()[0]
+        # v3 / v4 的表结构升级必须最先做，下面的路径迁移只认新表
+        if legacy == 'text_usr':
+            # v4: USR 字符串换成 64 位符号 ID
+            logger.info("🔧 升级索引库: defs / refs 的 USR 换成 64 位符号 ID")
+            self._import_text_usr_rows('defs', 'defs_legacy')
+            self._import_text_usr_rows('refs', 'refs_legacy')
+            self.cursor.execute('DROP TABLE defs_legacy')
+            self.cursor.execute('DROP TABLE refs_legacy')
+        elif legacy == 'no_access':
+            # v7: refs 主键加入访问方式，只能整表搬运；旧引用没有分类 (access = 0)，重建索引后才有
+            logger.info("🔧 升级索引库: refs 增加访问方式列")
+            caller = 'caller_id' if 'caller_id' in self._table_columns('refs_legacy') else 'NULL'
+            self.cursor.execute(f'''INSERT INTO refs (usr_id, file_path, s_line, s_col, e_line, e_col, name, kind, caller_id)
+                SELECT usr_id, file_path, s_line, s_col, e_line, e_col, name, kind, {caller} FROM refs_legacy''')
+            self.cursor.execute('DROP TABLE refs_legacy')
+        elif legacy:
+            # v3: 拆分 symbols 表
+            logger.info("🔧 升级索引库: symbols 表按角色拆分为 defs / refs / includes")
+            self._import_text_usr_rows('defs', 'symbols', "WHERE role = 'def'")
+            self._import_text_usr_rows('refs', 'symbols', "WHERE role = 'ref'")
+            self.cursor.execute("""INSERT OR IGNORE INTO includes
+                SELECT file_path, usr, s_line, s_col, e_line, e_col, name FROM symbols WHERE role = 'inc'""")
+            self.cursor.execute('DROP TABLE symbols')
+            self.cursor.execute('DROP TABLE includes_legacy')
+        if version < 1:
+            # 旧库存的是绝对路径：把工作区前缀剥掉，变成可搬迁的相对路径
+            for prefix in Database._path_prefixes:
+                Database.remap_path_prefix(self.cursor, prefix, '')
+        if version < 2:
+            self.cursor.execute('PRAGMA table_info(files)')
+            if 'phase' not in [row[1] for row in self.cursor.fetchall()]:
+                self.cursor.execute('ALTER TABLE files ADD COLUMN phase INTEGER')
+            # 旧库里的源文件都是完整解析的
+            self.cursor.execute('UPDATE files SET phase = ? WHERE mtime IS NOT NULL AND phase IS NULL', (Database.PHASE_FULL,))
+        if version < 5:
+            # 旧核心输出的前向声明没有 DECL_ 标记，仍会被算进去，重建索引 (--rebuild) 后才准
+            Database.rebuild_refcounts(self.cursor)
+        if version < 6:
+            if 'caller_id' not in self._table_columns('refs'):
+                self.cursor.execute('ALTER TABLE refs ADD COLUMN caller_id INTEGER')
+            if version:
+                logger.warning("⚠️ 旧索引没有记录调用者，调用层级需要重建索引 (--rebuild) 后才完整")
+        if version and version < 7:
+            logger.warning("⚠️ 旧索引没有记录引用的读/写/调用分类，按访问方式过滤需要重建索引 (--rebuild)")
+        if version and version < 8:
+            logger.warning("⚠️ 旧索引没有函数指针实现表，跳转到实现需要重建索引 (--rebuild)")
+        if version and version < 9:
+            logger.warning("⚠️ 旧索引没有结构体布局，查看布局需要重建索引 (--rebuild)")
+        if version and version < 10:
+            logger.warning("⚠️ 旧索引没有悬停信息，悬停提示需要重建索引 (--rebuild)")
+        if version and version < 11:
+            logger.warning("⚠️ 旧索引没有定义范围，大纲在重建索引 (--rebuild) 之前是平铺的")
+        if version and version < 12:
+            logger.warning("⚠️ 旧索引没有日志格式串，日志反查源码只能靠 [file:line] 前缀，完整功能需要重建索引 (--rebuild)")
+        if version != Database.SCHEMA_VERSION:
+            self.cursor.execute(f'PRAGMA user_version = {Database.SCHEMA_VERSION}')
+
+    @staticmethod
+    def rebuild_refcounts(cursor):
+        """从 refs 全量重算引用数 (升级旧库、UPDATE OR REPLACE 这类绕过触发器的批量改写之后)"""
+        cursor.execute('DELETE FROM refcounts')
+        cursor.execute(f'INSERT INTO refcounts (usr_id, refs) SELECT usr_id, COUNT(*) FROM refs WHERE {Database.counted_ref()} GROUP BY usr_id')
+
+    @staticmethod
+    def counted_ref(row=''):
+        """
+        计入引用数的 refs 行：函数 / 变量的前向声明 (头文件里的原型、extern) 也按引用入库，kind 是 DECL_xxx，不算使用，
+        否则头文件里声明过的函数永远不会是零引用。row 为触发器里的 NEW. / OLD. 前缀
+        """
+        return f"{row}kind NOT GLOB 'DECL_*'"
+
+    @staticmethod
+    def rebuild_call_edges(cursor):
+        """从 refs 全量重算调用图的边 (同 rebuild_refcounts)"""
+        cursor.execute('DELETE FROM calls')
+        cursor.execute('''
+            INSERT INTO calls (caller_id, callee_id, sites)
+            SELECT caller_id, usr_id, COUNT(*) FROM refs WHERE caller_id IS NOT NULL GROUP BY caller_id, usr_id
+        ''')
+
+    @staticmethod
+    def remap_path_prefix(cursor, old, new):
+        """
+        把库里所有以 old 开头的路径替换成 new 开头 (全部在 SQL 里完成，不逐行搬运)。
+        只在路径分隔处匹配：重映射 /build/out 不会改到 /build/outer/...
+        """
+        n = len(old)
+        bounded = int(old.endswith('/'))  # old 自带结尾的 '/' 时前缀匹配本身就落在分隔处
+        for table, column in (
+            ('defs', 'file_path'),
+            ('refs', 'file_path'),
+            ('includes', 'source_file'),
+            ('includes', 'included_file'),
+            ('impls', 'file_path'),
+            ('layouts', 'file_path'),
+            ('hovers', 'file_path'),
+            ('extents', 'file_path'),
+            ('logfmts', 'file_path'),
+            ('files', 'file_path'),
+        ):
+            cursor.execute(f'''
+                UPDATE OR REPLACE {table} SET {column} = ? || substr({column}, ?)
+                WHERE substr({column}, 1, ?) = ? AND (? OR length({column}) = ? OR substr({column}, ?, 1) = '/')
+            ''', (new, n + 1, n, old, bounded, n, n + 1))
+        # 宏的 USR: c:<path>@NAME，路径变了 ID 也跟着变，def/ref 行要改挂到新 ID 下
+        cursor.connection.create_function("usr_id", 1, Database.usr_id, deterministic=True)
+        cursor.execute('DROP TABLE IF EXISTS temp.remapped_usrs')
+        cursor.execute('''
+            CREATE TEMP TABLE remapped_usrs AS
+            SELECT id AS old_id, usr_id(new_usr) AS new_id, new_usr FROM (
+                SELECT id, 'c:' || ? || substr(usr, ?) AS new_usr FROM usrs
+                WHERE substr(usr, 1, ?) = 'c:' || ? AND (? OR substr(usr, ?, 1) IN ('/', '@'))
+            )
+        ''', (new, n + 3, n + 2, old, bounded, n + 3))
+        for table in ('defs', 'refs', 'layouts', 'hovers', 'extents', 'logfmts'):
+            cursor.execute(f'''
+                UPDATE OR REPLACE {table} SET usr_id = (SELECT new_id FROM remapped_usrs WHERE old_id = usr_id)
+                WHERE usr_id IN (SELECT old_id FROM remapped_usrs)
+            ''')
+        cursor.execute('''
+            UPDATE refs SET caller_id = (SELECT new_id FROM remapped_usrs WHERE old_id = caller_id)
+            WHERE caller_id IN (SELECT old_id FROM remapped_usrs)
+        ''')
+        cursor.execute('DELETE FROM usrs WHERE id IN (SELECT old_id FROM remapped_usrs)')
+        cursor.execute('INSERT OR IGNORE INTO usrs (id, usr) SELECT new_id, new_usr FROM remapped_usrs')
+        cursor.execute('DROP TABLE temp.remapped_usrs')
+        # OR REPLACE 删掉的冲突行不触发 DELETE 触发器，这里整体重算一次
+        Database.rebuild_refcounts(cursor)
+        Database.rebuild_call_edges(cursor)
+
     def load_commands_map(self):
         """加载 compile_commands.json, 返回 dict: { absolute_file_path -> dict }"""
         cc_path = os.path.join(self.workspace_dir, "compile_commands.json")
@@ -165,66 +850,434 @@ class Database:
     @with_retry()
     def update_file_status(self, file_path, mtime, status, commit=True):
         """更新文件状态：indexing, completed, failed"""
-        self.cursor.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (file_path, mtime, status))
+        self.cursor.execute('INSERT OR REPLACE INTO files (file_path, mtime, md5) VALUES (?, ?, ?)',
+                            (Database.to_db_path(file_path), mtime, status))
         if commit:
             self.conn.commit()
 
     @with_retry()
     def prepare_file_reindex(self, file_path):
-        """增量第一步：抹除该文件旧的物理位置记录"""
-        self.cursor.execute('DELETE FROM symbols WHERE file_path = ?', (file_path,))
+        """增量第一步：让该文件在下一轮被重新解析；旧符号保留，由 save_stored_result 做行级差分"""
+        self.cursor.execute('UPDATE files SET md5 = NULL WHERE file_path = ?', (Database.to_db_path(file_path),))
         self.conn.commit()
 
+    @staticmethod
+    def to_stored_rows(symbols, includes):
+        """解析结果里都是绝对路径，入库 (以及进解析缓存) 前统一转换成库内路径"""
+        to_db_path = Database.to_db_path
+        stored = []
+        for f, sl, sc, el, ec, usr, role, name, kind, *extra in symbols:
+            if extra and extra[0] and role not in Database.TEXT_ROLES:
+                extra = [Database.to_db_usr(extra[0], role)] + extra[1:]  # context 同样是 USR
+            stored.append((to_db_path(f), sl, sc, el, ec, Database.to_db_usr(usr, role), role, name, kind, *extra))
+        includes = [(to_db_path(src), to_db_path(inc)) for src, inc in includes]
+        return stored, includes
+
+    def save_parse_result(self, source_file, source_md5, symbols, includes, phase=None):
+        symbols, includes = Database.to_stored_rows(symbols, includes)
+        self.save_stored_result(source_file, source_md5, symbols, includes, phase)
+
     @with_retry()
-    def save_parse_result(self, source_file, source_md5, symbols, includes):
+    def save_stored_result(self, source_file, source_md5, symbols, includes, phase=None):
+        """symbols / includes 已经是库内路径形式"""
+        phase = phase or Database.PHASE_FULL
+        db_source = Database.to_db_path(source_file)
+
+        # 两阶段索引时定义阶段可能晚于完整阶段完成 (打开的文件被提前)，不能用少的结果覆盖多的
+        if phase < Database.PHASE_FULL:
+            self.cursor.execute('SELECT md5, phase FROM files WHERE file_path = ?', (db_source,))
+            row = self.cursor.fetchone()
+            if row and row[0] == source_md5 and (row[1] or 0) >= phase:
+                return
+
         # 1. 保存主文件 MD5
         mtime = os.path.getmtime(source_file)
-        self.cursor.execute('INSERT OR REPLACE INTO files (file_path, md5, mtime) VALUES (?, ?, ?)', 
-                            (source_file, source_md5, mtime))
+        self.cursor.execute('INSERT OR REPLACE INTO files (file_path, md5, mtime, phase) VALUES (?, ?, ?, ?)', 
+                            (db_source, source_md5, mtime, phase))
         
-        # 2. 刷新依赖并顺手算头文件的 MD5
-        self.cursor.execute('DELETE FROM includes WHERE source_file = ?', (source_file,))
-        if includes:
-            self.cursor.executemany('INSERT OR IGNORE INTO includes (source_file, included_file) VALUES (?, ?)', includes)
-            for _, included_file in includes:
-                if os.path.exists(included_file):
-                    inc_md5 = self.get_file_md5(included_file)
-                    self.cursor.execute('INSERT OR REPLACE INTO files (file_path, md5) VALUES (?, ?)', 
-                                        (included_file, inc_md5))
-
-        # 3. 清除主文件旧符号，插入新符号
-        self.cursor.execute('DELETE FROM symbols WHERE file_path = ?', (source_file,))
-        if symbols:
-            self.cursor.executemany('INSERT OR IGNORE INTO symbols VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', symbols)
+        # 2. 顺手算头文件的 MD5 (包含关系本身就是 inc 行，随下面的符号一起写入 includes 表)
+        for _, included_file in includes:
+            inc_md5 = Database.cached_file_md5(Database.from_db_path(included_file))
+            if inc_md5:
+                self.cursor.execute('INSERT OR REPLACE INTO files (file_path, md5) VALUES (?, ?)', 
+                                    (included_file, inc_md5))
+
+        # 3. 主文件符号做行级差分，只写真正变化的行；头文件里的符号沿用原来的 INSERT OR IGNORE
+        own_rows = [r for r in symbols if r[0] == db_source]
+        other_rows = [r for r in symbols if r[0] != db_source]
+        deletes, shifts, inserts = Database.diff_symbol_rows(self.file_symbol_rows(db_source), own_rows)
+        try:
+            self.delete_symbol_rows(deletes)
+            self.shift_symbol_rows(shifts)
+        except sqlite3.IntegrityError:
+            # 平移顺序仍撞上主键 (同位置同 USR 的重复行) 时退回整文件重写
+            self.delete_file_rows(db_source)
+            inserts = own_rows
+        self.insert_symbol_rows(inserts + other_rows)
+        logger.debug(f"📝 {db_source}: 新增 {len(inserts)} 行, 删除 {len(deletes)} 行, 平移 {len(shifts)} 行")
 
         self.conn.commit()
 
+    # 库内的一行统一是 (file_path, s_line, s_col, e_line, e_col, usr, role, name, kind[, context[, access]])，按 role 落到不同的表。
+    # context 是关联的另一个 USR：ref 行为所在函数 (只有函数体里的函数引用才有)，impl 行为被赋值的函数指针成员；
+    # layout / hover 行 (BLOB_ROLES) 的 context 不是 USR，而是结构体布局 / 悬停信息的 JSON 文本，入库时压缩；
+    # log 行的 context 是 printk 的格式串，原样存 (TEXT_ROLES 的 context 都不是 USR)；
+    # access 是 ref 的访问方式；旧的解析缓存 / 分片里没有这两列
+    # extent 行的位置是定义的完整范围 (函数头到右花括号)，名字的位置仍在 def 行里
+    ROLE_TABLES = {'def': 'defs', 'ref': 'refs', 'inc': 'includes', 'impl': 'impls', 'layout': 'layouts', 'hover': 'hovers',
+                   'extent': 'extents', 'log': 'logfmts'}
+    BLOB_ROLES = ('layout', 'hover')
+    TEXT_ROLES = BLOB_ROLES + ('log',)
+    # 三张表都用 (符号/头文件, 文件, 起止位置) 定位一行，refs 的主键里还有访问方式
+    ROW_KEYS = {
+        'defs': 'usr_id = ? AND file_path = ? AND s_line = ? AND s_col = ? AND e_line = ? AND e_col = ?',
+        'refs': 'usr_id = ? AND access = ? AND file_path = ? AND s_line = ? AND s_col = ? AND e_line = ? AND e_col = ?',
+        'includes': 'included_file = ? AND source_file = ? AND s_line = ? AND s_col = ? AND e_line = ? AND e_col = ?',
+        'layouts': 'usr_id = ? AND file_path = ? AND s_line = ? AND s_col = ? AND e_line = ? AND e_col = ?',
+        'extents': 'usr_id = ? AND file_path = ? AND s_line = ? AND s_col = ? AND e_line = ? AND e_col = ?',
+        'logfmts': 'usr_id = ? AND file_path = ? AND s_line = ? AND s_col = ? AND e_line = ? AND e_col = ?',
+        'hovers': 'usr_id = ? AND file_path = ? AND s_line = ? AND s_col = ? AND e_line = ? AND e_col = ?',
+        'impls': 'field_id = ? AND func_id = ? AND file_path = ? AND s_line = ? AND s_col = ? AND e_line = ? AND e_col = ?',
+    }
+
+    @staticmethod
+    def row_context(row):
+        return row[9] if len(row) > 9 else None
+
+    @staticmethod
+    def row_access(row):
+        return row[10] if len(row) > 10 else 0
+
+    @staticmethod
+    def _group_by_table(rows):
+        """按角色拆成各表的列顺序：{表名: [行]}"""
+        tables = {}
+        for row in rows:
+            f, sl, sc, el, ec, usr, role, name, kind = row[:9]
+            table = Database.ROLE_TABLES[role]
+            if table == 'includes':
+                tables.setdefault(table, []).append((f, usr, sl, sc, el, ec, name))
+            elif table == 'impls':
+                tables.setdefault(table, []).append((Database.usr_id(Database.row_context(row)), Database.usr_id(usr),
+                                                     f, sl, sc, el, ec, name))
+            elif table == 'extents':
+                tables.setdefault(table, []).append((Database.usr_id(usr), f, sl, sc, el, ec, name))
+            elif table == 'logfmts':
+                tables.setdefault(table, []).append((Database.usr_id(usr), f, sl, sc, el, ec, name, Database.row_context(row)))
+            elif role in Database.BLOB_ROLES:
+                tables.setdefault(table, []).append((Database.usr_id(usr), f, sl, sc, el, ec, name,
+                                                     Database.pack_blob(Database.row_context(row))))
+            elif table == 'refs':
+                caller = Database.row_context(row)
+                tables.setdefault(table, []).append((Database.usr_id(usr), f, sl, sc, el, ec, name, kind,
+                                                     Database.usr_id(caller) if caller else None,
+                                                     Database.row_access(row)))
+            else:
+                tables.setdefault(table, []).append((Database.usr_id(usr), f, sl, sc, el, ec, name, kind))
+        return tables
+
+    @staticmethod
+    def _row_key(table, row):
+        if table == 'includes':
+            return (row[1], row[0]) + row[2:6]
+        if table == 'refs':
+            return (row[0], row[9]) + row[1:6]
+        if table == 'impls':
+            return row[:7]
+        return row[:6]
+
+    def insert_symbol_rows(self, rows):
+        collided = self.register_usrs({r[5] for r in rows if r[6] != 'inc'} |
+                                      {Database.row_context(r) for r in rows if r[6] not in Database.TEXT_ROLES and Database.row_context(r)})
+        if collided:
+            rows = Database.drop_collided_rows(rows, collided)
+        if not rows:
+            return
+        for table, values in Database._group_by_table(rows).items():
+            placeholders = ', '.join('?' * len(values[0]))
+            self.cursor.executemany(f'INSERT OR IGNORE INTO {table} VALUES ({placeholders})', values)
+
+    def delete_symbol_rows(self, rows):
+        for table, values in Database._group_by_table(rows).items():
+            self.cursor.executemany(f'DELETE FROM {table} WHERE {Database.ROW_KEYS[table]}',
+                                    [Database._row_key(table, v) for v in values])
+
+    def shift_symbol_rows(self, shifts):
+        """shifts: [(新 s_line, 新 e_line, 旧行)]，按给定顺序逐行执行"""
+        for s_line, e_line, row in shifts:
+            table = Database.ROLE_TABLES[row[6]]
+            (values,) = Database._group_by_table([row])[table]
+            self.cursor.execute(f'UPDATE {table} SET s_line = ?, e_line = ? WHERE {Database.ROW_KEYS[table]}',
+                                (s_line, e_line) + Database._row_key(table, values))
+
+    def register_usrs(self, usrs):
+        """
+        登记 ID -> USR 对照表，并检查 64 位哈希碰撞。返回碰撞落败的 USR 集合 (和已登记或同批先登记的 USR 哈希相同)：
+        它们的行不能入库，否则会悄悄记到别的符号名下，定义和引用都会串
+        """
+        ids, collided = {}, set()
+        for usr in sorted(usrs):
+            sid = Database.usr_id(usr)
+            if sid in ids:
+                logger.error(f"❌ 符号 ID 碰撞: {usr} 与 {ids[sid]} 的哈希相同 ({sid})，跳过 {usr}")
+                collided.add(usr)
+            else:
+                ids[sid] = usr
+        if not ids:
+            return collided
+        self.cursor.executemany('INSERT OR IGNORE INTO usrs (id, usr) VALUES (?, ?)', ids.items())
+        self.cursor.execute('SELECT id, usr FROM usrs WHERE id IN (SELECT value FROM json_each(?))', (json.dumps(list(ids)),))
+        for sid, stored in self.cursor.fetchall():
+            if stored != ids[sid]:
+                logger.error(f"❌ 符号 ID 碰撞: {ids[sid]} 与 {stored} 的哈希相同 ({sid})，跳过 {ids[sid]}")
+                collided.add(ids[sid])
+        return collided
+
+    @staticmethod
+    def drop_collided_rows(rows, collided):
+        """去掉符号 ID 碰撞落败的行；只是所在函数碰撞的 ref 行保留，不记调用者，成员碰撞的 impl 行整行去掉"""
+        kept = []
+        for row in rows:
+            if row[6] != 'inc' and row[5] in collided:
+                continue
+            if row[6] not in Database.TEXT_ROLES and Database.row_context(row) in collided:
+                if row[6] != 'ref':
+                    continue
+                row = row[:9] + (None,) + tuple(row[10:])
+            kept.append(row)
+        return kept
+
+    def delete_file_rows(self, db_path):
+        """删除某个文件里的全部 def/ref/inc 行"""
+        self.cursor.execute('DELETE FROM defs WHERE file_path = ?', (db_path,))
+        self.cursor.execute('DELETE FROM refs WHERE file_path = ?', (db_path,))
+        self.cursor.execute('DELETE FROM includes WHERE source_file = ?', (db_path,))
+        self.cursor.execute('DELETE FROM impls WHERE file_path = ?', (db_path,))
+        self.cursor.execute('DELETE FROM layouts WHERE file_path = ?', (db_path,))
+        self.cursor.execute('DELETE FROM hovers WHERE file_path = ?', (db_path,))
+        self.cursor.execute('DELETE FROM extents WHERE file_path = ?', (db_path,))
+        self.cursor.execute('DELETE FROM logfmts WHERE file_path = ?', (db_path,))
+
+    def file_symbol_rows(self, db_path):
+        """某个文件里的全部 def/ref/inc 行，统一成库内行格式"""
+        self.cursor.execute('''
+            SELECT file_path, s_line, s_col, e_line, e_col, usr, 'def', name, kind, NULL, 0 FROM defs JOIN usrs ON id = usr_id
+            WHERE file_path = ?
+            UNION ALL
+            SELECT file_path, s_line, s_col, e_line, e_col, u.usr, 'ref', name, kind, c.usr, access FROM refs
+            JOIN usrs u ON u.id = usr_id LEFT JOIN usrs c ON c.id = caller_id
+            WHERE file_path = ?
+            UNION ALL
+            SELECT source_file, s_line, s_col, e_line, e_col, included_file, 'inc', name, 'inc', NULL, 0 FROM includes WHERE source_file = ?
+            UNION ALL
+            SELECT file_path, s_line, s_col, e_line, e_col, fn.usr, 'impl', name, 'IMPL', fld.usr, 0 FROM impls
+            JOIN usrs fn ON fn.id = func_id JOIN usrs fld ON fld.id = field_id
+            WHERE file_path = ?
+            UNION ALL
+            SELECT file_path, s_line, s_col, e_line, e_col, usr, 'layout', name, 'LAYOUT', unpack_blob(data), 0 FROM layouts
+            JOIN usrs ON id = usr_id
+            WHERE file_path = ?
+            UNION ALL
+            SELECT file_path, s_line, s_col, e_line, e_col, usr, 'hover', name, 'HOVER', unpack_blob(data), 0 FROM hovers
+            JOIN usrs ON id = usr_id
+            WHERE file_path = ?
+            UNION ALL
+            SELECT file_path, s_line, s_col, e_line, e_col, usr, 'extent', name, 'EXTENT', NULL, 0 FROM extents
+            JOIN usrs ON id = usr_id
+            WHERE file_path = ?
+            UNION ALL
+            SELECT file_path, s_line, s_col, e_line, e_col, usr, 'log', name, 'LOGFMT', fmt, 0 FROM logfmts
+            JOIN usrs ON id = usr_id
+            WHERE file_path = ?
+        ''', (db_path,) * 8)
+        return self.cursor.fetchall()
+
+    @staticmethod
+    def diff_symbol_rows(old_rows, new_rows):
+        """
+        对比同一文件入库的旧行和新解析的行，返回 (要删除的旧行, 平移 [(s_line, e_line, 旧行)], 要插入的行)。
+        稳定键不含行号：(usr, role, name, kind, 起止列, 跨越行数)，同键的行按行号顺序一一配对，
+        这样在文件中间插几行时，后面的符号只是平移而不是删了重插。
+        """
+        def stable_key(r):
+            _, sl, sc, el, ec, usr, role, name, kind = r[:9]
+            # 调用挪到了另一个函数里 (所在函数改名)、读改成了写都不能当作平移，context / access 也算进稳定键
+            return (usr, role, name, kind, sc, ec, el - sl, Database.row_context(r), Database.row_access(r))
+
+        old_groups = {}
+        for r in sorted(old_rows, key=lambda r: r[1]):
+            old_groups.setdefault(stable_key(r), []).append(r)
+        # 与 INSERT OR IGNORE 的语义保持一致：同一角色同一位置同一 USR (同一访问方式) 只保留先出现的那行
+        unique_rows = {}
+        for r in new_rows:
+            unique_rows.setdefault(r[:7] + (Database.row_access(r),), r)
+        new_groups = {}
+        for r in sorted(unique_rows.values(), key=lambda r: r[1]):
+            new_groups.setdefault(stable_key(r), []).append(r)
+
+        deletes, shifts, inserts = [], [], []
+        for key, olds in old_groups.items():
+            news = new_groups.pop(key, [])
+            for old, new in zip(olds, news):
+                if old[1] != new[1]:
+                    shifts.append((new[1], new[3], old))
+            deletes.extend(olds[len(news):])
+            inserts.extend(news[len(olds):])
+        for news in new_groups.values():
+            inserts.extend(news)
+
+        # 同键的行配对时保持顺序，下移的从下往上改、上移的从上往下改，避免中途撞上还没挪走的行
+        down = sorted((s for s in shifts if s[0] > s[2][1]), key=lambda s: -s[2][1])
+        up = sorted((s for s in shifts if s[0] < s[2][1]), key=lambda s: s[2][1])
+        return deletes, down + up, inserts
+
+    def load_stored_file(self, db_path, md5, phase, symbols):
+        """回放快照仓库里的一个文件 (库内路径形式，inc 行即包含关系)，由调用方统一提交"""
+        # 源文件带 mtime (collect_index_tasks 据此判断是否需要重建)，头文件只记 md5
+        mtime = os.path.getmtime(Database.from_db_path(db_path)) if phase else None
+        self.cursor.execute('INSERT OR REPLACE INTO files (file_path, md5, mtime, phase) VALUES (?, ?, ?, ?)',
+                            (db_path, md5, mtime, phase))
+        self.delete_file_rows(db_path)
+        self.insert_symbol_rows(symbols)
+
     # --- LSP 查询接口 (全部升级为单表查询) ---
     def get_sources_including(self, included_file):
         """查询依赖了指定头文件的所有源文件"""
-        self.cursor.execute('SELECT DISTINCT file_path FROM symbols WHERE role = "inc" AND usr = ?', (included_file,))
-        return [row[0] for row in self.cursor.fetchall()]
+        self.cursor.execute('SELECT DISTINCT source_file FROM includes WHERE included_file = ?',
+                            (Database.to_db_path(included_file),))
+        return [Database.from_db_path(row[0]) for row in self.cursor.fetchall()]
+
+    # 大纲收录的定义种类 (去掉 DEF_ 前缀后的 DeclKindName)，没有定义范围的旧库靠它排除参数、标号这些
+    OUTLINE_DECL_KINDS = {"Function", "CXXMethod", "CXXConstructor", "CXXDestructor", "CXXConversion", "FunctionTemplate",
+                          "Var", "Field", "IndirectField", "Record", "CXXRecord", "ClassTemplate", "Enum", "EnumConstant",
+                          "Typedef", "TypeAlias", "Namespace"}
 
     def lsp_document_symbols_db(self, file_path):
-        #mytodo bug需要修复，获取符号表
+        """
+        大纲：[(name, kind, 范围, 名字范围, 子节点)]，范围都是 (s_line, s_col, e_line, e_col)。
+        范围取索引时记下的真实定义范围，按 (起点, 终点倒序) 排好后一遍栈扫描就能套出嵌套关系；按索引时的 md5 缓存。
+        """
         logger.info(f"👉 获取符号表: {file_path}")
-        self.cursor.execute('''
-            SELECT name, kind, s_line, s_col, e_line, e_col 
-            FROM symbols
-            WHERE file_path = ? AND role = 'def' ORDER BY s_line ASC
-        ''', (file_path,))
-        ret = self.cursor.fetchall()
-        return ret
+        return self._cached_by_file("outline", file_path, self._build_outline)[1]
+
+    def _build_outline(self, db_path):
+        self.cursor.execute('SELECT usr_id, s_line, s_col, e_line, e_col FROM extents WHERE file_path = ?', (db_path,))
+        extents = {}
+        for sid, *rng in self.cursor.fetchall():
+            extents.setdefault(sid, []).append(tuple(rng))
+        self.cursor.execute('SELECT usr_id, name, kind, s_line, s_col, e_line, e_col FROM defs WHERE file_path = ?', (db_path,))
+
+        nodes = []
+        for sid, name, kind, *sel in self.cursor.fetchall():
+            sel = tuple(sel)
+            # 同一个符号在一个文件里可能有多个范围 (#ifdef 两个分支各定义一次)，取包含名字的那个
+            rng = next((r for r in extents.get(sid, ()) if r[:2] <= sel[:2] and sel[2:] <= r[2:]), None)
+            if rng is None:
+                if extents or not (kind.startswith("MACRO") or kind.partition("_")[2] in Database.OUTLINE_DECL_KINDS):
+                    continue  # 有范围表时，没有范围的定义就是局部变量、参数这些
+                rng = sel
+            nodes.append((name, kind, rng, sel, []))
+
+        roots, stack = [], []
+        for node in sorted(nodes, key=lambda n: (n[2][:2], (-n[2][2], -n[2][3]))):
+            rng = node[2]
+            while stack and not (stack[-1][2][:2] <= rng[:2] and rng[2:] <= stack[-1][2][2:]):
+                stack.pop()
+            (stack[-1][4] if stack else roots).append(node)
+            stack.append(node)
+        return roots
+
+    FILE_CACHE_SIZE = 256  # 按文件缓存的大纲 / 语义着色结果个数
+
+    def _cached_by_file(self, purpose, file_path, build):
+        """
+        按 (文件, 索引时的 md5) 缓存从索引行算出来的整文件结果：文件重新索引后 md5 变了自然失效，
+        内容没变的文件从不重算。返回 (md5, 结果)，文件还没入库 (或正在重新索引) 时 md5 为 None 且不缓存。
+        """
+        db_path = Database.to_db_path(file_path)
+        self.cursor.execute('SELECT md5 FROM files WHERE file_path = ?', (db_path,))
+        row = self.cursor.fetchone()
+        md5 = row[0] if row else None
+        key = (purpose, db_path)
+        hit = self._file_cache.get(key)
+        if md5 and hit and hit[0] == md5:
+            self._file_cache.move_to_end(key)
+            return md5, hit[1]
+        value = build(db_path)
+        if md5:
+            self._file_cache[key] = (md5, value)
+            while len(self._file_cache) > Database.FILE_CACHE_SIZE:
+                self._file_cache.popitem(last=False)
+        return md5, value
+
+    # 语义着色的图例 (LSP SemanticTokensLegend)，列表下标就是编码里的 tokenType / 修饰位
+    SEMANTIC_TOKEN_TYPES = ["namespace", "type", "class", "enum", "struct", "typeParameter", "parameter", "variable",
+                            "property", "enumMember", "function", "method", "macro", "label"]
+    SEMANTIC_TOKEN_MODIFIERS = ["declaration", "definition", "modification"]
+    # PyClangd-Core 输出的 kind 去掉 DEF_ / REF_ / DECL_ 前缀后是 clang 的 DeclKindName
+    DECL_TOKEN_TYPES = {
+        "Namespace": "namespace", "Typedef": "type", "TypeAlias": "type", "CXXRecord": "class", "ClassTemplate": "class",
+        "Enum": "enum", "Record": "struct", "TemplateTypeParm": "typeParameter", "ParmVar": "parameter", "Var": "variable",
+        "Field": "property", "IndirectField": "property", "EnumConstant": "enumMember", "Function": "function",
+        "FunctionTemplate": "function", "CXXMethod": "method", "CXXConstructor": "method", "CXXDestructor": "method",
+        "CXXConversion": "method", "Label": "label",
+    }
+
+    @staticmethod
+    def encode_semantic_tokens(rows):
+        """
+        rows: [(s_line, s_col, e_col, kind, 是否定义, access)]，已按位置排好序 (同位置定义在前)。
+        编码成 LSP 的整数数组：每个记号 5 个数 (行差, 列差, 长度, 类型, 修饰位)，行列转成 0 起始。
+        """
+        types = {t: i for i, t in enumerate(Database.SEMANTIC_TOKEN_TYPES)}
+        declaration, definition, modification = (1 << i for i in range(len(Database.SEMANTIC_TOKEN_MODIFIERS)))
+        data = []
+        prev_line = prev_col = 0
+        last = None
+        for line, col, e_col, kind, is_def, access in rows:
+            if (line, col) == last or e_col <= col:
+                continue  # 同一位置只着一次色 (定义优先)
+            token_type = "macro" if kind.startswith("MACRO") else Database.DECL_TOKEN_TYPES.get(kind.partition("_")[2])
+            if token_type is None:
+                continue
+            if is_def:
+                modifiers = definition
+            elif kind.startswith("DECL_"):
+                modifiers = declaration  # 前向声明 (头文件里的原型、extern)
+            elif access & Database.ACCESS_WRITE:
+                modifiers = modification
+            else:
+                modifiers = 0
+            line0, col0 = line - 1, col - 1
+            data += [line0 - prev_line, col0 - prev_col if line0 == prev_line else col0, e_col - col,
+                     types[token_type], modifiers]
+            prev_line, prev_col, last = line0, col0, (line, col)
+        return data
+
+    def semantic_tokens_db(self, file_path):
+        """整个文件的语义着色 (LSP 整数数组)，直接由该文件的 def / ref 行编码，按索引时的 md5 缓存。返回 (md5, data)"""
+        def build(db_path):
+            self.cursor.execute('''
+                SELECT s_line, s_col, e_col, kind, 1, 0 FROM defs WHERE file_path = :f AND s_line = e_line
+                UNION ALL
+                SELECT s_line, s_col, e_col, kind, 0, access FROM refs WHERE file_path = :f
+                ORDER BY 1, 2, 5 DESC
+            ''', {"f": db_path})
+            return Database.encode_semantic_tokens(self.cursor.fetchall())
+        return self._cached_by_file("semantic_tokens", file_path, build)
 
     def lsp_workspace_symbols_db(self, query):
     # 全局搜索关键字
         logger.info(f"👉 全局搜索CTRL+T: {query}")
+        # 排序：名字完全相同 > 前缀匹配 > 引用多的 (常用的内核函数排在前面)
         self.cursor.execute('''
             SELECT name, file_path, s_line, s_col, usr 
-            FROM symbols
-            WHERE name LIKE ? AND role = 'def' LIMIT 100
-        ''', (f"%{query}%",))
-        ret = self.cursor.fetchall()
+            FROM defs JOIN usrs ON id = defs.usr_id LEFT JOIN refcounts rc ON rc.usr_id = defs.usr_id
+            WHERE name LIKE :pattern
+            ORDER BY name = :query DESC, name LIKE :prefix DESC, COALESCE(rc.refs, 0) DESC
+            LIMIT 100
+        ''', {"pattern": f"%{query}%", "query": query, "prefix": f"{query}%"})
+        ret = [(n, Database.from_db_path(fp), sl, sc, usr) for n, fp, sl, sc, usr in self.cursor.fetchall()]
         self.show_res(ret)
         return ret
 
@@ -298,6 +1351,13 @@ class Database:
         res = self.get_usr_at_location(file_path, line, col)
         logger.info(f"查询usr结果: {res}")
 
+        if not res and self.is_log_file(file_path):
+            # 日志文件 (dmesg 之类)：整行反查打印它的 printk 调用点
+            ret = self.log_line_definition_db(file_path, line)
+            if ret:
+                self.show_res(ret)
+                return ret
+
         if not res:
             logger.info(f"❌查找usr失败，添加字符串查找来兜底")
             # 添加字符串查找来兜底
@@ -313,15 +1373,15 @@ class Database:
         if role == 'inc':
             logger.info(f"✅ 找到头文件: {target_str}")
             # 头文件路径直接就存在了 target_str 中
-            return [(target_str, 1, 1, 1, 1)]
+            return [(Database.from_db_path(target_str), 1, 1, 1, 1)]
         elif role in ('ref', 'def'):
             # 无论是引用处按 F12，还是定义处自己按 F12，统统拿着 USR 去找它的 def 记录
             self.cursor.execute('''
                 SELECT file_path, s_line, s_col, e_line, e_col 
-                FROM symbols
-                WHERE usr = ? AND role = 'def'
+                FROM defs
+                WHERE usr_id = ?
             ''', (target_str,))
-            res = self.cursor.fetchall()
+            res = Database.abs_rows(self.cursor.fetchall())
             if res:
                 logger.info(f"✅ 查找定义结果: 找到 {len(res)} 个定义")
                 self.show_res(res)
@@ -332,14 +1392,59 @@ class Database:
 
         return []
 
-    def lsp_references_db(self, file_path, line, col):
+    def lsp_implementation_db(self, file_path, line, col):
+        """
+        跳转到实现：光标在函数指针成员上 (.open = / ops->open(...) 都行)，返回所有填进这个成员的函数的定义。
+        impls 按成员聚簇，整棵树的实现是一次主键前缀查找；没有定义的函数 (外部模块里的) 退回到赋值处。
+        """
+        logger.info(f"👉 跳转到实现: {file_path}:{line}:{col}")
+        ret = self.get_usr_at_location(file_path, line, col)
+        if not ret or ret[0] == 'inc':
+            return []
+        self.cursor.execute('''
+            SELECT DISTINCT d.file_path, d.s_line, d.s_col, d.e_line, d.e_col
+            FROM impls i JOIN defs d ON d.usr_id = i.func_id
+            WHERE i.field_id = :id
+            UNION
+            SELECT i.file_path, i.s_line, i.s_col, i.e_line, i.e_col FROM impls i
+            WHERE i.field_id = :id AND NOT EXISTS (SELECT 1 FROM defs d WHERE d.usr_id = i.func_id)
+        ''', {"id": ret[1]})
+        res = Database.abs_rows(self.cursor.fetchall())
+        logger.info(f"✅ 找到 {len(res)} 个实现")
+        return res
+
+    def lsp_hover_db(self, file_path, line, col):
+        """
+        悬停：光标处符号的 (签名, 文档注释, 结构体大小/对齐)，没有悬停信息时返回 None。
+        签名和注释在索引时就打印好了，这里与查定义一样只是按符号 ID 的主键读取；结构体顺带带上布局表里的大小。
+        """
+        ret = self.get_usr_at_location(file_path, line, col)
+        if not ret or ret[0] == 'inc':
+            return None
+        self.cursor.execute('''
+            SELECT unpack_blob(data), (SELECT unpack_blob(data) FROM layouts WHERE usr_id = :id LIMIT 1)
+            FROM hovers WHERE usr_id = :id LIMIT 1
+        ''', {"id": ret[1]})
+        row = self.cursor.fetchone()
+        if not row:
+            return None
+        hover = json.loads(row[0])
+        size = None
+        if row[1]:
+            layout = json.loads(row[1])
+            size = (layout["size"], layout["align"])
+        return hover.get("sig", ""), hover.get("doc"), size
+
+    def lsp_references_db(self, file_path, line, col, access=None):
         # mymark 获取变量引用
-        """查引用核心逻辑"""
+        """查引用核心逻辑，access 为访问方式过滤 (见 ACCESS_FILTERS)，例如 ["write"] 只找写入处"""
         logger.info(f"👉 查找引用: {file_path}:{line}:{col}")
         usr = self.get_usr_at_location(file_path, line, col)
         if usr:
             logger.info(f"找到引用usr={usr}")
-            res = self.get_references_by_usr(usr[1])
+            if not self.references_complete():
+                logger.warning("⚠️ 引用索引尚未完成，结果可能不完整")
+            res = self.get_references_by_id(usr[1], access)
             if res:
                 logger.info(f"✅ 查找引用结果: 找到 {len(res)} 个引用")
                 self.show_res(res)
@@ -353,7 +1458,8 @@ class Database:
     def lsp_did_save_db(self, file_path):
         # 计算文件md5值
         current_md5 = self.get_file_md5(file_path)
-        self.cursor.execute('SELECT md5 FROM files WHERE file_path = ?', (file_path,))
+        stored_path = Database.to_db_path(file_path)
+        self.cursor.execute('SELECT md5 FROM files WHERE file_path = ?', (stored_path,))
         res = self.cursor.fetchone()
         
         if res and res[0] == current_md5:
@@ -363,15 +1469,16 @@ class Database:
         logger.info(f"开始增量分析并更新: {file_path}")
 
         # 查出依赖库，检查变脏的头文件
-        self.cursor.execute('SELECT included_file FROM includes WHERE source_file = ?', (file_path,))
+        self.cursor.execute('SELECT included_file FROM includes WHERE source_file = ?', (stored_path,))
         dependencies = [row[0] for row in self.cursor.fetchall()]
 
         dirty_headers = []
         for inc_file in dependencies:
             logger.info(f"发现依赖文件: {inc_file}")
-            if not os.path.exists(inc_file): continue
+            inc_abs = Database.from_db_path(inc_file)
+            if not os.path.exists(inc_abs): continue
             
-            inc_current_md5 = self.get_file_md5(inc_file)
+            inc_current_md5 = self.get_file_md5(inc_abs)
             self.cursor.execute('SELECT md5 FROM files WHERE file_path = ?', (inc_file,))
             inc_old_md5_res = self.cursor.fetchone()
             
@@ -379,7 +1486,7 @@ class Database:
             if not inc_old_md5_res or inc_old_md5_res[0] != inc_current_md5:
                 dirty_headers.append(inc_file)
                 logger.info(f"删除头文件变脏的符号: {inc_file}")
-                self.cursor.execute('DELETE FROM symbols WHERE file_path = ?', (inc_file,))
+                self.delete_file_rows(inc_file)
         
         self.conn.commit()
         
@@ -401,68 +1508,411 @@ class Database:
         reindex_task()
         #threading.Thread(target=reindex_task, daemon=True).start()
 
-    def is_macro(self, usr):
-        """判断一个符号是否为宏"""
-        self.cursor.execute('SELECT kind FROM symbols WHERE usr = ?', (usr,))
+    def is_macro(self, sid):
+        """判断一个符号 (ID) 是否为宏"""
+        self.cursor.execute('SELECT kind FROM defs WHERE usr_id = ?', (sid,))
         res = self.cursor.fetchone()
-        return res and res[0] == 'MACRO_DEFINITION'
+        # MACRO_DEFINITION 是 libclang 时代的 kind
+        return bool(res) and res[0] in ('MACRO_DEF', 'MACRO_DEFINITION')
 
     def lsp_code_action_db(self, file_path, line, col):
-        # mymark lsp_code_action_db 目前只看是不是宏，这个功能基本是正常的！
         """查支持的 Code Action 操作 (目前只看是不是宏)"""
         ret = self.get_usr_at_location(file_path, line, col)
-        if ret and ret[1] and self.is_macro(ret[1]):
+        if ret and ret[0] != 'inc' and self.is_macro(ret[1]):
             return "expand_macro"
         return None
 
+    def expand_macro_line_db(self, file_path, line):
+        """
+        file_path 第 line 行起的宏调用展开后的代码，返回 (调用结束的行号, 展开文本)，失败返回 None。
+        按该文件 (头文件则取离它最近的、直接或间接包含它的源文件) 真实的编译命令预处理，
+        结果按编译单元和编译参数缓存，同一个文件里接着展开别的宏不会再跑一遍预处理。
+        """
+        file_path = os.path.realpath(file_path)
+        commands_map = self.commands_map or self.load_commands_map()
+        if file_path in commands_map:
+            tu = file_path
+        else:
+            tu = next(iter(self.nearest_including_units(file_path, 1, commands_map)), None)
+        if not tu:
+            logger.warning(f"❌ 没有找到可以用来预处理的编译命令: {file_path}")
+            return None
+        cmd_info = commands_map[tu]
+        source_file, compiler_args = Database.clean_compiler_args(cmd_info)
+        pp = Database._preprocess_cache.get(tu, cmd_info.get('directory', ''), compiler_args,
+                                            lambda: Database.preprocess_cpp(source_file, compiler_args),
+                                            Database.cached_file_md5)
+        if not pp:
+            return None
+        try:
+            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                end_line = invocation_end(f.readlines(), line)
+        except OSError:
+            end_line = line
+        text = pp.expansion(file_path, line, end_line)
+        return (end_line, text) if text is not None else None
+
+    def log_resolver(self):
+        """
+        整库的日志格式串索引 (见 log_resolver.py)，只在 logfmts 表的修改代数变了时重建。
+        [file:line] 前缀指向的调用点本身就在 logfmts 里，files 表在后台索引时的变化不影响结果，不参与判断
+        """
+        self.cursor.execute("SELECT value FROM generations WHERE name = 'logfmts'")
+        generation = self.cursor.fetchone()[0]
+        if not self._log_resolver or self._log_resolver[0] != generation:
+            start_time = time.time()
+            self.cursor.execute('SELECT file_path, s_line, s_col, fmt FROM logfmts')
+            rows = self.cursor.fetchall()
+            self.cursor.execute('SELECT file_path FROM files')
+            resolver = LogResolver(rows, [r[0] for r in self.cursor.fetchall()])
+            self._log_resolver = (generation, resolver)
+            logger.info(f"📜 日志格式串索引: {resolver.formats} 个格式串 ({time.time() - start_time:.2f}s)")
+        return self._log_resolver[1]
+
+    def resolve_log_lines_db(self, lines):
+        """批量反查日志行 (生成器)：每行产出 None 或 (方式, [(绝对路径, 行, 列, 格式串)])，方式见 LogResolver.resolve"""
+        from_db_path = functools.lru_cache(maxsize=4096)(Database.from_db_path)
+        for res in self.log_resolver().resolve_lines(lines):
+            yield res and (res[0], [(from_db_path(fp), sl, sc, fmt) for fp, sl, sc, fmt in res[1]])
+
+    def resolve_log_file_db(self, log_path, out):
+        """
+        整个日志文件批量反查，每个定位到的行往 out 写一行 "日志行号\t方式\t路径:行:列"
+        (同样可信的多个调用点用 ; 隔开)。返回 (总行数, 定位到的行数)
+        """
+        start_time = time.time()
+        total = resolved = 0
+        with open(log_path, 'r', encoding='utf-8', errors='replace') as f:
+            for total, res in enumerate(self.resolve_log_lines_db(f), 1):
+                if res:
+                    resolved += 1
+                    out.write(f"{total}\t{res[0]}\t" + ";".join(f"{fp}:{sl}:{sc}" for fp, sl, sc, _ in res[1]) + "\n")
+        logger.info(f"📜 {log_path}: {total} 行日志定位到 {resolved} 行 ({time.time() - start_time:.2f}s)")
+        return total, resolved
+
+    def is_indexed_file(self, file_path):
+        self.cursor.execute('SELECT 1 FROM files WHERE file_path = ?', (Database.to_db_path(file_path),))
+        return self.cursor.fetchone() is not None
+
+    # C/C++ 源码、头文件和汇编的扩展名，这类文件还没入库时也不会被当成日志
+    SOURCE_EXTENSIONS = ('.c', '.h', '.C', '.H', '.cc', '.hh', '.cpp', '.hpp', '.cxx', '.hxx', '.c++', '.h++', '.inl', '.ipp',
+                         '.tcc', '.s', '.S')
+
+    def is_log_file(self, file_path):
+        """没入库、不在编译数据库里、扩展名也不像源码的文件才当作日志"""
+        return not file_path.endswith(Database.SOURCE_EXTENSIONS) and file_path not in self.commands_map \
+            and not self.is_indexed_file(file_path)
+
+    def log_line_definition_db(self, file_path, line):
+        """日志文件里第 line 行 -> 打印它的调用点 [(绝对路径, 行, 列, 行, 列)]"""
+        try:
+            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                text = next(itertools.islice(f, line - 1, None), None)
+        except OSError:
+            return []
+        res = next(self.resolve_log_lines_db([text]), None) if text else None
+        if not res:
+            return []
+        logger.info(f"📜 日志行按{'前缀' if res[0] == 'location' else '格式串'}定位到 {len(res[1])} 处")
+        return [(fp, sl, sc, sl, sc) for fp, sl, sc, _ in res[1]]
+
     def get_usr_at_location(self, file_path, line, col):
-        """核心：查询特定坐标下的符号 USR (精准跳转的基础)"""
-        # 匹配逻辑：s_line == line 且 s_col <= col <= e_col
+        """核心：查询特定坐标下的符号 (精准跳转的基础)，返回 (role, 符号 ID)，#include 处返回 ('inc', 头文件库内路径)"""
+        # 匹配逻辑：s_line == line 且 s_col <= col <= e_col，三张表都走 (file_path, s_line, s_col) 索引
         # ⭐ 优化：优先匹配 role != 'def' (引用处)，并按宽度升序排列 (最精准的优先)
         self.cursor.execute('''
-            SELECT role, usr FROM symbols
-            WHERE file_path = ? AND s_line = ? AND s_col <= ? AND e_col >= ?
-            ''', (file_path, line, col, col))
+            SELECT role, usr FROM (
+                SELECT 'ref' AS role, usr_id AS usr, e_col - s_col AS width FROM refs
+                WHERE file_path = :f AND s_line = :line AND s_col <= :col AND e_col >= :col
+                UNION ALL
+                SELECT 'inc', included_file, e_col - s_col FROM includes
+                WHERE source_file = :f AND s_line = :line AND s_col <= :col AND e_col >= :col
+                UNION ALL
+                SELECT 'def', usr_id, e_col - s_col FROM defs
+                WHERE file_path = :f AND s_line = :line AND s_col <= :col AND e_col >= :col
+            ) ORDER BY role = 'def', width LIMIT 1
+            ''', {"f": Database.to_db_path(file_path), "line": line, "col": col})
         res = self.cursor.fetchone()
         return res
 
+    def lsp_reference_counts_db(self, file_path, line=None, col=None):
+        """
+        引用数 (code lens 式的 "N 个引用")：给了坐标时只查光标处的符号，否则返回文件里所有定义的引用数。
+        每个符号只是 refcounts 的一次主键读取。返回 [(name, s_line, s_col, refs)]。
+        """
+        if line is not None:
+            ret = self.get_usr_at_location(file_path, line, col)
+            if not ret or ret[0] == 'inc':
+                return []
+            # 符号可能定义在没有索引的文件里，名字从定义或引用里随便取一个
+            self.cursor.execute('''
+                SELECT (SELECT name FROM defs WHERE usr_id = :id UNION ALL SELECT name FROM refs WHERE usr_id = :id LIMIT 1),
+                       :line, :col, COALESCE((SELECT refs FROM refcounts WHERE usr_id = :id), 0)
+            ''', {"id": ret[1], "line": line, "col": col})
+        else:
+            self.cursor.execute('''
+                SELECT d.name, d.s_line, d.s_col, COALESCE(rc.refs, 0) FROM defs d
+                LEFT JOIN refcounts rc ON rc.usr_id = d.usr_id
+                WHERE d.file_path = ? ORDER BY d.s_line
+            ''', (Database.to_db_path(file_path),))
+        return self.cursor.fetchall()
+
+    def struct_layout_db(self, file_path=None, line=None, col=None, name=None):
+        """
+        结构体布局：光标处的结构体 (定义处、struct xxx 类型名处都行)，或者按名字查。
+        布局在索引时算好，这里只是一次主键 (或名字索引) 读取。返回 [(name, abs_path, s_line, 布局 dict)]。
+        """
+        if name:
+            self.cursor.execute('SELECT name, file_path, s_line, unpack_blob(data) FROM layouts WHERE name = ?', (name,))
+        else:
+            ret = self.get_usr_at_location(file_path, line, col)
+            if not ret or ret[0] == 'inc':
+                return []
+            self.cursor.execute('SELECT name, file_path, s_line, unpack_blob(data) FROM layouts WHERE usr_id = ?', (ret[1],))
+        return [(n, Database.from_db_path(fp), sl, Database.format_layout(json.loads(data)))
+                for n, fp, sl, data in self.cursor.fetchall()]
+
+    @staticmethod
+    def format_layout(raw):
+        """
+        把库里以 bit 计的布局换成 pahole 的口径：偏移 / 大小 / 空洞以字节计，位域和位空洞另给 bit_offset / bits / bit_hole，
+        并汇总空洞个数、空洞字节数、尾部填充和占用的 cacheline 数
+        """
+        summary = {"holes": 0, "sum_holes": 0, "bit_holes": 0}
+
+        def fields(entries):
+            out = []
+            for name, type_, off, bits, hole, *sub in entries:
+                field = {"name": name, "type": type_, "offset": off // 8, "size": bits // 8}
+                if off % 8 or bits % 8:
+                    field.update(bit_offset=off % 8, bits=bits)
+                if hole:
+                    summary["holes"] += 1
+                    summary["sum_holes"] += hole // 8
+                    summary["bit_holes"] += hole % 8
+                    field["hole"] = hole // 8
+                    if hole % 8:
+                        field["bit_hole"] = hole % 8
+                if sub:
+                    field["fields"] = fields(sub[0])
+                out.append(field)
+            return out
+
+        layout = {"size": raw["size"], "align": raw["align"], "union": bool(raw["union"]),
+                  "fields": fields(raw["fields"])}
+        layout.update(summary, padding=raw["padding"] // 8, bit_padding=raw["padding"] % 8,
+                      cachelines=-(-raw["size"] // 64))
+        return layout
+
+    # 死代码查找关心的定义种类 -> PyClangd-Core 输出的 kind
+    UNREFERENCED_KINDS = {
+        "function": ("DEF_Function",),
+        "variable": ("DEF_Var",),
+        "macro": ("MACRO_DEF",),
+        "field": ("DEF_Field",),
+    }
+
+    def iter_unreferenced_defs(self, kinds=None, profile=None, batch=1000):
+        """
+        流式列出整个索引里零引用的定义：yield (abs_path, s_line, s_col, kind, name)。
+        一条 refcounts 反连接完成，按文件顺序分批取，内存占用与结果总数无关；
+        profile (IndexProfile) 按相对工作区路径过滤。函数内的局部变量 (USR 含 @F@) 不算在内。
+        """
+        kind_raws = [k for name in (kinds or Database.UNREFERENCED_KINDS) for k in Database.UNREFERENCED_KINDS[name]]
+        if not self.references_complete():
+            logger.warning("⚠️ 引用索引尚未完成，部分定义会被误报为零引用")
+        cursor = self.conn.cursor()  # 独立游标，边迭代边查别的不会互相打断
+        cursor.execute(f'''
+            SELECT d.file_path, d.s_line, d.s_col, d.kind, d.name FROM defs d JOIN usrs u ON u.id = d.usr_id
+            WHERE d.kind IN ({', '.join('?' * len(kind_raws))})
+              AND NOT EXISTS (SELECT 1 FROM refcounts rc WHERE rc.usr_id = d.usr_id)
+              AND NOT (d.kind = 'DEF_Var' AND u.usr GLOB '*@F@*')
+            ORDER BY d.file_path, d.s_line
+        ''', kind_raws)
+        while True:
+            rows = cursor.fetchmany(batch)
+            if not rows:
+                break
+            for fp, sl, sc, kind, name in rows:
+                abs_path = Database.from_db_path(fp)
+                if profile is None or profile.matches(abs_path):
+                    yield abs_path, sl, sc, kind, name
+        cursor.close()
+
     def get_definitions_by_usr(self, usr):
         # myark 这个函数在项目中没有使用，但是在其他测试验证文件中使用了
         """通过 USR 精确查找定义位置"""
         self.cursor.execute('''
             SELECT DISTINCT file_path, s_line, s_col, e_line, e_col 
-            FROM symbols WHERE usr = ? AND role = 'def'
-        ''', (usr,))
-        return self.cursor.fetchall()
+            FROM defs WHERE usr_id = ?
+        ''', (Database.usr_id(usr),))
+        return Database.abs_rows(self.cursor.fetchall())
 
     def get_references_by_usr(self, usr):
-        """查 USR 对应的所有引用位置（包含声明/定义、调用、读取等）"""
+        return self.get_references_by_id(Database.usr_id(usr))
+
+    # 引用的访问方式位标志，与 PyClangd-Core 的 RefAccess 一致 (0 为声明或未分类)
+    ACCESS_READ = 1
+    ACCESS_WRITE = 2
+    ACCESS_CALL = 4
+    ACCESS_ADDR = 8
+    ACCESS_TYPE = 16  # 类型名、sizeof / offsetof
+    ACCESS_ALL = 31
+    # 过滤条件 -> 必须同时具备的位；write 包含读改写，rmw 只要读改写
+    ACCESS_FILTERS = {
+        "read": ACCESS_READ,
+        "write": ACCESS_WRITE,
+        "rmw": ACCESS_READ | ACCESS_WRITE,
+        "call": ACCESS_CALL,
+        "addr": ACCESS_ADDR,
+        "type": ACCESS_TYPE,
+    }
+
+    @staticmethod
+    def access_values(filters):
+        """过滤条件 -> 命中的全部 access 取值 (不超过 32 个)，查询时 access IN (...) 直接落在 refs 主键上"""
+        unknown = [f for f in filters if f not in Database.ACCESS_FILTERS]
+        if unknown:
+            raise ValueError(f"❌ 未知的访问方式过滤: {unknown}，可选 {list(Database.ACCESS_FILTERS)}")
+        masks = [Database.ACCESS_FILTERS[f] for f in filters]
+        return [a for a in range(Database.ACCESS_ALL + 1) if any(a & m == m for m in masks)]
+
+    def get_references_by_id(self, sid, access=None):
+        """查符号 ID 对应的所有引用位置（包含声明/定义、调用、读取等）；按访问方式过滤时只返回命中的引用，不含定义"""
+        if access:
+            # 主键 (usr_id, access, ...)：每个命中的 access 取值是一段连续的行，不碰其余引用
+            self.cursor.execute('''
+                SELECT file_path, s_line, s_col, e_line, e_col FROM refs
+                WHERE usr_id = ? AND access IN (SELECT value FROM json_each(?))
+            ''', (sid, json.dumps(Database.access_values(access))))
+            return Database.abs_rows(self.cursor.fetchall())
         # 这个是查询所有引的的关键函数
         self.cursor.execute('''
-            SELECT DISTINCT file_path, s_line, s_col, e_line, e_col 
-            FROM symbols WHERE usr = ? AND role IN ('ref', 'def')
-        ''', (usr,))
-        return self.cursor.fetchall()
+            SELECT file_path, s_line, s_col, e_line, e_col FROM refs WHERE usr_id = ?
+            UNION
+            SELECT file_path, s_line, s_col, e_line, e_col FROM defs WHERE usr_id = ?
+        ''', (sid, sid))
+        return Database.abs_rows(self.cursor.fetchall())
+
+    # 调用层级里可以作为节点的定义种类 (PyClangd-Core 输出 kind 的后半段，即 Clang 的 DeclKindName)
+    CALLABLE_KINDS = ("Function", "CXXMethod", "CXXConstructor", "CXXDestructor", "CXXConversion", "FunctionTemplate")
+
+    @staticmethod
+    def is_callable_kind(kind):
+        return kind.split('_', 1)[-1] in Database.CALLABLE_KINDS
+
+    def _call_items(self, ids):
+        """
+        批量取调用图节点：{符号 ID: (name, kind, abs_path, s_line, s_col, e_line, e_col)}。
+        有定义的取第一处定义；没有索引到定义的 (外部函数、汇编实现) 退回到第一处引用，至少能显示名字和位置。
+        """
+        seeds = json.dumps(list(ids))
+        self.cursor.execute('''
+            SELECT usr_id, name, kind, file_path, s_line, s_col, e_line, e_col FROM defs
+            WHERE usr_id IN (SELECT value FROM json_each(?)) ORDER BY file_path, s_line
+        ''', (seeds,))
+        items = {}
+        for sid, name, kind, fp, sl, sc, el, ec in self.cursor.fetchall():
+            items.setdefault(sid, (name, kind, Database.from_db_path(fp), sl, sc, el, ec))
+        missing = [sid for sid in ids if sid not in items]
+        if missing:
+            # 每个符号只取主键上的第一行，一次点查，不扫它的全部引用
+            for sid in missing:
+                self.cursor.execute('''
+                    SELECT name, kind, file_path, s_line, s_col, e_line, e_col FROM refs WHERE usr_id = ? LIMIT 1
+                ''', (sid,))
+                row = self.cursor.fetchone()
+                if row:
+                    items[sid] = row[:2] + (Database.from_db_path(row[2]),) + row[3:]
+        return items
+
+    def lsp_prepare_call_hierarchy_db(self, file_path, line, col):
+        """光标处的函数作为调用层级的根：返回 [(符号 ID, 节点)]，不是函数时返回空"""
+        logger.info(f"👉 调用层级: {file_path}:{line}:{col}")
+        ret = self.get_usr_at_location(file_path, line, col)
+        if not ret or ret[0] == 'inc':
+            return []
+        sid = ret[1]
+        item = self._call_items([sid]).get(sid)
+        if not item or not Database.is_callable_kind(item[1]):
+            return []
+        if not self.references_complete():
+            logger.warning("⚠️ 引用索引尚未完成，调用关系可能不完整")
+        return [(sid, item)]
+
+    def lsp_incoming_calls_db(self, sid):
+        """
+        谁调用了 sid：[(调用者 ID, 调用者节点, [调用点 (abs_path, s_line, s_col, e_line, e_col)])]。
+        直接读 refs 主键上 sid 的那一段，调用点和调用者一次取齐。
+        """
+        self.cursor.execute('''
+            SELECT caller_id, file_path, s_line, s_col, e_line, e_col FROM refs
+            WHERE usr_id = ? AND caller_id IS NOT NULL ORDER BY file_path, s_line, s_col
+        ''', (sid,))
+        sites = {}
+        for caller, fp, sl, sc, el, ec in self.cursor.fetchall():
+            sites.setdefault(caller, []).append((Database.from_db_path(fp), sl, sc, el, ec))
+        items = self._call_items(sites)
+        return [(caller, items[caller], ranges) for caller, ranges in sites.items() if caller in items]
+
+    def lsp_outgoing_calls_db(self, sid):
+        """sid 调用了谁：[(被调用者 ID, 被调用者节点, [调用点])]，走 refs(caller_id) 部分索引"""
+        self.cursor.execute('''
+            SELECT usr_id, file_path, s_line, s_col, e_line, e_col FROM refs
+            WHERE caller_id = ? ORDER BY file_path, s_line, s_col
+        ''', (sid,))
+        sites = {}
+        for callee, fp, sl, sc, el, ec in self.cursor.fetchall():
+            sites.setdefault(callee, []).append((Database.from_db_path(fp), sl, sc, el, ec))
+        items = self._call_items(sites)
+        return [(callee, items[callee], ranges) for callee, ranges in sites.items() if callee in items]
+
+    def call_graph_db(self, sids, direction="incoming", depth=3, limit=5000):
+        """
+        从一批符号出发沿 calls 表展开 depth 层，整个展开是一条递归查询 (每层一次批量连接，不是逐个节点往返)。
+        direction="incoming" 向上找调用者，"outgoing" 向下找被调用者；limit 限制边数，免得 kmalloc 这类函数展开成整个内核。
+        返回 (节点 {符号 ID: (层数, 节点)}, 边 [(caller_id, callee_id, 调用点个数)])。
+        """
+        near, far = ("callee_id", "caller_id") if direction == "incoming" else ("caller_id", "callee_id")
+        self.cursor.execute(f'''
+            WITH RECURSIVE walk(id, depth) AS (
+                SELECT value, 0 FROM json_each(:seeds)
+                UNION
+                SELECT c.{far}, w.depth + 1 FROM walk w JOIN calls c ON c.{near} = w.id WHERE w.depth < :depth
+            ),
+            frontier(id, depth) AS (SELECT id, MIN(depth) FROM walk GROUP BY id)
+            SELECT c.caller_id, c.callee_id, c.sites, f.depth FROM frontier f JOIN calls c ON c.{near} = f.id
+            WHERE f.depth < :depth ORDER BY f.depth LIMIT :limit
+        ''', {"seeds": json.dumps(list(sids)), "depth": depth, "limit": limit})
+
+        levels = {sid: 0 for sid in sids}
+        edges = []
+        for caller, callee, n, level in self.cursor.fetchall():
+            edges.append((caller, callee, n))
+            other = caller if direction == "incoming" else callee
+            levels[other] = min(levels.get(other, level + 1), level + 1)
+        items = self._call_items(levels)
+        return {sid: (level, items[sid]) for sid, level in levels.items() if sid in items}, edges
 
     def get_references_by_name(self, name):
         # mymark 这个函数在项目中没有使用，可以删除
         """查名字对应的所有引用位置 (作为兜底)"""
         self.cursor.execute('''
             SELECT DISTINCT file_path, s_line, s_col, e_line, e_col 
-            FROM symbols
-            WHERE name = ? AND role = 'ref'
+            FROM refs
+            WHERE name = ?
         ''', (name,))
-        return self.cursor.fetchall()
+        return Database.abs_rows(self.cursor.fetchall())
 
     def get_definitions_by_name(self, name):
         # mymark 这个函数在项目中没有使用，可以删除
         """查名字对应的所有定义位置 (作为兜底)"""
         self.cursor.execute('''
             SELECT DISTINCT file_path, s_line, s_col, e_line, e_col 
-            FROM symbols
-            WHERE name = ? AND role = 'def'
+            FROM defs
+            WHERE name = ?
         ''', (name,))
-        return self.cursor.fetchall()
+        return Database.abs_rows(self.cursor.fetchall())
 
     # =========================================================================
     # --- 构建索引与解析体系 (从原来的 pyclangd_server 中抽取) ---
@@ -527,14 +1977,16 @@ class Database:
 
     # 需求2：调用 C++ 核心进行解析
     @staticmethod
-    def index_parse_cpp(source_file, compiler_args):
-        """调用 PyClangd-Core 替代 libclang python 绑定"""
+    def index_parse_cpp(source_file, compiler_args, phase=None):
+        """调用 PyClangd-Core 替代 libclang python 绑定，phase=PHASE_DEFS 时跳过函数体只输出定义和 #include"""
         if not Database._core_bin_path or not os.path.exists(Database._core_bin_path):
             logger.error(f"找不到核心程序: {Database._core_bin_path}")
-            return "FAILED", []
+            return "FAILED", [], []
 
         # 构造命令: ./PyClangd-Core source.c -- args...
         cmd = [Database._core_bin_path, source_file, "--"] + compiler_args
+        if phase == Database.PHASE_DEFS:
+            cmd.insert(1, "--defs-only")
         
         # 动态编译版需要设置动态库搜索路径 #mymark 待修改
         env = os.environ.copy()
@@ -551,7 +2003,7 @@ class Database:
             if process.returncode != 0:
                 # 打印出具体的错误原因，方便我们定位是少了头文件还是参数不对
                 logger.error(f"❌ C++ 核心解析失败 [{cmd}]\n{stderr_data}")
-                return "FAILED", stderr_data
+                return "FAILED", [], []
 
             for line in stdout_data.splitlines():
                 line = line.strip()
@@ -563,6 +2015,12 @@ class Database:
                     
                     if kind_raw == "inc":
                         role = "inc"
+                    elif kind_raw == "IMPL":
+                        role = "impl"
+                    elif kind_raw in ("LAYOUT", "HOVER", "EXTENT"):
+                        role = kind_raw.lower()
+                    elif kind_raw == "LOGFMT":
+                        role = "log"
                     elif "DEF" in kind_raw or "MACRO_DEF" in kind_raw:
                         role = "def" 
                     else:
@@ -573,16 +2031,25 @@ class Database:
                     s_line = data.get("line", 0)
                     s_col = data.get("col", 0)
                     usr = data.get("usr", "")
+                    context = data.get("context")
+                    if role in Database.BLOB_ROLES:
+                        # 布局 / 悬停信息是 JSON 对象，键名与角色同名
+                        context = json.dumps(data.get(role), separators=(",", ":"), ensure_ascii=False)
+                    elif role == "log":
+                        context = data.get("format", "")
+                    access = data.get("access", 0)
 
                     # 收集依赖：源文件包含的头文件
                     if role == "inc" and f_path and usr:
                         includes_to_upsert.append((f_path, usr))
                     
-                    # 组合成存储格式
+                    # 组合成存储格式：extent 行带着真实的结束位置，其余的行都是名字本身 (起点 + 名字长度)
+                    e_line, e_col = (data.get("end_line", s_line), data.get("end_col", s_col)) if role == "extent" \
+                        else (s_line, s_col + len(name))
                     symbols_to_upsert.append((
-                        f_path, s_line, s_col, s_line, s_col + len(name),
+                        f_path, s_line, s_col, e_line, e_col,
                         usr,
-                        role, name, kind_raw
+                        role, name, kind_raw, context, access
                     ))
                 except Exception as e:
                     logger.warning(f"解析 JSON 行失败: {line} \n error: {e}")
@@ -599,36 +2066,105 @@ class Database:
             return "FAILED", [], []
 
     @staticmethod
-    def index_worker(cmd_info):
+    def preprocess_cpp(source_file, compiler_args):
+        """PyClangd-Core --preprocess：与索引相同的编译参数跑一遍预处理，返回带行号标记的输出，失败返回 None"""
+        if not Database._core_bin_path or not os.path.exists(Database._core_bin_path):
+            logger.error(f"找不到核心程序: {Database._core_bin_path}")
+            return None
+        cmd = [Database._core_bin_path, "--preprocess", source_file, "--"] + compiler_args
+        env = os.environ.copy()
+        env["LD_LIBRARY_PATH"] = Database._clang_lib_path + ":" + env.get("LD_LIBRARY_PATH", "")
+        try:
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=env)
+        except Exception as e:
+            logger.exception(f"执行 PyClangd-Core 预处理崩溃: {e}")
+            return None
+        if result.returncode != 0:
+            logger.error(f"❌ 预处理失败 [{cmd}]\n{result.stderr}")
+            return None
+        return result.stdout
+
+    @staticmethod
+    def _parse_cache_key(cmd_info, source_file, source_md5, compiler_args, phase):
+        core_id = ""
+        if Database._core_bin_path and os.path.exists(Database._core_bin_path):
+            st = os.stat(Database._core_bin_path)
+            core_id = f"{st.st_size}:{st.st_mtime_ns}"  # 核心程序升级后旧结果全部作废
+        return Database._parse_cache.base_key(
+            Database.to_db_path(source_file), source_md5, cmd_info.get('directory', ''), compiler_args,
+            phase or Database.PHASE_FULL, Database._workspace_real, core_id)
+
+    @staticmethod
+    def index_worker(cmd_info, phase=None):
         """核心解析工人进程"""
         # 注意：这里需要确保 Database._core_bin_path 已在主进程设置
         source_file, compiler_args = Database.clean_compiler_args(cmd_info)
+        source_md5 = Database.cached_file_md5(source_file)
+        cache = Database._parse_cache
+        cache_key = None
+        if cache and source_md5:
+            cache_key = Database._parse_cache_key(cmd_info, source_file, source_md5, compiler_args, phase)
+            cached = cache.lookup(cache_key, lambda p: Database.cached_file_md5(Database.from_db_path(p)))
+            if cached:
+                # 命中：完全跳过解析，只回放结果
+                db = Database()
+                db.save_stored_result(source_file, source_md5, cached[0], cached[1], phase)
+                db.close()
+                return "SUCCESS", source_file
+
         # 使用 C++ 核心进行解析
         # 接收三个返回值
-        status, symbols, includes = Database.index_parse_cpp(source_file, compiler_args)
+        status, symbols, includes = Database.index_parse_cpp(source_file, compiler_args, phase)
 
         if status == "FAILED":
             return "FAILED", source_file
         else:
+            symbols, includes = Database.to_stored_rows(symbols, includes)
             # 需求1：使用无参初始化（前提是主进程已初始化过）
             db = Database()
-            source_md5 = db.get_file_md5(source_file)
             # 传入 md5 和 includes
-            db.save_parse_result(source_file, source_md5, symbols, includes)
+            db.save_stored_result(source_file, source_md5, symbols, includes, phase)
             db.close()
+            if cache_key:
+                headers = {inc: Database.cached_file_md5(Database.from_db_path(inc)) for _, inc in includes}
+                # 头文件在解析过程中被删掉 (md5 为 None) 时不缓存，免得记下一个永远对不上的状态
+                if all(headers.values()):
+                    cache.store(cache_key, headers, symbols, includes)
             return "SUCCESS", source_file
 
-    def run_index_mode(self, jobs):
-        """主动索引模式（带增量更新与断点续传）"""
+    @staticmethod
+    def parse_shard_spec(spec):
+        """解析 --shard i/N (i 从 1 开始)，返回 (i, N)"""
+        try:
+            index, count = (int(x) for x in spec.split('/'))
+        except ValueError:
+            raise ValueError(f"❌ 分片参数格式错误: {spec}，应为 i/N，例如 2/8")
+        if count <= 0 or not 1 <= index <= count:
+            raise ValueError(f"❌ 分片参数越界: {spec}，要求 1 <= i <= N")
+        return index, count
 
-        from concurrent.futures import ProcessPoolExecutor, as_completed
-        
+    @staticmethod
+    def shard_db_name(workspace_dir, shard):
+        """分片索引默认输出的数据库路径"""
+        index, count = shard
+        return os.path.join(os.path.abspath(workspace_dir), f"pyclangd_index.shard-{index}-of-{count}.db")
+
+    def in_shard(self, abs_path, shard):
+        """按工作区相对路径的 crc32 取模分片：与机器、compile_commands.json 顺序无关，结果稳定"""
+        if not shard:
+            return True
+        index, count = shard
+        rel_path = os.path.relpath(abs_path, self.workspace_dir)
+        return zlib.crc32(rel_path.encode('utf-8')) % count == index - 1
+
+    def collect_index_tasks(self, shard=None, two_phase=False, profile=None):
+        """扫描 compile_commands.json，返回 (命令总数, 需要增量处理的 [(编译命令, 阶段)])"""
         workspace_dir = self.workspace_dir
         cc_path = os.path.join(workspace_dir, "compile_commands.json")
         
         if not os.path.exists(cc_path):
             logger.error("未找到 compile_commands.json")
-            return
+            return 0, []
 
         with open(cc_path, 'r', encoding='utf-8') as f:
             commands = json.load(f)
@@ -648,10 +2184,9 @@ class Database:
         if repeat_count > 0:
             logger.error(f"发现 {repeat_count} 个重复文件，请注意！！！")
 
-        max_workers = 1 if jobs <= 0 else jobs
-
-        self.cursor.execute('SELECT file_path, mtime FROM files')
-        indexed_files = {row[0]: row[1] for row in self.cursor.fetchall()}
+        self.cursor.execute('SELECT file_path, mtime, md5, phase FROM files')
+        indexed_files = {row[0]: (row[1], row[2], row[3] or Database.PHASE_FULL) for row in self.cursor.fetchall()}
+        phases = (Database.PHASE_DEFS, Database.PHASE_FULL) if two_phase else (Database.PHASE_FULL,)
 
         tasks = []
         for cmd in commands:
@@ -663,86 +2198,425 @@ class Database:
                 logger.info(f"文件 {abs_path} 是汇编文件，跳过解析")
                 continue
 
+            if not self.in_shard(abs_path, shard):
+                continue
+
+            if profile and not profile.matches(abs_path):
+                continue
+
             if not os.path.exists(abs_path):
                 logger.error(f"文件 {abs_path} 不存在")
                 continue
             
             mtime = os.path.getmtime(abs_path)
+            stored_path = Database.to_db_path(abs_path)
             # 如果文件存在且mtime相同，说明文件没有被修改，跳过解析
-            if abs_path in indexed_files and indexed_files[abs_path] == mtime:
-                logger.info(f"文件 {abs_path} 已是最新状态，无需合并解析！")
-                continue
+            if stored_path in indexed_files:
+                old_mtime, old_md5, old_phase = indexed_files[stored_path]
+                unchanged = old_mtime == mtime
+                # mtime 变了但内容没变 (比如导入别人导出的索引、重新 checkout)：只刷新 mtime
+                if not unchanged and old_md5 and old_md5 == self.get_file_md5(abs_path):
+                    self.cursor.execute('UPDATE files SET mtime = ? WHERE file_path = ?', (mtime, stored_path))
+                    unchanged = True
+                if unchanged:
+                    if old_phase >= Database.PHASE_FULL:
+                        logger.info(f"文件 {abs_path} 已是最新状态，无需合并解析！")
+                        continue
+                    # 只做过定义阶段：补跑引用阶段
+                    tasks.append((cmd, Database.PHASE_FULL))
+                    continue
 
-            tasks.append(cmd)
+            tasks.extend((cmd, phase) for phase in phases)
 
         self.conn.commit()
+        return len(commands), tasks
+
+    @staticmethod
+    def _init_index_worker(nice):
+        """工人进程初始化：后台索引时降低 CPU 优先级，子进程 PyClangd-Core 会继承"""
+        if nice:
+            try:
+                os.nice(nice)
+            except OSError as e:
+                logger.warning(f"降低进程优先级失败: {e}")
+
+    def run_index_mode(self, jobs, shard=None, progress=None, throttle=None, nice=0, index_queue=None, two_phase=False,
+                       profile=None):
+        """
+        主动索引模式（带增量更新与断点续传），shard=(i, N) 时只处理属于第 i 片的文件。
+        progress(completed, total, elapsed, finished_file): 每完成一个文件回调一次
+        throttle(): 派发下一个任务前调用，阻塞期间暂停派发 (LSP 查询变慢时让路)
+        nice: 工人进程的 nice 增量
+        index_queue: 外部持有的 IndexQueue，调用方可以在索引过程中随时 bump 文件优先级
+        two_phase: 先跳过函数体只建定义 (F12/Ctrl+T 马上可用)，所有定义建完后再补引用
+        profile: IndexProfile，只解析命中范围的编译单元
+        """
+        if profile:
+            logger.info(f"🎯 索引范围: {profile}")
+        command_count, tasks = self.collect_index_tasks(shard, two_phase, profile)
 
         total = len(tasks)
         if total == 0:
             logger.info("🎉 所有文件均已是最新状态，无需合并解析！")
             return
 
-        logger.info(f"🚀 开始索引: 共 {len(commands)} 个文件，增量需要处理 {total} 个, 进程数: {max_workers}")
+        max_workers = 1 if jobs <= 0 else jobs
+        shard_info = f", 分片 {shard[0]}/{shard[1]} -> {self.db_path}" if shard else ""
+        logger.info(f"🚀 开始索引: 共 {command_count} 个文件，增量需要处理 {total} 个, 进程数: {max_workers}{shard_info}")
 
         completed = 0
-        from time import time
-        start_time = time()
-        
+        start_time = time.time()
+        pending = index_queue if index_queue is not None else IndexQueue()
+        for cmd, phase in tasks:
+            priority = IndexQueue.PRIORITY_BULK if phase == Database.PHASE_DEFS or not two_phase else IndexQueue.PRIORITY_REFS
+            pending.push(cmd, priority, phase)
+        results = queue.Queue()
+        in_flight = 0
+
         # ctrl + c 时能够自动安全退出
-        with multiprocessing.Pool(processes=max_workers) as pool:
-            # 使用 imap_unordered 可以极大地节省内存，它不会一次性把所有任务结果憋在内存里
-            # 而是像流水线一样，谁先完成就先吐出谁的结果
-            for res, finished_file in pool.imap_unordered(Database.index_worker, tasks):
+        with multiprocessing.Pool(processes=max_workers, initializer=Database._init_index_worker, initargs=(nice,)) as pool:
+            # 自己维护一个窗口，最多只有 2 * max_workers 个任务在飞：
+            # 不会一次性把所有任务结果憋在内存里，也让 throttle 能及时暂停派发
+            while len(pending) or in_flight:
+                while len(pending) and in_flight < max_workers * 2:
+                    if throttle:
+                        throttle()
+                    cmd, phase = pending.pop()
+                    if cmd is None:
+                        break
+                    pool.apply_async(Database.index_worker, (cmd, phase), callback=results.put,
+                                     error_callback=lambda e, cmd=cmd: results.put(("FAILED", cmd.get('file', ''))))
+                    in_flight += 1
+
+                res, finished_file = results.get()
+                in_flight -= 1
                 completed += 1
                 
                 if res == "FAILED":
                     logger.error(f"某个文件处理失败，请查看上方详细日志 {finished_file}")
 
-                elapsed = time() - start_time
-                progress = (completed / total) * 100
-                logger.info(f"进度: [{completed}/{total}] {progress:.1f}% | 耗时: {elapsed:.2f}s {finished_file}")
+                elapsed = time.time() - start_time
+                percent = (completed / total) * 100
+                logger.info(f"进度: [{completed}/{total}] {percent:.1f}% | 耗时: {elapsed:.2f}s {finished_file}")
+                if progress:
+                    progress(completed, total, elapsed, finished_file)
+
+        if Database._parse_cache:
+            Database._parse_cache.evict()
+
+    def merge_shards(self, shard_paths):
+        """
+        把多个分片库合并进当前库：ATTACH + 整表 INSERT ... SELECT，不在 Python 里逐行搬运。
+        头文件会被多个分片重复解析，依靠各表的主键去重。
+        """
+        shard_paths = [os.path.abspath(p) for p in shard_paths if os.path.abspath(p) != os.path.abspath(self.db_path)]
+        if not shard_paths:
+            logger.warning("⚠️ 没有需要合并的分片库")
+            return 0
+
+        start_time = time.time()
+        # ATTACH/DETACH 不能出现在事务里，先把隐式事务提交掉
+        self.conn.commit()
+
+        # 第一轮：抹掉所有分片里出现过的文件的旧记录。
+        # 必须先全部删完再插入，否则后合并的分片会把前一个分片刚插入的头文件符号删掉
+        for path in shard_paths:
+            self._attach_shard(path)
+            for table, column in (('defs', 'file_path'), ('refs', 'file_path'), ('includes', 'source_file'), ('impls', 'file_path'),
+                                  ('layouts', 'file_path'), ('hovers', 'file_path'), ('extents', 'file_path'),
+                                  ('logfmts', 'file_path')):
+                self.cursor.execute(f'DELETE FROM main.{table} WHERE {column} IN (SELECT file_path FROM shard.files)')
+            self.conn.commit()
+            self.cursor.execute('DETACH DATABASE shard')
+
+        # 第二轮：集合式插入
+        for path in shard_paths:
+            self._attach_shard(path)
+            # 和主库哈希碰撞的符号 (ID 相同 USR 不同) 的行不合并，见 register_usrs
+            self.cursor.execute('DROP TABLE IF EXISTS temp.collided')
+            self.cursor.execute('''
+                CREATE TEMP TABLE collided AS
+                SELECT s.id, s.usr AS shard_usr, m.usr AS main_usr FROM shard.usrs s JOIN main.usrs m ON m.id = s.id WHERE m.usr != s.usr
+            ''')
+            self.cursor.execute('SELECT shard_usr, main_usr FROM temp.collided')
+            for shard_usr, main_usr in self.cursor.fetchall():
+                logger.error(f"❌ 符号 ID 碰撞: {shard_usr} 与 {main_usr} 的哈希相同，跳过 {shard_usr}")
+            not_collided = 'NOT IN (SELECT id FROM temp.collided)'
+            self.cursor.execute('INSERT OR IGNORE INTO main.usrs SELECT * FROM shard.usrs')
+            self.cursor.execute('INSERT OR IGNORE INTO main.includes SELECT * FROM shard.includes')
+            for table in ('defs', 'layouts', 'hovers', 'extents', 'logfmts'):
+                self.cursor.execute(f'INSERT OR IGNORE INTO main.{table} SELECT * FROM shard.{table} WHERE usr_id {not_collided}')
+            self.cursor.execute(f'''
+                INSERT OR IGNORE INTO main.refs (usr_id, file_path, s_line, s_col, e_line, e_col, name, kind, caller_id, access)
+                SELECT usr_id, file_path, s_line, s_col, e_line, e_col, name, kind,
+                       CASE WHEN caller_id {not_collided} THEN caller_id END, access
+                FROM shard.refs WHERE usr_id {not_collided}
+            ''')
+            self.cursor.execute(f'INSERT OR IGNORE INTO main.impls SELECT * FROM shard.impls WHERE field_id {not_collided} AND func_id {not_collided}')
+            self.cursor.execute('DROP TABLE temp.collided')
+            # 源文件带 mtime，头文件只有 md5：已有 mtime 的记录不能被头文件记录覆盖成 NULL
+            self.cursor.execute('''
+                INSERT INTO main.files (file_path, mtime, md5, phase)
+                SELECT file_path, mtime, md5, phase FROM shard.files WHERE true
+                ON CONFLICT(file_path) DO UPDATE SET
+                    mtime = COALESCE(excluded.mtime, files.mtime),
+                    md5 = excluded.md5,
+                    phase = COALESCE(excluded.phase, files.phase)
+            ''')
+            self.conn.commit()
+            self.cursor.execute('DETACH DATABASE shard')
+            logger.info(f"✅ 已合并分片: {path}")
+
+        logger.info(f"🎉 合并完成: {len(shard_paths)} 个分片 -> {self.db_path}，耗时 {time.time() - start_time:.2f}s")
+        return len(shard_paths)
+
+    @with_retry()
+    def _attach_shard(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"❌ 分片库不存在: {path}")
+        self.cursor.execute('ATTACH DATABASE ? AS shard', (path,))
+
+    def find_shard_dbs(self):
+        """查找工作区下按默认命名生成的分片库"""
+        return sorted(glob.glob(os.path.join(self.workspace_dir, "pyclangd_index.shard-*-of-*.db")))
+
+    def export_index(self, archive_path):
+        """
+        导出可搬迁的索引包 (tar.gz)：VACUUM INTO 出一份紧凑的库快照 + manifest.json。
+        工作区内路径本来就是相对路径，manifest 只记录工作区外绝对路径的来源前缀，供导入时重映射。
+        """
+        self.conn.commit()
+        tmp_dir = tempfile.mkdtemp(prefix="pyclangd_export_")
+        try:
+            snapshot = os.path.join(tmp_dir, "pyclangd_index.db")
+            self.cursor.execute('VACUUM INTO ?', (snapshot,))
+            self.cursor.execute('SELECT COUNT(*) FROM files WHERE mtime IS NOT NULL')
+            manifest = {
+                "schema_version": Database.SCHEMA_VERSION,
+                "workspace_dir": Database._workspace_real,
+                "clang_include_path": Database._clang_include_path,
+                "source_files": self.cursor.fetchone()[0],
+                "created": time.time(),
+            }
+            manifest_path = os.path.join(tmp_dir, "manifest.json")
+            with open(manifest_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, indent=2)
+            with tarfile.open(archive_path, "w:gz") as tar:
+                tar.add(manifest_path, arcname="manifest.json")
+                tar.add(snapshot, arcname="pyclangd_index.db")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        logger.info(f"🎉 索引已导出: {archive_path}")
+        return archive_path
+
+    def import_index(self, archive_path, remaps=()):
+        """
+        导入索引包并替换当前库。remaps 为 [(old_prefix, new_prefix)]，用于重映射工作区外的绝对路径
+        (例如 O= 输出目录)；导出端自带的 clang_include 目录会自动映射到本机。
+        导入后照常运行索引模式即可：内容未变的文件只刷新 mtime，只有本地改动过的文件会被重新解析。
+        """
+        tmp_dir = tempfile.mkdtemp(prefix="pyclangd_import_", dir=os.path.dirname(self.db_path))
+        try:
+            with tarfile.open(archive_path, "r:gz") as tar:
+                for name in ("manifest.json", "pyclangd_index.db"):
+                    tar.extract(name, tmp_dir, filter="data")
+            with open(os.path.join(tmp_dir, "manifest.json"), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if not 1 <= manifest.get("schema_version", 0) <= Database.SCHEMA_VERSION:
+                raise ValueError(f"❌ 索引包版本 {manifest.get('schema_version')} 与当前版本 {Database.SCHEMA_VERSION} 不兼容")
+
+            remaps = list(remaps)
+            exported_include = manifest.get("clang_include_path")
+            if exported_include and exported_include != Database._clang_include_path:
+                remaps.append((exported_include, Database._clang_include_path))
+
+            imported = os.path.join(tmp_dir, "pyclangd_index.db")
+            # 旧版本的索引包先在临时库里升级到当前表结构，再重映射路径，最后整体替换
+            staged = Database(db_file=imported)
+            staged._setup()
+            for old, new in remaps:
+                logger.info(f"🔁 重映射路径前缀: {old} -> {new}")
+                Database.remap_path_prefix(staged.cursor, old, new)
+            staged.conn.commit()
+            staged.close()
+
+            # 原子替换当前库
+            self._disconnect()
+            try:
+                if not Database.replace_db_file(imported, self.db_path):
+                    raise RuntimeError(f"❌ 索引库 {self.db_path} 正在被使用 (VS Code 服务器或后台索引)，请先关闭再导入")
+            finally:
+                self._connect()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        logger.info(f"🎉 索引已导入: {archive_path} (导出自 {manifest.get('workspace_dir')}, {manifest.get('source_files')} 个源文件)")
+        return manifest
+
+    def index_status(self):
+        """各索引阶段的源文件数量，供查询判断结果是否完整"""
+        self.cursor.execute('SELECT phase, COUNT(*) FROM files WHERE mtime IS NOT NULL GROUP BY phase')
+        counts = dict(self.cursor.fetchall())
+        return {
+            "defs_only": counts.get(Database.PHASE_DEFS, 0),
+            "full": counts.get(Database.PHASE_FULL, 0),
+            "total": len(self.commands_map),
+        }
+
+    def references_complete(self):
+        """是否所有已索引的源文件都已完成引用阶段"""
+        self.cursor.execute('SELECT 1 FROM files WHERE phase = ? LIMIT 1', (Database.PHASE_DEFS,))
+        return self.cursor.fetchone() is None
+
+    def includer_closure(self, file_paths):
+        """直接或间接包含了 file_paths 中任一文件的所有文件 (含自身)，返回绝对路径列表"""
+        seeds = json.dumps([Database.to_db_path(p) for p in file_paths])
+        self.cursor.execute('''
+            WITH RECURSIVE up(f) AS (
+                SELECT value FROM json_each(?)
+                UNION
+                SELECT includes.source_file FROM includes JOIN up ON includes.included_file = up.f
+            )
+            SELECT f FROM up
+        ''', (seeds,))
+        return [Database.from_db_path(r[0]) for r in self.cursor.fetchall()]
+
+    SCOPE_HEADER_UNITS = 2  # 范围里的头文件最多带上几个包含它的编译单元 (解析一个就能建好头文件里的符号)
+
+    def scope_units(self, scoped):
+        """
+        范围文件 -> 要解析的编译单元。spinlock.h、sched.h 这类头文件的包含闭包几乎是整个内核，
+        所以头文件不展开闭包：范围内的源文件已经 (按已有索引) 包含了它就不再加，否则沿包含关系逐层往上找，
+        只取最近的 SCOPE_HEADER_UNITS 个编译单元；还没有索引时退回头文件同目录下的源文件。
+        """
+        commands_map = self.commands_map or self.load_commands_map()
+        units = {p for p in scoped if p in commands_map}
+        seeds = json.dumps([Database.to_db_path(p) for p in units])
+        self.cursor.execute('''
+            WITH RECURSIVE down(f) AS (
+                SELECT value FROM json_each(?)
+                UNION
+                SELECT includes.included_file FROM includes JOIN down ON includes.source_file = down.f
+            )
+            SELECT f FROM down
+        ''', (seeds,))
+        covered = {Database.from_db_path(r[0]) for r in self.cursor.fetchall()}
+
+        files = set(scoped)
+        for header in scoped:
+            if header not in covered:
+                files.update(self.nearest_including_units(header, Database.SCOPE_HEADER_UNITS, commands_map))
+        return files
+
+    def nearest_including_units(self, header, limit, commands_map):
+        """
+        沿包含关系逐层往上找直接或间接包含 header 的编译单元，每层按目录远近排序，凑够 limit 个就停，
+        不会把 kernel.h 这类头文件的整个包含闭包都查出来；还没有索引时退回头文件同目录下的源文件。
+        """
+        def nearest(paths):
+            return sorted(paths, key=lambda p: (-len(os.path.commonpath([p, header])), p))
+
+        found, frontier, seen = [], [Database.to_db_path(header)], set()
+        while frontier and len(found) < limit:
+            self.cursor.execute('''
+                SELECT DISTINCT source_file FROM includes WHERE included_file IN (SELECT value FROM json_each(?))
+            ''', (json.dumps(frontier),))
+            frontier = [r[0] for r in self.cursor.fetchall() if r[0] not in seen]
+            seen.update(frontier)
+            level = [p for p in map(Database.from_db_path, frontier) if p in commands_map]
+            found += nearest(level)[:limit - len(found)]
+        if not found:
+            directory = os.path.dirname(header)
+            found = nearest([p for p in commands_map if os.path.dirname(p) == directory])[:limit]
+        return found
+
+    def load_index_profile(self, include=(), exclude=(), scope_file=None, profile_file=None):
+        """
+        组装索引范围。profile_file 为空时尝试工作区下的 .pyclangd_profile.json；
+        scope_file (例如 generate_ftrace_scope 生成的 .ftrace_scope.txt) 里的源文件直接入选，
+        头文件只带上最近的几个包含它的编译单元 (见 scope_units)。都没有时返回 None (全量索引)。
+        """
+        include, exclude = list(include), list(exclude)
+        if not profile_file and not (include or exclude or scope_file):
+            default_file = os.path.join(self.workspace_dir, ".pyclangd_profile.json")
+            profile_file = default_file if os.path.exists(default_file) else None
+        if profile_file:
+            config = IndexProfile.read_config(profile_file)
+            include += config.get("include", [])
+            exclude += config.get("exclude", [])
+            scope_file = scope_file or config.get("scope")
+        if not (include or exclude or scope_file):
+            return None
+
+        files = None
+        if scope_file:
+            scope_path = os.path.join(self.workspace_dir, scope_file)
+            with open(scope_path, 'r', encoding='utf-8') as f:
+                scoped = [os.path.realpath(os.path.join(self.workspace_dir, line.strip())) for line in f if line.strip()]
+            files = self.scope_units(scoped)
+            logger.info(f"🎯 范围文件 {scope_path}: {len(scoped)} 个文件，选出 {len(files)} 个编译单元")
+        return IndexProfile(include, exclude, files)
+
+    def related_index_files(self, file_path, limit=32):
+        """
+        打开一个文件时应当优先索引的编译单元，按 IndexQueue 优先级分组返回 {priority: [abs_path]}：
+        - 头文件：直接或间接包含它的源文件 (按目录远近取前 limit 个，避免 kernel.h 这类头文件把全部文件都提前)
+        - 调用者/被调用者：引用了本文件定义的符号的文件，以及定义了本文件引用的符号的文件
+        - 同目录下的其他源文件
+        只返回 compile_commands.json 里存在的编译单元；索引尚未覆盖时只能依靠目录推断。
+        """
+        stored_path = Database.to_db_path(file_path)
+        directory = os.path.dirname(file_path)
+
+        def nearest(paths):
+            paths = [p for p in paths if p in self.commands_map and p != file_path]
+            paths.sort(key=lambda p: -len(os.path.commonpath([p, file_path])))
+            return paths[:limit]
+
+        includers = self.includer_closure([file_path])
+
+        self.cursor.execute('''
+            SELECT r.file_path FROM defs d JOIN refs r ON r.usr_id = d.usr_id WHERE d.file_path = ?
+            UNION
+            SELECT d.file_path FROM refs r JOIN defs d ON d.usr_id = r.usr_id WHERE r.file_path = ?
+        ''', (stored_path, stored_path))
+        neighbours = [Database.from_db_path(r[0]) for r in self.cursor.fetchall()]
+
+        siblings = [p for p in self.commands_map if os.path.dirname(p) == directory]
+        return {
+            IndexQueue.PRIORITY_RELATED: nearest(includers + neighbours),
+            IndexQueue.PRIORITY_NEARBY: nearest(siblings),
+        }
 
     def close(self):
-        self.conn.close()
+        self._disconnect()
 
 
-    def generate_ftrace_scope(self, trace_file_path, output_scope_file=".ftrace_scope.txt"):
+    def generate_ftrace_scope(self, trace_file_path, output_scope_file=".ftrace_scope.txt", jobs=0):
         """
         功能1：解析 ftrace 日志，提取所有函数名，映射到源文件，并生成范围限制文件。
+        trace 按块并行扫描 (见 ftrace.py)，可以是单个文件也可以是 per_cpu 目录；函数名一次性 JOIN 定义表。
         """
         logger.info(f"🔍 开始解析 ftrace 日志: {trace_file_path}")
         if not os.path.exists(trace_file_path):
             logger.error(f"❌ ftrace 文件不存在: {trace_file_path}")
             return False
 
-        functions = set()
-        # 正则表达式匹配 ftrace 格式：匹配 `|` 后面跟着的单词，直到遇到 `(` 
-        # 例如匹配: "|  do_el0_svc() {" 或 "|          _raw_spin_lock();"
-        pattern = re.compile(r'\|\s*([a-zA-Z0-9_]+)\s*\(')
-
+        start_time = time.time()
         try:
-            with open(trace_file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                for line in f:
-                    match = pattern.search(line)
-                    if match:
-                        functions.add(match.group(1))
+            functions = ftrace.collect_function_names(trace_file_path, jobs)
         except Exception as e:
             logger.error(f"❌ 读取 trace 文件失败: {e}")
             return False
 
-        logger.info(f"✅ 从 trace 日志中提取到 {len(functions)} 个不重复的函数名")
+        logger.info(f"✅ 从 trace 日志中提取到 {len(functions)} 个不重复的函数名 ({time.time() - start_time:.2f}s)")
 
-        valid_files = set()
-        # 遍历函数名，去数据库里找它们定义在哪些文件里
-        for func in functions:
-            self.cursor.execute('''
-                SELECT DISTINCT file_path FROM symbols 
-                WHERE name = ? AND role = 'def'
-            ''', (func,))
-            res = self.cursor.fetchall()
-            logger.info(f"函数 {func} 定义在 {res} 中")
-            for r in res:
-                valid_files.add(r[0])
+        # 函数名整体作为 json_each 虚表，和 defs 的 name 索引做一次连接；只读查询，不跟后台索引抢写锁
+        self.cursor.execute('''
+            SELECT DISTINCT d.file_path FROM json_each(?) AS t CROSS JOIN defs d ON d.name = t.value
+            WHERE d.kind = 'DEF_Function'
+        ''', (json.dumps(sorted(functions)),))
+        valid_files = {Database.from_db_path(r[0]) for r in self.cursor.fetchall()}
 
         if not valid_files:
             logger.warning("⚠️ 没有找到任何与这些函数匹配的源文件，可能内核未被完整索引。")
@@ -761,9 +2635,147 @@ class Database:
             return False
 
 
-    def lsp_scoped_references_db(self, file_path, line, col, scope_file=".ftrace_scope.txt"):
+    def import_ftrace_profile(self, trace_file_path, jobs=0):
+        """
+        功能2：导入 function_graph 日志里的耗时。trace 按块并行解析 (见 ftrace.collect_profile)，
+        按函数和调用边汇总后对上 USR 存进 ftrace_funcs / ftrace_edges，整表替换上一次导入的结果。
+        trace 里只有函数名：同名的多个定义 (各文件里的 static 函数) 只认索引调用图 calls 里真实存在的 调用者 -> 被调用者，
+        仍然分不出是哪一个的函数和边不入库，计入 ambiguous / ambiguous_edges。
+        返回 {functions, resolved, ambiguous, edges, ambiguous_edges}，trace 文件不存在时返回 None
+        """
+        logger.info(f"⏱ 开始导入 ftrace 耗时: {trace_file_path}")
+        if not os.path.exists(trace_file_path):
+            logger.error(f"❌ ftrace 文件不存在: {trace_file_path}")
+            return None
+        start_time = time.time()
+        funcs, edges = ftrace.collect_profile(trace_file_path, jobs)
+        logger.info(f"✅ trace 解析完成: {len(funcs)} 个函数, {len(edges)} 条调用边 ({time.time() - start_time:.2f}s)")
+
+        names = set(funcs).union(*edges)
+        self.cursor.execute('''
+            SELECT t.value, d.usr_id FROM json_each(?) AS t CROSS JOIN defs d ON d.name = t.value
+            WHERE d.kind = 'DEF_Function'
+        ''', (json.dumps(sorted(names)),))
+        ids = {}
+        for name, sid in self.cursor.fetchall():
+            ids.setdefault(name, set()).add(sid)
+
+        # 两端都唯一的边直接采用 (函数指针调用不在调用图里，也要留下)；有一端同名的边只留调用图里恰好一对的
+        edge_ids = {}
+        candidates = {}
+        for edge in edges:
+            callers, callees = ids.get(edge[0], ()), ids.get(edge[1], ())
+            if len(callers) == 1 and len(callees) == 1:
+                edge_ids[edge] = (next(iter(callers)), next(iter(callees)))
+            elif callers and callees:
+                candidates[edge] = [(a, b) for a in callers for b in callees]
+        if candidates:
+            pairs = {pair for pairs in candidates.values() for pair in pairs}
+            self.cursor.execute('''
+                SELECT c.caller_id, c.callee_id FROM json_each(?) AS t
+                JOIN calls c ON c.caller_id = json_extract(t.value, '$[0]') AND c.callee_id = json_extract(t.value, '$[1]')
+            ''', (json.dumps(sorted(pairs)),))
+            known = set(self.cursor.fetchall())
+            for edge, pairs in candidates.items():
+                matched = [pair for pair in pairs if pair in known]
+                if len(matched) == 1:
+                    edge_ids[edge] = matched[0]
+
+        # 同名函数的耗时记到对上的边指向的那个定义上；边指向不止一个 (或一个都没有) 时分不出来
+        func_ids = {name: next(iter(sids)) for name, sids in ids.items() if len(sids) == 1}
+        implied = {}
+        for (caller, callee), (a, b) in edge_ids.items():
+            implied.setdefault(caller, set()).add(a)
+            implied.setdefault(callee, set()).add(b)
+        for name, sids in ids.items():
+            if len(sids) > 1 and len(implied.get(name, ())) == 1:
+                func_ids[name] = next(iter(implied[name]))
+
+        func_rows = [(func_ids[name], *stat) for name, stat in funcs.items() if name in func_ids]
+        edge_rows = [(*edge_ids[edge], *stat) for edge, stat in edges.items() if edge in edge_ids]
+        self._save_ftrace_profile(func_rows, edge_rows)
+
+        ambiguous = sum(1 for name in funcs if name in ids and name not in func_ids)
+        ambiguous_edges = sum(1 for edge in candidates if edge not in edge_ids)
+        logger.info(f"🎉 ftrace 耗时已入库: {len(func_rows)}/{len(funcs)} 个函数对上了定义, {len(edge_rows)} 条边")
+        if ambiguous or ambiguous_edges:
+            logger.warning(f"⚠️ {ambiguous} 个函数、{ambiguous_edges} 条边对应多个同名定义，调用图也分不出来，没有入库")
+        return {"functions": len(funcs), "resolved": len(func_rows), "ambiguous": ambiguous,
+                "edges": len(edge_rows), "ambiguous_edges": ambiguous_edges}
+
+    @with_retry()
+    def _save_ftrace_profile(self, func_rows, edge_rows):
+        self.cursor.execute('DELETE FROM ftrace_funcs')
+        self.cursor.execute('DELETE FROM ftrace_edges')
+        self.cursor.executemany('INSERT INTO ftrace_funcs VALUES (?, ?, ?, ?, ?)', func_rows)
+        self.cursor.executemany('INSERT OR IGNORE INTO ftrace_edges VALUES (?, ?, ?, ?, ?)', edge_rows)
+        self.conn.commit()
+
+    FTRACE_ORDERS = {'self': 'self_us', 'total': 'total_us', 'max': 'max_us', 'calls': 'calls'}
+
+    def ftrace_hot_functions_db(self, order='self', limit=100):
+        """导入的 trace 里最耗时的函数：[(name, abs_path, s_line, s_col, calls, total_us, self_us, max_us)]"""
+        column = Database.FTRACE_ORDERS.get(order)
+        if not column:
+            raise ValueError(f"未知的排序方式: {order}，可选 {', '.join(Database.FTRACE_ORDERS)}")
+        self.cursor.execute(f'''
+            SELECT f.usr_id, d.name, d.file_path, d.s_line, d.s_col, f.calls, f.total_us, f.self_us, f.max_us
+            FROM (SELECT * FROM ftrace_funcs ORDER BY {column} DESC LIMIT ?) f
+            JOIN defs d ON d.usr_id = f.usr_id
+            ORDER BY f.{column} DESC, d.file_path, d.s_line
+        ''', (limit,))
+        seen = set()
+        rows = []
+        for sid, name, fp, sl, sc, *stat in self.cursor.fetchall():
+            if sid not in seen:
+                seen.add(sid)
+                rows.append((name, Database.from_db_path(fp), sl, sc, *stat))
+        return rows
+
+    def ftrace_edge_costs_db(self, sid, direction="incoming"):
+        """sid 的调用者 (incoming) 或被调用者 (outgoing) 在 trace 里的耗时：{另一端 ID: (calls, total_us, max_us)}"""
+        near, far = ("callee_id", "caller_id") if direction == "incoming" else ("caller_id", "callee_id")
+        self.cursor.execute(f'SELECT {far}, calls, total_us, max_us FROM ftrace_edges WHERE {near} = ?', (sid,))
+        return {row[0]: tuple(row[1:]) for row in self.cursor.fetchall()}
+
+    def ftrace_ranked_references_db(self, file_path, line, col):
+        """
+        光标处符号的引用按运行时耗时排序。函数调用取 所在函数 -> 它 这条边的耗时 (trace 里没走到就是 0)，
+        其它引用取所在函数 (按定义范围找) 自身的总耗时。
+        返回 [(abs_path, s_line, s_col, e_line, e_col, 所在函数名, calls, total_us)]，没有 trace 数据的引用耗时为 0、排在最后
+        """
+        ret = self.get_usr_at_location(file_path, line, col)
+        if not ret or ret[0] == 'inc':
+            return []
+        self.cursor.execute('''
+            SELECT r.file_path, r.s_line, r.s_col, r.e_line, r.e_col, r.caller_id IS NOT NULL,
+                   COALESCE(r.caller_id, (
+                       SELECT x.usr_id FROM extents x JOIN ftrace_funcs f ON f.usr_id = x.usr_id
+                       WHERE x.file_path = r.file_path AND x.s_line <= r.s_line AND x.e_line >= r.s_line
+                       ORDER BY x.s_line DESC LIMIT 1)),
+                   e.calls, e.total_us
+            FROM refs r LEFT JOIN ftrace_edges e ON e.caller_id = r.caller_id AND e.callee_id = r.usr_id
+            WHERE r.usr_id = ?
+        ''', (ret[1],))
+        rows = self.cursor.fetchall()
+        owners = {row[6] for row in rows if row[6] is not None}
+        self.cursor.execute('SELECT usr_id, calls, total_us FROM ftrace_funcs WHERE usr_id IN (SELECT value FROM json_each(?))',
+                            (json.dumps(list(owners)),))
+        func_costs = {sid: (calls, total) for sid, calls, total in self.cursor.fetchall()}
+        items = self._call_items(owners)
+
+        ranked = []
+        for fp, sl, sc, el, ec, is_call, owner, calls, total in rows:
+            if total is None:
+                calls, total = (0, 0.0) if is_call else func_costs.get(owner, (0, 0.0))
+            name = items[owner][0] if owner in items else None
+            ranked.append((Database.from_db_path(fp), sl, sc, el, ec, name, calls, total))
+        ranked.sort(key=lambda r: (-r[7], r[0], r[1], r[2]))
+        return ranked
+
+    def lsp_scoped_references_db(self, file_path, line, col, scope_file=".ftrace_scope.txt", access=None):
         """
-        专属功能：限定在 .ftrace_scope.txt 记录的文件范围内，搜索符号的所有引用
+        专属功能：限定在 .ftrace_scope.txt 记录的文件范围内，搜索符号的所有引用 (access 同 lsp_references_db)
         """
         logger.info(f"👉 发起右键范围搜索: {file_path}:{line}:{col}")
         
@@ -788,9 +2800,9 @@ class Database:
             logger.warning("❌ 范围搜索失败: 无法提取光标处符号的 USR (可能未索引)")
             return {"error": "无法获取当前光标下符号的精准 USR，请确保代码已编译索引。"}
 
-        role, usr = ret
-        # 4. 去数据库拉取该 USR 的所有引用和定义
-        all_refs = self.get_references_by_usr(usr)
+        role, sid = ret
+        # 4. 去数据库拉取该符号的所有引用和定义
+        all_refs = self.get_references_by_id(sid, access)
 
         # 5. Python 内存级高速过滤
         filtered_refs = [r for r in all_refs if r[0] in allowed_files]
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# ftrace (function_graph) 日志的并行扫描
+#
+# trace 动辄几个 GB，逐行跑正则是单核瓶颈。这里按字节把文件切成固定大小的块，交给进程池并行扫描：
+# 每块从块内第一个完整行开始、到跨过块尾的那一行为止，相邻块不重不漏。
+# 块内直接对整块 bytes 跑多行正则 (不逐行解码成 str)，工人进程只把去重后的函数名送回来。
+# 传入目录时按 per_cpu/cpu*/trace 这类每个 CPU 一份的文件分别切块，各 CPU 的文件同样并行。
+#
+# 耗时统计 (collect_profile)：function_graph 每个叶子调用 "foo();" 和每个 "}" 都带着耗时，
+# 按 CPU 维护调用栈就能得到每个函数的 调用次数 / 总耗时 / 自身耗时 / 最大耗时，以及 调用者 -> 被调用者 边的耗时。
+# 块与块之间调用栈是连着的：每块从空栈开始解析，把 "弹出了块开头之前就打开的帧" 这类事件
+# (外层帧，按从内到外的序号记) 和块尾仍然打开的帧作为残余交回来，主进程按块顺序把各 CPU 的栈接起来。
+
+import os
+import re
+import glob
+import logging
+import multiprocessing
+
+logger = logging.getLogger("PyClangd")
+
+CHUNK_SIZE = 64 << 20  # 每块 64 MB：块太小进程间往返太多，太大则最后几块拖尾
+# "| 函数名(" ：例如 " 1)   0.123 us    |  do_el0_svc() {"。不按行锚定，整块一次 findall 最快。
+# 编译器克隆出来的 foo.isra.0 / foo.constprop.0 / foo.cold 归到 foo 名下
+FUNCTION_CALL = re.compile(rb'\|\s*([A-Za-z_][A-Za-z0-9_]*)(?:\.[A-Za-z0-9_.]+)?\s*\(')
+
+
+def trace_files(path):
+    """
+    单个 trace 文件，或者 tracefs (及其拷贝) 目录：有 per_cpu 时取每个 CPU 一份的 per_cpu/cpu*/trace，
+    否则取顶层的 trace。两者内容重复，不能都读；trace_pipe、trace_marker、trace_options 这些也不是日志
+    """
+    if not os.path.isdir(path):
+        return [path]
+    for per_cpu in (os.path.join(path, "per_cpu"), path):
+        files = [p for p in glob.glob(os.path.join(per_cpu, "cpu*", "trace")) if os.path.isfile(p)]
+        if files:
+            return sorted(files)
+    top = os.path.join(path, "trace")
+    return [top] if os.path.isfile(top) else []
+
+
+def split_chunks(paths, chunk_size=None):
+    """[(文件, 起始字节, 结束字节)]，边界不必对齐到行，read_chunk 负责补齐。chunk_size 默认取调用时的 CHUNK_SIZE"""
+    chunk_size = chunk_size or CHUNK_SIZE
+    chunks = []
+    for path in paths:
+        size = os.path.getsize(path)
+        chunks.extend((path, start, min(start + chunk_size, size)) for start in range(0, size, chunk_size))
+    return chunks
+
+
+def read_chunk(path, start, end):
+    """起点落在 [start, end) 里的所有完整行"""
+    with open(path, "rb") as f:
+        if start:
+            # 上一块会读完跨过边界的那一行；start 前一个字节恰好是换行时这一行属于本块
+            f.seek(start - 1)
+            f.readline()
+        begin = f.tell()
+        if begin >= end:
+            return b""
+        data = f.read(end - begin)
+        # 块尾恰好是换行时下一行整行属于下一块
+        return data if data.endswith(b"\n") else data + f.readline()
+
+
+def scan_function_names(chunk):
+    """工人进程：一块里出现过的函数名 (去重后的 bytes 集合)"""
+    return set(FUNCTION_CALL.findall(read_chunk(*chunk)))
+
+
+def map_chunks(path, worker, jobs=0, ordered=False):
+    """把 path 切块后交给 worker 并行处理，产出每块的结果 (ordered 时按块在文件里的顺序)；只有一块时不起进程池"""
+    chunks = split_chunks(trace_files(path))
+    if len(chunks) <= 1:
+        yield from map(worker, chunks)
+        return
+    jobs = min(jobs or os.cpu_count() or 1, len(chunks))
+    logger.info(f"🧵 trace 切成 {len(chunks)} 块，{jobs} 个进程并行扫描")
+    with multiprocessing.Pool(processes=jobs) as pool:
+        yield from (pool.imap if ordered else pool.imap_unordered)(worker, chunks)
+
+
+def collect_function_names(path, jobs=0):
+    names = set()
+    for chunk_names in map_chunks(path, scan_function_names, jobs):
+        names |= chunk_names
+    return {name.decode("ascii") for name in names}
+
+
+CPU_COLUMN = re.compile(rb'(\d+)\)')
+DURATION = re.compile(rb'(\d+\.\d+)\s*us')
+TAIL_NAME = re.compile(rb'/\*\s*([A-Za-z_][A-Za-z0-9_]*)')  # funcgraph-tail: "} /* do_sys_open */"
+
+
+def add_call(table, key, duration, self_time=None):
+    """函数: [次数, 总耗时, 自身耗时, 最大耗时]；边 (self_time 为 None): [次数, 总耗时, 最大耗时]"""
+    stat = table.get(key)
+    if stat is None:
+        table[key] = [1, duration, self_time, duration] if self_time is not None else [1, duration, duration]
+        return
+    stat[0] += 1
+    stat[1] += duration
+    if self_time is not None:
+        stat[2] += self_time
+    stat[-1] = max(stat[-1], duration)
+
+
+def merge_stats(into, other):
+    for key, stat in other.items():
+        mine = into.get(key)
+        if mine is None:
+            into[key] = list(stat)
+            continue
+        for i in range(len(stat) - 1):
+            mine[i] += stat[i]
+        mine[-1] = max(mine[-1], stat[-1])
+
+
+class CpuResidue:
+    """一块里某个 CPU 没法就地结算的部分"""
+    __slots__ = ("closes", "pending_child", "outer_edges", "stack")
+
+    def __init__(self):
+        self.closes = []  # 弹出的外层帧：[(耗时, 块内记到它名下的子调用耗时, funcgraph-tail 里的名字)]
+        self.pending_child = 0.0  # 块尾时当前外层帧 (序号 len(closes)) 名下的子调用耗时
+        self.outer_edges = {}  # (外层帧序号, 被调用者) -> 边统计
+        self.stack = []  # 块尾仍然打开的帧 [[名字, 子调用耗时]]，栈顶在最后
+
+
+def parse_graph_chunk(chunk):
+    """工人进程：一块 function_graph 日志 -> (函数统计, 边统计, {(文件, CPU): CpuResidue})，名字都是 bytes"""
+    path = chunk[0]
+    funcs, edges, cpus = {}, {}, {}
+    for line in read_chunk(*chunk).split(b"\n"):
+        bar = line.rfind(b"|")
+        if bar < 0:
+            continue
+        body = line[bar + 1:].strip()
+        if not body:
+            continue
+        head = line[:bar]
+        m = CPU_COLUMN.search(head)
+        cpu = (path, int(m.group(1)) if m else 0)
+        state = cpus.get(cpu)
+        if state is None:
+            state = cpus[cpu] = CpuResidue()
+        m = DURATION.search(head)
+        duration = float(m.group(1)) if m else None
+        stack = state.stack
+
+        if body.startswith(b"}"):
+            if stack:
+                name, child = stack.pop()
+                if duration is None:
+                    continue
+                add_call(funcs, name, duration, duration - child)
+                if stack:
+                    stack[-1][1] += duration
+                    add_call(edges, (stack[-1][0], name), duration)
+                else:
+                    state.pending_child += duration
+                    add_call(state.outer_edges, (len(state.closes), name), duration)
+            else:
+                m = TAIL_NAME.search(body)
+                state.closes.append((duration, state.pending_child, m.group(1) if m else None))
+                state.pending_child = 0.0
+            continue
+
+        paren = body.find(b"(")
+        if paren <= 0 or not (body.endswith(b"{") or body.endswith(b";")):
+            continue  # trace_printk 注释、中断进出标记之类
+        name = body[:paren].split(b".", 1)[0]
+        if body.endswith(b"{"):
+            stack.append([name, 0.0])
+        elif duration is not None:
+            add_call(funcs, name, duration, duration)
+            if stack:
+                stack[-1][1] += duration
+                add_call(edges, (stack[-1][0], name), duration)
+            else:
+                state.pending_child += duration
+                add_call(state.outer_edges, (len(state.closes), name), duration)
+    return funcs, edges, cpus
+
+
+def stitch_residue(stack, residue, funcs, edges):
+    """把一块的 CPU 残余接到这个 CPU 之前的栈 stack 上 (原地修改)，结算跨块的帧和边"""
+    def outer_name(k):
+        if k < len(stack):
+            return stack[-1 - k][0]
+        return residue.closes[k][2] if k < len(residue.closes) else None
+
+    for (k, callee), stat in residue.outer_edges.items():
+        caller = outer_name(k)
+        if caller is not None:
+            merge_stats(edges, {(caller, callee): stat})
+
+    for duration, child, tail in residue.closes:
+        if stack:
+            name, outer_child = stack.pop()
+            child += outer_child
+        else:
+            name = tail  # 栈在 trace 开头之前就打开了，只有 funcgraph-tail 才知道是谁
+        if name is None or duration is None:
+            continue
+        add_call(funcs, name, duration, duration - child)
+        if stack:
+            stack[-1][1] += duration
+            add_call(edges, (stack[-1][0], name), duration)
+    if stack:
+        stack[-1][1] += residue.pending_child
+    stack.extend(residue.stack)
+
+
+def collect_profile(path, jobs=0):
+    """
+    function_graph 日志 -> (函数统计 {名字: [次数, 总耗时, 自身耗时, 最大耗时]},
+                             边统计 {(调用者, 被调用者): [次数, 总耗时, 最大耗时]})，耗时单位 us
+    """
+    funcs, edges, stacks = {}, {}, {}
+    for chunk_funcs, chunk_edges, cpus in map_chunks(path, parse_graph_chunk, jobs, ordered=True):
+        merge_stats(funcs, chunk_funcs)
+        merge_stats(edges, chunk_edges)
+        for cpu, residue in cpus.items():
+            stitch_residue(stacks.setdefault(cpu, []), residue, funcs, edges)
+    return ({name.decode("utf-8", "replace"): stat for name, stat in funcs.items()},
+            {(a.decode("utf-8", "replace"), b.decode("utf-8", "replace")): stat for (a, b), stat in edges.items()})
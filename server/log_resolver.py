@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# 内核日志 -> 源码调用点的反查 (进程内)
+#
+# 索引时 PyClangd-Core 把 printk 家族每个调用点的格式串存进 logfmts 表。一行 dmesg 按两种方式定位：
+#   1. add_kernel_pl 增强过的日志带 [file:line] 前缀，文件名是调试信息里的 (通常相对编译目录)，按路径后缀对到库内路径；
+#   2. 普通日志按格式串模糊匹配：格式串按转换说明符切成字面量片段，日志正文里依次出现这些片段 (最后一段在结尾) 就算匹配，
+#      再挑它在所有格式串里最少见的一个单词 (这个词也很常见时取最少见的两个词) 做锚点建倒排表。日志行只需要拿自己的单词 (和词对) 查倒排表，
+#      只对少数候选做子串查找，不会每行扫一遍全部格式串；几十万个格式串也不用逐个编译正则。
+# 同一条消息在日志里往往重复成千上万次 (只是数值不同)，按把数字抹掉后的消息做记忆化，命中时直接复用，
+# 百万行的日志批量反查基本都落在缓存上。字面量本身带数字的格式串会让形状相同的两行结果不同，涉及它们的消息不记忆化。
+
+import os
+import re
+import itertools
+import collections
+
+# printf 转换说明符：%[标志][宽度][.精度][长度]转换，内核的 %pS / %pI4 / %*ph 这类扩展也算
+CONVERSION = re.compile(r'%(?:%|[-+ #0]*(?:\*|\d+)?(?:\.(?:\*|\d+))?(?:hh|ll|[hlLzZtjq])?(?:p[A-Za-z0-9]*|[diouxXcsfFeEgGaAn]))')
+WORD = re.compile(r'[A-Za-z_][A-Za-z0-9_]{2,}')
+# add_kernel_pl 插入的 "[drivers/foo/bar.c:123] "
+LOCATION = re.compile(r'\[([^\[\]\s:]+\.[A-Za-z]+):(\d+)\] ?')
+# dmesg / journalctl / 串口日志的行首：syslog 头 "... kernel: "、"<6>"、"[   12.345678]"、"[T123]" / "[C1]" 调用者 ID
+LINE_PREFIX = re.compile(r'^(?:.*?\bkernel: )?(?:<\d+>)?\s*(?:\[\s*\d+\.\d+\]\s*)?(?:\[\s*[TC]\d+\]\s*)?')
+DIGITS = re.compile(r'\d+')
+
+
+class LogFormat:
+    """一个格式串 (的一行) 和它的调用点"""
+    __slots__ = ("sites", "literals", "score")
+
+    def __init__(self, literals):
+        self.sites = []  # [(库内路径, 行, 列, 原始格式串)]，同一个格式串可能出现在很多地方
+        self.literals = literals  # 被转换说明符隔开的字面量片段
+        self.score = sum(len(s) for s in literals)  # 字面量越长匹配越可信
+
+    def match(self, message):
+        """message 已经去掉了行尾空白。每段字面量都取最靠前的出现位置，这样留给后面片段的空间最大"""
+        *head, tail = self.literals
+        if not message.endswith(tail):
+            return False
+        # 不锚定开头：dev_err / netdev_err 在格式串前面还会加 "驱动名 设备名: "
+        pos, limit = 0, len(message) - len(tail)
+        for literal in head:
+            pos = message.find(literal, pos, limit)
+            if pos < 0:
+                return False
+            pos += len(literal)
+        return True
+
+
+class LogResolver:
+    MEMO_SIZE = 1 << 18  # 记忆化的不同消息形状条数上限，满了整体清空
+    COMMON_WORD = 16  # 出现在超过这么多个格式串里的单词不单独做锚点
+
+    def __init__(self, rows, known_files):
+        """
+        rows: logfmts 表的 [(库内路径, 行, 列, 格式串)]；known_files: 库里所有文件的库内路径，
+        给 [file:line] 前缀做后缀匹配 (没有格式串的旧库也能按前缀跳转)
+        """
+        self._by_site = {}  # (库内路径, 行) -> [site]
+        formats = {}  # 一行格式串 -> LogFormat
+        for file_path, line, col, fmt in rows:
+            site = (file_path, line, col, fmt)
+            self._by_site.setdefault((file_path, line), []).append(site)
+            # 格式串里的 \n 会把一次 printk 拆成几行日志，每一行单独匹配
+            for piece in (fmt or "").split("\n"):
+                literals = LogResolver.split_format(piece)
+                if literals is None:
+                    continue
+                key = tuple(literals)
+                if key not in formats:
+                    formats[key] = LogFormat(literals)
+                formats[key].sites.append(site)
+
+        # 锚点：格式串里最少见的单词。只取两侧都不紧挨转换说明符的单词，"dev%d" 里的 dev 在日志里是 "dev0"。
+        # "failed" / "error" 这种词做锚点时一个桶里有上千个格式串，这时改用最少见的两个词组成的词对
+        words = {fmt: LogResolver.anchor_words(fmt.literals) for fmt in formats.values()}
+        df = collections.Counter(w for ws in words.values() for w in ws)
+        self._buckets = {}  # 锚点 (单词或按字母序的词对) -> [LogFormat]
+        for fmt, ws in words.items():
+            if not ws:
+                continue  # 没有锚点的格式串 (比如 "%s: %d") 太宽泛，不参与模糊匹配
+            rarest = sorted(ws, key=lambda w: (df[w], -len(w)))[:2]
+            anchor = rarest[0] if len(rarest) == 1 or df[rarest[0]] <= LogResolver.COMMON_WORD else tuple(sorted(rarest))
+            self._buckets.setdefault(anchor, []).append(fmt)
+        for bucket in self._buckets.values():
+            bucket.sort(key=lambda fmt: -fmt.score)  # 桶内按可信度从高到低，找到匹配后剩下的不用再看
+        self._vocabulary = set(df)  # 日志里不在任何格式串中的单词 (数值、设备名) 先滤掉，少拼词对
+        # 字面量里带数字的格式串 ("EXT4-fs"、"rate 100 Hz") 对数字抹掉后形状相同的两行可能一行匹配、一行不匹配，
+        # 碰到挂着它们的锚点 (或者形状相同的带数字单词) 的消息不做记忆化
+        self._digit_anchors = {anchor for anchor, bucket in self._buckets.items()
+                               if any(DIGITS.search(s) for fmt in bucket for s in fmt.literals)}
+        self._digit_word_shapes = {DIGITS.sub("0", w) for w in self._vocabulary if DIGITS.search(w)}
+
+        self._by_basename = {}  # 文件名 -> [库内路径]
+        for file_path in known_files:
+            self._by_basename.setdefault(os.path.basename(file_path), []).append(file_path)
+        self._path_memo = {}
+        self._memo = {}
+        self.formats = len(formats)
+
+    @staticmethod
+    def split_format(fmt):
+        """格式串拆成字面量片段 (%% 还原成 %)，全是空白的格式串返回 None"""
+        fmt = fmt.strip()
+        if not fmt:
+            return None
+        literals, pos = [""], 0
+        for m in CONVERSION.finditer(fmt):
+            literals[-1] += fmt[pos:m.start()]
+            if m.group() == "%%":
+                literals[-1] += "%"
+            else:
+                literals.append("")
+            pos = m.end()
+        literals[-1] += fmt[pos:]
+        return literals
+
+    @staticmethod
+    def anchor_words(literals):
+        words = set()
+        last = len(literals) - 1
+        for i, chunk in enumerate(literals):
+            for m in WORD.finditer(chunk):
+                if (m.start() > 0 or i == 0) and (m.end() < len(chunk) or i == last):
+                    words.add(m.group())
+        return words
+
+    def resolve_path(self, name):
+        """调试信息里的文件名 -> 库内路径：先原样 (去掉 ./ ../)，再按路径后缀匹配，同名多个时取最短的"""
+        if name in self._path_memo:
+            return self._path_memo[name]
+        rel = name
+        while rel.startswith(("./", "../")):
+            rel = rel.split("/", 1)[1]
+        candidates = self._by_basename.get(os.path.basename(rel), [])
+        if rel in candidates:
+            found = rel
+        else:
+            found = min((p for p in candidates if p.endswith("/" + rel) or rel.endswith("/" + p)), key=len, default=None)
+        self._path_memo[name] = found
+        return found
+
+    def resolve(self, line):
+        """
+        一行日志 -> (方式, [(库内路径, 行, 列, 格式串)])，方式是 'location' / 'format'；定位不到返回 None。
+        按格式串匹配时同样可信的调用点 (同一个格式串复制在好几个驱动里) 会全部返回
+        """
+        message = LINE_PREFIX.sub("", line.rstrip(), count=1)
+        located = self._resolve_location(message)
+        if located:
+            return located
+        shape = DIGITS.sub("0", message)
+        matched = self._memo.get(shape)
+        if matched is None:
+            matched, exact = self._resolve_format(message)
+            if exact:
+                if len(self._memo) >= LogResolver.MEMO_SIZE:
+                    self._memo.clear()
+                self._memo[shape] = matched
+        return ("format", [site for fmt in matched for site in fmt.sites]) if matched else None
+
+    def resolve_lines(self, lines):
+        """批量反查，逐行产出 resolve 的结果 (生成器，可以直接喂打开的日志文件)"""
+        resolve = self.resolve
+        for line in lines:
+            yield resolve(line)
+
+    def _resolve_location(self, message):
+        m = LOCATION.search(message)
+        if not m:
+            return None
+        file_path = self.resolve_path(m.group(1))
+        if not file_path:
+            return None
+        line = int(m.group(2))
+        return "location", self._by_site.get((file_path, line)) or [(file_path, line, 1, None)]
+
+    def _resolve_format(self, message):
+        """
+        (同样可信的匹配格式串列表, 结果能否按数字抹掉后的形状记忆化)。
+        只有字面量不带数字的格式串参与时，数字不同的两行匹配结果一定相同
+        """
+        best, best_score = [], 0
+        buckets = self._buckets
+        all_words = WORD.findall(message)
+        exact = not any(DIGITS.search(w) and DIGITS.sub("0", w) in self._digit_word_shapes for w in all_words)
+        # 每个格式串只挂在一个锚点下，单词去重后候选就不会重复
+        words = sorted(self._vocabulary.intersection(all_words))
+        for anchor in itertools.chain(words, itertools.combinations(words, 2)):
+            if anchor in self._digit_anchors:
+                exact = False
+            for fmt in buckets.get(anchor, ()):
+                if fmt.score < best_score:
+                    break
+                if not fmt.match(message):
+                    continue
+                if fmt.score > best_score:
+                    best, best_score = [fmt], fmt.score
+                else:
+                    best.append(fmt)
+        return best, exact
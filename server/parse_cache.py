@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# 按内容寻址的单编译单元解析结果缓存 (相当于给索引用的 ccache)
+#
+# 目录结构:
+#   manifests/<ab>/<base_key>.json   base_key = hash(源文件相对路径, 源文件 md5, 清洗后的编译参数, 阶段, 核心程序版本)
+#                                    内容是若干候选: [{"headers": {头文件: md5}, "result": result_key}]
+#   results/<ab>/<result_key>.zlib   压缩后的 (symbols, includes)，路径全部是库内形式 (工作区相对路径)
+#
+# 头文件列表要解析之后才知道，所以和 ccache 的 direct mode 一样分两级：
+# 先用 base_key 找到候选，再逐个核对候选里记录的头文件 md5，全部一致才算命中。
+# 结果里的路径是相对工作区的，多个工作区 / worktree 可以共用同一个缓存目录。
+
+import os
+import json
+import zlib
+import hashlib
+import logging
+import tempfile
+import time
+
+logger = logging.getLogger("PyClangd")
+
+
+class ParseCache:
+    MAX_CANDIDATES = 8  # 每个 base_key 最多记住几种头文件状态 (例如在几个分支之间来回切换)
+    WORKSPACE_MARK = "${WORKSPACE}"
+    ORPHAN_GRACE = 60  # 秒，淘汰时不清理这么近写过的 manifest 和没人引用的结果 (可能正被别的进程写入)
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(self.cache_dir, "manifests"), exist_ok=True)
+        os.makedirs(os.path.join(self.cache_dir, "results"), exist_ok=True)
+
+    @staticmethod
+    def default_dir():
+        return os.environ.get("PYCLANGD_CACHE_DIR") or os.path.join(
+            os.path.expanduser("~"), ".cache", "pyclangd", "parse_cache")
+
+    def _path(self, kind, key, suffix):
+        return os.path.join(self.cache_dir, kind, key[:2], key + suffix)
+
+    def _write_atomic(self, path, data):
+        # 多个工人进程、多个工作区可能同时写同一个条目，先写临时文件再 rename
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def base_key(self, rel_source, source_md5, directory, args, phase, workspace_dir, core_id):
+        """工作区绝对路径在参数里替换成占位符，这样不同 worktree 的同一个文件能算出同一个 key"""
+        normalize = lambda s: s.replace(workspace_dir, ParseCache.WORKSPACE_MARK)
+        payload = json.dumps([rel_source, source_md5, normalize(directory), [normalize(a) for a in args], phase, core_id])
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def _load_manifest(self, base_key):
+        try:
+            with open(self._path("manifests", base_key, ".json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def lookup(self, base_key, header_md5):
+        """
+        命中返回 (symbols, includes)，否则返回 None。
+        header_md5(stored_path) 返回头文件当前的 md5，文件不存在时返回 None。
+        """
+        for candidate in self._load_manifest(base_key):
+            if all(header_md5(path) == md5 for path, md5 in candidate["headers"].items()):
+                result_path = self._path("results", candidate["result"], ".zlib")
+                try:
+                    with open(result_path, "rb") as f:
+                        symbols, includes = json.loads(zlib.decompress(f.read()))
+                    os.utime(result_path)  # mtime 充当最近使用时间，供 LRU 淘汰
+                    os.utime(self._path("manifests", base_key, ".json"))
+                except (OSError, ValueError, zlib.error):
+                    continue  # 结果已被淘汰或损坏，当作未命中
+                return [tuple(r) for r in symbols], [tuple(r) for r in includes]
+        return None
+
+    def store(self, base_key, headers, symbols, includes):
+        """headers: {头文件库内路径: md5}"""
+        data = zlib.compress(json.dumps([symbols, includes], separators=(",", ":")).encode("utf-8"))
+        result_key = hashlib.sha1(data).hexdigest()
+        result_path = self._path("results", result_key, ".zlib")
+        if os.path.exists(result_path):
+            os.utime(result_path)
+        else:
+            self._write_atomic(result_path, data)
+
+        candidates = [c for c in self._load_manifest(base_key) if c["headers"] != headers]
+        candidates.insert(0, {"headers": headers, "result": result_key})
+        manifest = json.dumps(candidates[:ParseCache.MAX_CANDIDATES]).encode("utf-8")
+        self._write_atomic(self._path("manifests", base_key, ".json"), manifest)
+
+    def _scan(self, kind):
+        """[(mtime, 大小, 路径)]，mtime 充当最近使用时间"""
+        entries = []
+        for root, _, names in os.walk(os.path.join(self.cache_dir, kind)):
+            for name in names:
+                if name.startswith(".tmp-"):
+                    continue  # 别的进程正在写
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def evict(self):
+        """
+        manifests 和 results 一起计入 max_bytes，超出时两者混在一起按最近使用时间淘汰 (命中时两者都会刷新 mtime)。
+        淘汰后清理 manifest：去掉指向已删除结果的候选，候选全部失效的 manifest 整个删掉，
+        没有 manifest 指向的结果也一并删掉。返回释放的字节数。
+        """
+        started = time.time()
+        results = self._scan("results")
+        manifests = self._scan("manifests")
+        total = sum(size for _, size, _ in results) + sum(size for _, size, _ in manifests)
+        if total <= self.max_bytes:
+            return 0
+
+        freed = 0
+        removed = set()
+        for _, size, path in sorted(results + manifests):
+            if total - freed <= self.max_bytes:
+                break
+            if self._remove(path):
+                freed += size
+                removed.add(path)
+        live_results = {os.path.basename(path)[:-len(".zlib")]: (mtime, size, path)
+                        for mtime, size, path in results if path not in removed}
+
+        referenced = set()
+        for mtime, size, path in manifests:
+            if path in removed:
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    candidates = json.load(f)
+            except (OSError, ValueError):
+                candidates = []
+            if mtime >= started - ParseCache.ORPHAN_GRACE:
+                # 扫描之后别的进程可能刚写了新结果，最近写过的 manifest 不动
+                referenced.update(c.get("result") for c in candidates)
+                continue
+            alive = [c for c in candidates if c.get("result") in live_results]
+            if not alive:
+                if self._remove(path):
+                    freed += size
+                continue
+            if len(alive) != len(candidates):
+                data = json.dumps(alive).encode("utf-8")
+                self._write_atomic(path, data)
+                os.utime(path, (mtime, mtime))  # 重写不算使用
+                freed += size - len(data)
+                size = len(data)
+            referenced.update(c["result"] for c in alive)
+
+        for key, (mtime, size, path) in live_results.items():
+            # 刚写好、还没来得及写 manifest 的结果不算孤儿
+            if key not in referenced and mtime < started - ParseCache.ORPHAN_GRACE and self._remove(path):
+                freed += size
+
+        logger.info(f"🧹 解析缓存淘汰 {freed / 1048576:.1f} MB，剩余 {(total - freed) / 1048576:.1f} MB")
+        return freed
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# 宏展开服务用的预处理结果缓存 (进程内)
+#
+# 展开一行宏需要整个编译单元的预处理结果 (clang -E)，内核里一次要几百毫秒到几秒。
+# 这里按编译单元缓存预处理输出，并把输出里的行号标记 (# N "file" flags) 整理成
+#   文件 -> 有序的段 [(源文件起始行, 输出起始行, 行数)]
+# 查某个文件某一行的展开结果只是一次二分查找；同一个文件里连续展开多处宏只预处理一次。
+# 依赖的每个文件 (主文件 + 预处理时实际打开的头文件) 都记下内容 md5，任何一个变了整条作废。
+
+import os
+import re
+import bisect
+import logging
+import collections
+
+logger = logging.getLogger("PyClangd")
+
+
+class PreprocessedTU:
+    """一次预处理的输出 + 行号映射"""
+    LINE_MARKER = re.compile(r'^#\s+(\d+)\s+"((?:[^"\\]|\\.)*)"')
+    VIRTUAL_FILES = ("<built-in>", "<command line>", "<scratch space>")
+
+    def __init__(self, text, directory):
+        self.lines = text.split("\n")
+        self._starts = {}  # 文件 -> [段起始源行号]，与 _segments 一一对应，供 bisect 使用
+        self._segments = {}  # 文件 -> [(源行号, 输出行号, 行数)]
+        real_paths = {}  # 行号标记里的原始路径 -> 规范化后的绝对路径
+
+        def close(file, src_line, out_start, out_end):
+            if file and out_end > out_start:
+                self._segments.setdefault(file, []).append((src_line, out_start, out_end - out_start))
+
+        file, src_line, out_start = None, 0, 0
+        for i, line in enumerate(self.lines):
+            m = PreprocessedTU.LINE_MARKER.match(line) if line.startswith("#") else None
+            if not m:
+                continue
+            close(file, src_line, out_start, i)
+            raw = m.group(2).encode("utf-8").decode("unicode_escape")
+            if raw not in real_paths:
+                real_paths[raw] = None if raw in PreprocessedTU.VIRTUAL_FILES else \
+                    os.path.realpath(os.path.join(directory, raw))
+            file, src_line, out_start = real_paths[raw], int(m.group(1)), i + 1
+        close(file, src_line, out_start, len(self.lines))
+
+        for file, segments in self._segments.items():
+            segments.sort()
+            self._starts[file] = [s[0] for s in segments]
+
+    @property
+    def files(self):
+        return self._segments.keys()
+
+    def expansion(self, file_path, line, end_line=None):
+        """
+        file_path 第 line 行 (1 起始) 到 end_line 行预处理后的内容，这个文件没有参与预处理或该行被条件编译掉时返回 None。
+        跨行的宏调用整段展开在第一行的输出里，后面几行的输出是空行或者调用之后剩下的代码，一起取出来去掉空行
+        """
+        out = []
+        for n in range(line, (end_line or line) + 1):
+            text = self._output_line(file_path, n)
+            if text is None:
+                if n == line:
+                    return None
+                continue
+            if text:
+                out.append(text)
+        return "\n".join(out)
+
+    def _output_line(self, file_path, line):
+        starts = self._starts.get(file_path)
+        if not starts:
+            return None
+        i = bisect.bisect_right(starts, line) - 1
+        if i < 0:
+            return None
+        src_line, out_line, count = self._segments[file_path][i]
+        if line >= src_line + count:
+            return None
+        return self.lines[out_line + line - src_line].strip()
+
+
+def invocation_end(source_lines, line, max_lines=200):
+    """
+    从第 line 行 (1 起始) 开始的宏调用延续到第几行：括号没配平或者行尾是续行符 \\ 就接着往下数，
+    跳过字符串、字符字面量和注释里的括号
+    """
+    depth, in_block_comment = 0, False
+    last = min(len(source_lines), line + max_lines - 1)
+    for n in range(line, last + 1):
+        text = source_lines[n - 1].rstrip("\n")
+        i, quote = 0, None
+        while i < len(text):
+            c = text[i]
+            if in_block_comment:
+                if text.startswith("*/", i):
+                    in_block_comment = False
+                    i += 1
+            elif quote:
+                if c == "\\":
+                    i += 1
+                elif c == quote:
+                    quote = None
+            elif text.startswith("//", i):
+                break
+            elif text.startswith("/*", i):
+                in_block_comment = True
+                i += 1
+            elif c in "\"'":
+                quote = c
+            elif c == "(":
+                depth += 1
+            elif c == ")":
+                depth -= 1
+            i += 1
+        if (depth <= 0 and not in_block_comment) and not text.endswith("\\"):
+            return n
+    return last
+
+
+class PreprocessCache:
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries  # 一个内核编译单元的预处理输出有几 MB，只留最近用过的几个
+        self._entries = collections.OrderedDict()  # (编译单元, 目录, 编译参数) -> (依赖文件 {路径: md5}, PreprocessedTU)
+
+    def get(self, source_file, directory, args, run, file_md5):
+        """
+        取编译单元 source_file 按编译参数 args 的预处理结果。run() 执行预处理并返回输出文本 (失败返回 None)，
+        file_md5(path) 返回文件当前内容的 md5。参数相同且依赖文件全部没变时直接复用上一次的结果
+        (compile_commands.json 重新生成后参数变了，-D / -I 不同，结果也不同)。
+        """
+        key = (source_file, directory, tuple(args))
+        entry = self._entries.get(key)
+        if entry and all(file_md5(path) == md5 for path, md5 in entry[0].items()):
+            self._entries.move_to_end(key)
+            return entry[1]
+
+        text = run()
+        if text is None:
+            return None
+        tu = PreprocessedTU(text, directory)
+        deps = {path: file_md5(path) for path in tu.files}
+        self._entries[key] = (deps, tu)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        logger.info(f"🧩 预处理完成: {source_file} ({len(tu.lines)} 行输出，依赖 {len(deps)} 个文件)")
+        return tu
+
+    def clear(self):
+        self._entries.clear()
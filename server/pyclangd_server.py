@@ -6,6 +6,12 @@ import multiprocessing
 import json
 import argparse
 import shlex
+import time
+import uuid
+import asyncio
+import collections
+import functools
+import itertools
 
 # 日志定向到 stderr，VS Code 才能在输出窗口显示
 logging.basicConfig(level=logging.WARNING,
@@ -22,38 +28,62 @@ try:
     from pygls.server import LanguageServer
     from lsprotocol.types import (
         # LSP Features & Commands
+        CALL_HIERARCHY_INCOMING_CALLS,
+        CALL_HIERARCHY_OUTGOING_CALLS,
         TEXT_DOCUMENT_CODE_ACTION,
         TEXT_DOCUMENT_DEFINITION,
+        TEXT_DOCUMENT_DID_CLOSE,
+        TEXT_DOCUMENT_DID_OPEN,
         TEXT_DOCUMENT_DID_SAVE,
         TEXT_DOCUMENT_DOCUMENT_SYMBOL,
+        TEXT_DOCUMENT_HOVER,
+        TEXT_DOCUMENT_IMPLEMENTATION,
+        TEXT_DOCUMENT_PREPARE_CALL_HIERARCHY,
+        INITIALIZED,
         TEXT_DOCUMENT_REFERENCES,
+        TEXT_DOCUMENT_SEMANTIC_TOKENS_FULL,
+        TEXT_DOCUMENT_SEMANTIC_TOKENS_FULL_DELTA,
         WORKSPACE_EXECUTE_COMMAND,
         WORKSPACE_SYMBOL,
 
         # LSP Types & Classes
         ApplyWorkspaceEditParams,
+        CallHierarchyIncomingCall,
+        CallHierarchyItem,
+        CallHierarchyOutgoingCall,
         CodeAction,
         CodeActionKind,
         CodeActionParams,
         Command,
         DocumentSymbol,
         ExecuteCommandParams,
+        Hover,
         Location,
+        MarkupContent,
+        MarkupKind,
         MessageType,
         OptionalVersionedTextDocumentIdentifier,
         Position,
         Range,
+        SemanticTokens,
+        SemanticTokensDelta,
+        SemanticTokensEdit,
+        SemanticTokensLegend,
         SymbolInformation,
         SymbolKind,
         TextDocumentEdit,
         TextEdit,
         WorkspaceEdit,
+        WorkDoneProgressBegin,
+        WorkDoneProgressEnd,
+        WorkDoneProgressReport,
     )
 except ImportError as e:
     print(f"Error: 缺少基础库 {e}, 请执行 pip install pygls lsprotocol", file=sys.stderr)
     sys.exit(1)
 
-from database import Database
+from database import Database, IndexQueue, IndexProfile
+from snapshot_store import SnapshotStore
 from cindex import Index, Cursor, CursorKind, Config
 import clang_init
 
@@ -63,42 +93,287 @@ import typing
 
 # 在 PyClangdServer 初始化时，存一下命令字典，方便单文件查询
 class PyClangdServer(LanguageServer):
+    SLOW_QUERY_SECONDS = 0.3  # 查询超过这个耗时，认为后台索引在抢资源
+    INDEX_BACKOFF_SECONDS = 3.0  # 出现慢查询后，暂停派发新索引任务的时间
+    INDEX_NICE = 10  # 后台索引工人进程的 nice 增量
+    PROGRESS_INTERVAL = 0.5  # 进度通知的最小间隔，避免刷屏
+    SEMANTIC_TOKENS_CACHE_SIZE = 64  # 记住最近多少个文件的着色结果 (算增量用)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.db: typing.Optional[Database] = None
+        self.background_index = True
+        self.index_jobs = 0
+        self._index_thread: typing.Optional[threading.Thread] = None
+        self._last_slow_query = 0.0
+        self._last_progress = 0.0
+        self.index_queue = IndexQueue()
+        self.open_files: typing.Set[str] = set()
+        # uri -> (result_id, data)，上一次发给客户端的着色，算增量用；关闭文件时删掉，最多留 SEMANTIC_TOKENS_CACHE_SIZE 个
+        self.semantic_tokens: typing.Dict[str, tuple] = collections.OrderedDict()
+        self._result_seq = itertools.count(1)
+
+    def remember_semantic_tokens(self, uri, md5, data):
+        """记下这次的着色结果，返回 result_id：已入库的文件直接用内容哈希，还没入库的用流水号"""
+        result_id = md5 or f"seq-{next(self._result_seq)}"
+        self.semantic_tokens[uri] = (result_id, data)
+        self.semantic_tokens.move_to_end(uri)
+        while len(self.semantic_tokens) > PyClangdServer.SEMANTIC_TOKENS_CACHE_SIZE:
+            self.semantic_tokens.popitem(last=False)
+        return result_id
+
+    def check_db_swapped(self):
+        """
+        影子库重建完成后正式库会被整体替换，发现后重新打开连接并丢弃缓存。
+        正式库还开着时重建进程不会替换，只留下就绪标记：后台索引没在跑时 (它自己也开着正式库) 由这里关掉连接再替换
+        """
+        if not self.db:
+            return
+        index_running = self._index_thread is not None and self._index_thread.is_alive()
+        if (not index_running and self.db.adopt_ready_shadow()) or self.db.reopen_if_swapped():
+            Database._md5_memo.clear()
+            self.db._file_cache.clear()
+            logger.info("🔄 检测到索引库已被替换，已重新打开数据库连接")
+
+    def record_query_latency(self, elapsed):
+        if elapsed > self.SLOW_QUERY_SECONDS:
+            self._last_slow_query = time.time()
+
+    def index_throttle(self):
+        """后台索引派发任务前调用：最近有慢查询就先让路"""
+        while time.time() - self._last_slow_query < self.INDEX_BACKOFF_SECONDS:
+            time.sleep(0.2)
+
+    def prioritize_file(self, db, file_path):
+        """把打开的文件以及和它相关的编译单元提到索引队列前面"""
+        self.index_queue.bump(file_path, IndexQueue.PRIORITY_OPEN)
+        for priority, paths in db.related_index_files(file_path).items():
+            for path in paths:
+                self.index_queue.bump(path, priority)
+
+    def start_background_index(self):
+        if self._index_thread and self._index_thread.is_alive():
+            return
+        self._index_thread = threading.Thread(target=self._background_index_task, daemon=True)
+        self._index_thread.start()
+
+    def _background_index_task(self):
+        """在后台线程里跑完整的增量索引流水线，并通过 window/workDoneProgress 汇报进度"""
+        token = str(uuid.uuid4())
+        db = Database()
+        try:
+            asyncio.run_coroutine_threadsafe(self.progress.create_async(token), self.loop).result(timeout=10)
+        except Exception as e:
+            logger.warning(f"客户端不支持进度条: {e}")
+            token = None
+
+        self._send_progress(token, self.progress.begin, WorkDoneProgressBegin(title="PyClangd 索引", percentage=0))
+        jobs = self.index_jobs if self.index_jobs > 0 else max(1, (os.cpu_count() or 2) // 2)
+        db.commands_map = self.db.commands_map
+        try:
+            profile = db.load_index_profile()
+            db.run_index_mode(jobs,
+                              progress=functools.partial(self._report_index_progress, db, token),
+                              throttle=self.index_throttle,
+                              nice=self.INDEX_NICE,
+                              index_queue=self.index_queue,
+                              two_phase=True,
+                              profile=profile)
+        except Exception as e:
+            logger.exception(f"后台索引崩溃: {e}")
+        finally:
+            db.close()
+            self._send_progress(token, self.progress.end, WorkDoneProgressEnd(message="索引完成"))
+
+    def _report_index_progress(self, db, token, completed, total, elapsed, finished_file):
+        # 打开的文件刚建完索引：此时才知道它的调用者/被调用者在哪，再把这些文件往前提
+        if finished_file in self.open_files:
+            self.prioritize_file(db, finished_file)
+
+        now = time.time()
+        if completed < total and now - self._last_progress < self.PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        rate = completed / elapsed if elapsed > 0 else 0.0
+        eta = int((total - completed) / rate) if rate > 0 else 0
+        message = f"{completed}/{total} | {rate:.1f} 文件/秒 | 剩余 {eta // 60}:{eta % 60:02d}"
+        self._send_progress(token, self.progress.report,
+                            WorkDoneProgressReport(message=message, percentage=int(completed * 100 / total)))
+
+    def _send_progress(self, token, send, value):
+        # 进度通知从后台线程发出，必须切回事件循环线程
+        if token:
+            self.loop.call_soon_threadsafe(send, token, value)
 
 ls = PyClangdServer("pyclangd", "1.0.0")
 
+
+def timed_query(func):
+    """记录查询耗时，供后台索引判断是否需要让路"""
+    @functools.wraps(func)
+    def wrapper(server, params):
+        start = time.time()
+        if isinstance(server, PyClangdServer):
+            server.check_db_swapped()
+        try:
+            return func(server, params)
+        finally:
+            if isinstance(server, PyClangdServer):
+                server.record_query_latency(time.time() - start)
+    return wrapper
+
+
+@ls.feature(INITIALIZED)
+def lsp_initialized(server: PyClangdServer, params):
+    """客户端握手完成后，在后台启动索引"""
+    if server.background_index and server.db:
+        server.start_background_index()
+
+@ls.feature(TEXT_DOCUMENT_DID_OPEN)
+def lsp_did_open(server: PyClangdServer, params):
+    """打开文件时把它及相关文件提到后台索引队列的最前面"""
+    file_path = os.path.realpath(params.text_document.uri.replace("file://", ""))
+    server.open_files.add(file_path)
+    if server.db:
+        server.prioritize_file(server.db, file_path)
+
+
+@ls.feature(TEXT_DOCUMENT_DID_CLOSE)
+def lsp_did_close(server: PyClangdServer, params):
+    """关闭文件后不再优先索引它，上一次的着色也用不上了"""
+    uri = params.text_document.uri
+    server.open_files.discard(os.path.realpath(uri.replace("file://", "")))
+    server.semantic_tokens.pop(uri, None)
+
+
 @ls.feature(TEXT_DOCUMENT_DID_SAVE)
 def lsp_did_save(server: PyClangdServer, params):
     """当 VS Code 里按下 Ctrl+S，触发单文件增量更新"""
     file_path = os.path.realpath(params.text_document.uri.replace("file://", ""))
     # 进行数据库更新动作
+    server.check_db_swapped()
     server.db.lsp_did_save_db(file_path)
 
 
+@ls.feature(TEXT_DOCUMENT_CODE_ACTION)
+@timed_query
+def lsp_code_action(server: PyClangdServer, params: CodeActionParams):
+    """光标在宏上时提供 "展开宏"，真正的展开放到命令里做 (要跑一次预处理)，列出 Code Action 本身只查索引"""
+    if not server.db:
+        return []
+    uri = params.text_document.uri
+    file_path = os.path.realpath(uri.replace("file://", ""))
+    line = params.range.start.line + 1
+    if server.db.lsp_code_action_db(file_path, line, params.range.start.character + 1) != "expand_macro":
+        return []
+    title = "PyClangd: 展开本行的宏"
+    return [CodeAction(title=title, kind=CodeActionKind.RefactorInline,
+                       command=Command(title=title, command="pyclangd.expand_macro", arguments=[{"uri": uri, "line": line}]))]
+
+
+@ls.command("pyclangd.expand_macro")
+def handle_expand_macro(server: PyClangdServer, params: ExecuteCommandParams):
+    """把宏调用所在的几行替换成预处理后的代码：参数 {uri, line} (line 从 1 开始)，调用跨多行时整段替换"""
+    server.check_db_swapped()
+    args = params[0]
+    uri, line = args.get("uri"), args.get("line")
+    result = server.db.expand_macro_line_db(os.path.realpath(uri.replace("file://", "")), line)
+    if result is None:
+        return {"error": "预处理失败，或者这一行被条件编译掉了"}
+    end_line, text = result
+    edit = TextEdit(range=Range(start=Position(line=line-1, character=0), end=Position(line=end_line, character=0)),
+                    new_text=text + "\n")
+    server.apply_edit(WorkspaceEdit(document_changes=[TextDocumentEdit(
+        text_document=OptionalVersionedTextDocumentIdentifier(uri=uri, version=None), edits=[edit])]))
+    return {"status": "success", "data": text}
+
+
+# 大纲里的符号种类：PyClangd-Core 的 kind 去掉 DEF_ 前缀后是 clang 的 DeclKindName
+OUTLINE_SYMBOL_KINDS = {
+    "Function": SymbolKind.Function,
+    "FunctionTemplate": SymbolKind.Function,
+    "CXXMethod": SymbolKind.Method,
+    "CXXConversion": SymbolKind.Method,
+    "CXXConstructor": SymbolKind.Constructor,
+    "CXXDestructor": SymbolKind.Method,
+    "Var": SymbolKind.Variable,
+    "Field": SymbolKind.Field,
+    "IndirectField": SymbolKind.Field,
+    "Record": SymbolKind.Struct,
+    "CXXRecord": SymbolKind.Class,
+    "ClassTemplate": SymbolKind.Class,
+    "Enum": SymbolKind.Enum,
+    "EnumConstant": SymbolKind.EnumMember,
+    "Typedef": SymbolKind.Class,
+    "TypeAlias": SymbolKind.Class,
+    "Namespace": SymbolKind.Namespace,
+}
+
+
+def to_document_symbol(node):
+    name, kind, (sl, sc, el, ec), (nsl, nsc, nel, nec), children = node
+    kind = SymbolKind.Constant if kind.startswith("MACRO") else OUTLINE_SYMBOL_KINDS.get(kind.partition("_")[2], SymbolKind.Field)
+    return DocumentSymbol(
+        name=name, kind=kind,
+        range=Range(start=Position(line=sl-1, character=sc-1), end=Position(line=el-1, character=ec-1)),
+        selection_range=Range(start=Position(line=nsl-1, character=nsc-1), end=Position(line=nel-1, character=nec-1)),
+        children=[to_document_symbol(c) for c in children])
+
+
 @ls.feature(TEXT_DOCUMENT_DOCUMENT_SYMBOL)
+@timed_query
 def lsp_document_symbols(server: PyClangdServer, params):
-    """大纲视图：从数据库秒级查询"""
+    """大纲视图：按索引里的定义范围嵌套 (结构体里的成员等)，整棵树按文件缓存"""
     file_path = os.path.realpath(params.text_document.uri.replace("file://", ""))
-    symbols = []
-    if server.db:
-        for name, kind_id, sl, sc, el, ec in server.db.lsp_document_symbols_db(file_path):
-            kind_map = {
-                "FUNCTION_DECL": SymbolKind.Function, 
-                "VAR_DECL": SymbolKind.Variable,
-                "MACRO_DEFINITION": SymbolKind.Constant,
-                "STRUCT_DECL": SymbolKind.Struct,
-                "FIELD_DECL": SymbolKind.Field,
-                "TYPEDEF_DECL": SymbolKind.Class
-            }
-            kind = kind_map.get(kind_id, SymbolKind.Field)
-            
-            rng = Range(start=Position(line=sl-1, character=sc-1), end=Position(line=el-1, character=ec-1))
-            symbols.append(DocumentSymbol(name=name, kind=kind, range=rng, selection_range=rng, children=[]))
-    return symbols
+    if not server.db:
+        return []
+    return [to_document_symbol(node) for node in server.db.lsp_document_symbols_db(file_path)]
+
+SEMANTIC_TOKENS_LEGEND = SemanticTokensLegend(token_types=Database.SEMANTIC_TOKEN_TYPES,
+                                              token_modifiers=Database.SEMANTIC_TOKEN_MODIFIERS)
+
+
+def semantic_tokens_edit(old, new):
+    """两次着色之间只改了一处时，去掉公共前后缀剩下的就是那一处：返回 (起点, 删除个数, 插入的数据)"""
+    start = 0
+    limit = min(len(old), len(new))
+    while start < limit and old[start] == new[start]:
+        start += 1
+    end = 0
+    while end < limit - start and old[-1 - end] == new[-1 - end]:
+        end += 1
+    return start, len(old) - start - end, new[start:len(new) - end]
+
+
+@ls.feature(TEXT_DOCUMENT_SEMANTIC_TOKENS_FULL, SEMANTIC_TOKENS_LEGEND)
+@timed_query
+def lsp_semantic_tokens_full(server: PyClangdServer, params):
+    """语义着色：由索引里该文件的 def / ref 行直接编码 (宏和函数区分得开)，不重新解析"""
+    uri = params.text_document.uri
+    if not server.db:
+        return None
+    md5, data = server.db.semantic_tokens_db(os.path.realpath(uri.replace("file://", "")))
+    return SemanticTokens(data=data, result_id=server.remember_semantic_tokens(uri, md5, data))
+
+
+@ls.feature(TEXT_DOCUMENT_SEMANTIC_TOKENS_FULL_DELTA, SEMANTIC_TOKENS_LEGEND)
+@timed_query
+def lsp_semantic_tokens_delta(server: PyClangdServer, params):
+    """语义着色增量：客户端手里的版本还在时只回一处编辑，内容没变 (同一个哈希) 时回空编辑"""
+    uri = params.text_document.uri
+    if not server.db:
+        return None
+    previous = server.semantic_tokens.get(uri)
+    md5, data = server.db.semantic_tokens_db(os.path.realpath(uri.replace("file://", "")))
+    result_id = server.remember_semantic_tokens(uri, md5, data)
+    if not previous or previous[0] != params.previous_result_id:
+        return SemanticTokens(data=data, result_id=result_id)
+    start, delete_count, inserted = semantic_tokens_edit(previous[1], data)
+    edits = [SemanticTokensEdit(start=start, delete_count=delete_count, data=inserted)] if delete_count or inserted else []
+    return SemanticTokensDelta(edits=edits, result_id=result_id)
 
 @ls.feature(WORKSPACE_SYMBOL)
+@timed_query
 def lsp_workspace_symbols(server: PyClangdServer, params):
     """全局符号搜索：Ctrl+T"""
     if not server.db:
@@ -115,6 +390,7 @@ import re
 
 # 在 PyClangdServer 类中修改或添加定义跳转函数
 @ls.feature(TEXT_DOCUMENT_DEFINITION)
+@timed_query
 def lsp_definition(server: PyClangdServer, params):
     """跳转到定义：执行坐标精准匹配 (USR 级)"""
     uri = params.text_document.uri
@@ -152,6 +428,7 @@ def lsp_definition(server: PyClangdServer, params):
 
 
 @ls.feature(TEXT_DOCUMENT_REFERENCES)
+@timed_query
 def lsp_references(server: PyClangdServer, params):
     """查找引用：执行坐标精准匹配 (USR 级)"""
     uri = params.text_document.uri
@@ -182,17 +459,242 @@ def lsp_references(server: PyClangdServer, params):
         return []
 
 
+@ls.feature(TEXT_DOCUMENT_HOVER)
+@timed_query
+def lsp_hover(server: PyClangdServer, params):
+    """悬停：签名 / 宏定义和文档注释都是索引时预先算好的，这里只读一行"""
+    file_path = os.path.realpath(params.text_document.uri.replace("file://", ""))
+    if not server.db:
+        return None
+    try:
+        res = server.db.lsp_hover_db(file_path, params.position.line + 1, params.position.character + 1)
+        if not res:
+            return None
+        sig, doc, size = res
+        text = f"```c\n{sig}\n```"
+        if size:
+            text += f"\n\nsize: {size[0]}, align: {size[1]}"
+        if doc:
+            text += f"\n\n---\n{doc}"
+        return Hover(contents=MarkupContent(kind=MarkupKind.Markdown, value=text))
+
+    except Exception as e:
+        logger.exception(f"lsp_hover 崩溃: {e}")
+        return None
+
+
+@ls.feature(TEXT_DOCUMENT_IMPLEMENTATION)
+@timed_query
+def lsp_implementation(server: PyClangdServer, params):
+    """跳转到实现：函数指针成员 (file_operations.open 之类) -> 所有填进去的函数"""
+    file_path = os.path.realpath(params.text_document.uri.replace("file://", ""))
+    if not server.db:
+        return []
+    try:
+        results = server.db.lsp_implementation_db(file_path, params.position.line + 1, params.position.character + 1)
+        return [Location(
+            uri=f"file://{fp}",
+            range=Range(
+                start=Position(line=sl-1, character=sc-1),
+                end=Position(line=el-1, character=ec-1)
+            )
+        ) for fp, sl, sc, el, ec in results]
+
+    except Exception as e:
+        logger.exception(f"lsp_implementation 崩溃: {e}")
+        return []
+
+
+def to_call_item(sid, item, cost=None):
+    """
+    数据库里的调用图节点 -> CallHierarchyItem；64 位符号 ID 超出 JS 的安全整数范围，以字符串放进 data。
+    cost 是导入的 ftrace 里这条调用边的 (次数, 总耗时 us, 最大耗时 us)，显示在 detail 里
+    """
+    name, kind, fp, sl, sc, el, ec = item
+    rng = Range(start=Position(line=sl-1, character=sc-1), end=Position(line=el-1, character=ec-1))
+    detail = f"⏱ {cost[0]} 次, 共 {cost[1] / 1000:.3f} ms, 最长 {cost[2]:.1f} us" if cost else None
+    return CallHierarchyItem(name=name, kind=SymbolKind.Function, uri=f"file://{fp}", range=rng,
+                             selection_range=rng, detail=detail, data={"usr_id": str(sid)})
+
+
+def by_trace_cost(calls, costs):
+    """有 ftrace 耗时时调用者 / 被调用者按这条边的总耗时从高到低排"""
+    if costs:
+        calls.sort(key=lambda call: -costs.get(call[0], (0, 0.0))[1])
+    return calls
+
+
+def call_ranges(fp, sites):
+    """fromRanges 必须落在 fp (调用者所在文件) 里；宏展开出来的调用点可能写在头文件里，只能丢掉"""
+    return [Range(start=Position(line=sl-1, character=sc-1), end=Position(line=el-1, character=ec-1))
+            for f, sl, sc, el, ec in sites if f == fp]
+
+
+@ls.feature(TEXT_DOCUMENT_PREPARE_CALL_HIERARCHY)
+@timed_query
+def lsp_prepare_call_hierarchy(server: PyClangdServer, params):
+    """调用层级的根：光标处的函数"""
+    file_path = os.path.realpath(params.text_document.uri.replace("file://", ""))
+    if not server.db:
+        return None
+    items = server.db.lsp_prepare_call_hierarchy_db(file_path, params.position.line + 1, params.position.character + 1)
+    return [to_call_item(sid, item) for sid, item in items] or None
+
+
+@ls.feature(CALL_HIERARCHY_INCOMING_CALLS)
+@timed_query
+def lsp_incoming_calls(server: PyClangdServer, params):
+    """调用者：fromRanges 是调用者函数体里的调用点"""
+    if not server.db:
+        return None
+    sid = int(params.item.data["usr_id"])
+    costs = server.db.ftrace_edge_costs_db(sid, "incoming")
+    return [CallHierarchyIncomingCall(from_=to_call_item(caller, item, costs.get(caller)),
+                                      from_ranges=call_ranges(item[2], sites))
+            for caller, item, sites in by_trace_cost(server.db.lsp_incoming_calls_db(sid), costs)]
+
+
+@ls.feature(CALL_HIERARCHY_OUTGOING_CALLS)
+@timed_query
+def lsp_outgoing_calls(server: PyClangdServer, params):
+    """被调用者：fromRanges 是当前函数 (params.item) 里的调用点"""
+    if not server.db:
+        return None
+    sid = int(params.item.data["usr_id"])
+    own_file = os.path.realpath(params.item.uri.replace("file://", ""))
+    costs = server.db.ftrace_edge_costs_db(sid, "outgoing")
+    return [CallHierarchyOutgoingCall(to=to_call_item(callee, item, costs.get(callee)),
+                                      from_ranges=call_ranges(own_file, sites))
+            for callee, item, sites in by_trace_cost(server.db.lsp_outgoing_calls_db(sid), costs)]
+
+
 @ls.command("pyclangd.scoped_search")
 def handle_scoped_search(server: PyClangdServer, params: ExecuteCommandParams):
     # args 通常是一个列表，第一项是前端传过来的参数字典
     # 把任务转发给你 database.py 里的 lsp_execute_command_db
     logger.info(f"执行范围搜索: {params}")
-    return server.db.lsp_scoped_references_db(params[0].get("file_path"), params[0].get("line"), params[0].get("col"))
+    server.check_db_swapped()
+    return server.db.lsp_scoped_references_db(params[0].get("file_path"), params[0].get("line"), params[0].get("col"),
+                                              access=params[0].get("access"))
+
+@ls.command("pyclangd.filtered_references")
+def handle_filtered_references(server: PyClangdServer, params: ExecuteCommandParams):
+    """按访问方式过滤的查找引用：参数 {file_path, line, col, access: [read|write|rmw|call|addr|type]}"""
+    server.check_db_swapped()
+    args = params[0]
+    try:
+        refs = server.db.lsp_references_db(args.get("file_path"), args.get("line"), args.get("col"), args.get("access"))
+    except ValueError as e:
+        return {"error": str(e)}
+    return {"status": "success", "data": refs}
+
+@ls.command("pyclangd.index_status")
+def handle_index_status(server: PyClangdServer, params: ExecuteCommandParams):
+    """各索引阶段的源文件数量：defs_only 个文件还没有引用"""
+    server.check_db_swapped()
+    return server.db.index_status()
+
+@ls.command("pyclangd.reference_counts")
+def handle_reference_counts(server: PyClangdServer, params: ExecuteCommandParams):
+    """引用数：参数 {file_path[, line, col]}，不带坐标时返回文件里所有定义的引用数"""
+    server.check_db_swapped()
+    args = params[0]
+    rows = server.db.lsp_reference_counts_db(args.get("file_path"), args.get("line"), args.get("col"))
+    return {"status": "success", "data": [{"name": n, "line": sl, "col": sc, "references": c} for n, sl, sc, c in rows]}
+
+@ls.command("pyclangd.unreferenced")
+def handle_unreferenced(server: PyClangdServer, params: ExecuteCommandParams):
+    """零引用的定义：参数 {kinds: [function|variable|macro|field], include: [glob], exclude: [glob], limit}"""
+    server.check_db_swapped()
+    args = params[0] if params else {}
+    profile = None
+    if args.get("include") or args.get("exclude"):
+        profile = IndexProfile(args.get("include", []), args.get("exclude", []))
+    rows = itertools.islice(server.db.iter_unreferenced_defs(args.get("kinds"), profile), args.get("limit", 1000))
+    return {"status": "success",
+            "data": [{"file": fp, "line": sl, "col": sc, "kind": kind, "name": name} for fp, sl, sc, kind, name in rows]}
+
+@ls.command("pyclangd.call_graph")
+def handle_call_graph(server: PyClangdServer, params: ExecuteCommandParams):
+    """多跳调用图：参数 {file_path, line, col, direction: incoming|outgoing, depth, limit}，给前端画图用"""
+    server.check_db_swapped()
+    args = params[0]
+    roots = server.db.lsp_prepare_call_hierarchy_db(args.get("file_path"), args.get("line"), args.get("col"))
+    if not roots:
+        return {"error": "光标处不是已索引的函数"}
+    nodes, edges = server.db.call_graph_db([sid for sid, _ in roots], args.get("direction", "incoming"),
+                                           args.get("depth", 3), args.get("limit", 5000))
+    return {"status": "success",
+            "nodes": [{"id": str(sid), "name": item[0], "file": item[2], "line": item[3], "col": item[4], "depth": level}
+                      for sid, (level, item) in nodes.items()],
+            "edges": [{"from": str(a), "to": str(b), "sites": n} for a, b, n in edges]}
+
+@ls.command("pyclangd.struct_layout")
+def handle_struct_layout(server: PyClangdServer, params: ExecuteCommandParams):
+    """结构体布局 (pahole 式)：参数 {file_path, line, col} 或 {name}，同一个结构体在不同位置有多份定义时都返回"""
+    server.check_db_swapped()
+    args = params[0]
+    rows = server.db.struct_layout_db(args.get("file_path"), args.get("line"), args.get("col"), args.get("name"))
+    if not rows:
+        return {"error": "没有找到已索引的结构体布局"}
+    return {"status": "success", "data": [dict(name=n, file=fp, line=sl, **layout) for n, fp, sl, layout in rows]}
+
+@ls.command("pyclangd.resolve_log")
+def handle_resolve_log(server: PyClangdServer, params: ExecuteCommandParams):
+    """日志反查源码：参数 {lines: [日志行]} 逐行返回调用点；或 {log_file, output} 把整个日志的结果写成 TSV，只返回统计"""
+    server.check_db_swapped()
+    args = params[0]
+    if args.get("log_file"):
+        if not args.get("output"):
+            return {"error": "批量反查需要指定 output"}
+        with open(args["output"], "w", encoding="utf-8") as out:
+            total, resolved = server.db.resolve_log_file_db(args["log_file"], out)
+        return {"status": "success", "lines": total, "resolved": resolved, "output": args["output"]}
+    return {"status": "success",
+            "data": [res and {"method": res[0], "sites": [{"file": fp, "line": sl, "col": sc, "format": fmt}
+                                                          for fp, sl, sc, fmt in res[1]]}
+                     for res in server.db.resolve_log_lines_db(args.get("lines", []))]}
+
+@ls.command("pyclangd.import_ftrace_profile")
+def handle_import_ftrace_profile(server: PyClangdServer, params: ExecuteCommandParams):
+    """导入 function_graph 日志的耗时：参数 {file_path[, jobs]}，替换上一次导入的结果"""
+    server.check_db_swapped()
+    args = params[0]
+    stats = server.db.import_ftrace_profile(args.get("file_path"), args.get("jobs", 0))
+    if stats is None:
+        return {"error": f"ftrace 文件不存在: {args.get('file_path')}"}
+    return {"status": "success", **stats}
+
+@ls.command("pyclangd.ftrace_hot_functions")
+def handle_ftrace_hot_functions(server: PyClangdServer, params: ExecuteCommandParams):
+    """trace 里最耗时的函数：参数 {order: self|total|max|calls, limit}"""
+    server.check_db_swapped()
+    args = params[0] if params else {}
+    try:
+        rows = server.db.ftrace_hot_functions_db(args.get("order", "self"), args.get("limit", 100))
+    except ValueError as e:
+        return {"error": str(e)}
+    return {"status": "success",
+            "data": [{"name": name, "file": fp, "line": sl, "col": sc, "calls": calls, "total_us": total,
+                      "self_us": self_us, "max_us": max_us}
+                     for name, fp, sl, sc, calls, total, self_us, max_us in rows]}
+
+@ls.command("pyclangd.ftrace_references")
+def handle_ftrace_references(server: PyClangdServer, params: ExecuteCommandParams):
+    """按 trace 耗时排序的引用：参数 {file_path, line, col}"""
+    server.check_db_swapped()
+    args = params[0]
+    rows = server.db.ftrace_ranked_references_db(args.get("file_path"), args.get("line"), args.get("col"))
+    return {"status": "success",
+            "data": [{"file": fp, "line": sl, "col": sc, "end_line": el, "end_col": ec, "function": fn,
+                      "calls": calls, "total_us": total}
+                     for fp, sl, sc, el, ec, fn, calls, total in rows]}
 
 @ls.command("pyclangd.generate_scope")
 def handle_generate_scope(server: PyClangdServer, params: ExecuteCommandParams):
     # 同样地，把任务转发给你的 database 处理中心
     logger.info(f"生成搜索范围文件: {params}")
+    server.check_db_swapped()
     return server.db.generate_ftrace_scope(params[0].get("file_path"))
 
 
@@ -201,15 +703,142 @@ def main():
     parser.add_argument("-d", "--directory")
     parser.add_argument("-s", "--server", action="store_true")
     parser.add_argument("-j", "--jobs", type=int, default=0)
+    parser.add_argument("--shard", help="只索引第 i 片 (共 N 片)，格式 i/N，i 从 1 开始")
+    parser.add_argument("-o", "--output", help="索引数据库路径，默认 <workspace>/pyclangd_index.db")
+    parser.add_argument("--no-background-index", action="store_true", help="服务器模式下不在后台自动建索引")
+    parser.add_argument("--two-phase", action="store_true", help="先跳过函数体只建定义，再补引用 (服务器后台索引默认开启)")
+    parser.add_argument("--include", action="append", default=[], metavar="GLOB", help="只索引匹配的文件 (相对工作区路径)，可多次指定")
+    parser.add_argument("--exclude", action="append", default=[], metavar="GLOB", help="跳过匹配的文件，可多次指定")
+    parser.add_argument("--scope", help="只索引范围文件 (如 .ftrace_scope.txt) 列出的文件及其包含闭包")
+    parser.add_argument("--profile", help="索引范围配置 JSON，缺省读取 <workspace>/.pyclangd_profile.json")
+    parser.add_argument("--cache-dir", help="解析结果缓存目录，可在多个工作区间共享 (默认 $PYCLANGD_CACHE_DIR 或 ~/.cache/pyclangd/parse_cache)")
+    parser.add_argument("--cache-size", type=int, default=4096, help="解析结果缓存上限 (MB)，超出后按最近使用时间淘汰")
+    parser.add_argument("--no-cache", action="store_true", help="不使用解析结果缓存")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="全量重建到旁边的影子库，完成后原子替换正式库 (服务器期间照常查询旧库)")
+    subparsers = parser.add_subparsers(dest="command")
+    merge_parser = subparsers.add_parser("merge", help="把多个分片库合并成一个 pyclangd_index.db")
+    merge_parser.add_argument("shards", nargs="*", help="分片库路径，缺省时合并工作区下所有 pyclangd_index.shard-*-of-*.db")
+    export_parser = subparsers.add_parser("export", help="把索引导出成可搬迁的索引包 (tar.gz)")
+    export_parser.add_argument("archive", help="输出的索引包路径")
+    import_parser = subparsers.add_parser("import", help="导入索引包，替换当前 pyclangd_index.db")
+    import_parser.add_argument("archive", help="索引包路径")
+    import_parser.add_argument("--remap", action="append", default=[], metavar="OLD=NEW",
+                               help="重映射工作区外的绝对路径前缀，可多次指定")
+    unreferenced_parser = subparsers.add_parser("unreferenced", help="列出零引用的定义 (按全局 --include/--exclude 过滤路径)")
+    unreferenced_parser.add_argument("--kind", action="append", choices=sorted(Database.UNREFERENCED_KINDS),
+                                     help="只列出这几类定义，可多次指定，缺省全部")
+    resolve_log_parser = subparsers.add_parser("resolve-log", help="日志 (dmesg) 每一行反查打印它的源码位置，输出 TSV")
+    resolve_log_parser.add_argument("log", help="日志文件")
+    ftrace_scope_parser = subparsers.add_parser("ftrace-scope", help="由 ftrace (function_graph) 日志生成 .ftrace_scope.txt，-j 控制扫描进程数")
+    ftrace_scope_parser.add_argument("trace", help="trace 文件，或 per_cpu 这类每个 CPU 一份 trace 的目录")
+    ftrace_profile_parser = subparsers.add_parser("ftrace-profile", help="导入 function_graph 日志的耗时并列出最耗时的函数")
+    ftrace_profile_parser.add_argument("trace", help="trace 文件，或 per_cpu 这类每个 CPU 一份 trace 的目录")
+    ftrace_profile_parser.add_argument("--order", choices=sorted(Database.FTRACE_ORDERS), default="self")
+    ftrace_profile_parser.add_argument("--top", type=int, default=30)
+    store_parser = subparsers.add_parser("store", help="多棵树共用的索引快照仓库 (按文件内容寻址，不服务查询)")
+    store_parser.add_argument("action", choices=["save", "load", "drop", "gc", "list"])
+    store_parser.add_argument("name", nargs="?", help="清单名 (例如分支名或提交号)")
+    store_parser.add_argument("--store-dir", help="仓库目录 (默认 $PYCLANGD_STORE_DIR 或 ~/.cache/pyclangd/snapshots)")
+    store_parser.add_argument("--drop-local", action="store_true",
+                              help="save 之后删掉工作区里的索引库 (这棵树暂时不用，只留仓库里的清单；先关掉使用它的 VS Code)")
     args = parser.parse_args()
 
+    if not args.no_cache:
+        Database.enable_parse_cache(args.cache_dir, args.cache_size << 20)
+
     if args.server:
         ls.db = Database(args.directory, setup=True)
+        ls.background_index = not args.no_background_index
+        ls.index_jobs = args.jobs
         logger.info(f"🌐 启动 PyClangd LSP Server (Workspace: {args.directory}) ...")
         ls.start_io()
+    elif args.command == "merge":
+        db = Database(args.directory, setup=True, db_file=args.output)
+        db.merge_shards(args.shards or db.find_shard_dbs())
+        db.close()
+    elif args.command == "export":
+        db = Database(args.directory, setup=True, db_file=args.output)
+        db.export_index(args.archive)
+        db.close()
+    elif args.command == "import":
+        remaps = [tuple(r.split("=", 1)) for r in args.remap]
+        db = Database(args.directory, setup=True, db_file=args.output)
+        db.import_index(args.archive, remaps)
+        db.close()
+    elif args.command == "unreferenced":
+        db = Database(args.directory, setup=True, db_file=args.output)
+        profile = IndexProfile(args.include, args.exclude) if args.include or args.exclude else None
+        count = 0
+        for fp, sl, sc, kind, name in db.iter_unreferenced_defs(args.kind, profile):
+            print(f"{fp}:{sl}:{sc}\t{kind}\t{name}")
+            count += 1
+        logger.info(f"🪦 共 {count} 个零引用的定义")
+        db.close()
+    elif args.command == "resolve-log":
+        db = Database(args.directory, setup=True, db_file=args.output)
+        db.resolve_log_file_db(args.log, sys.stdout)
+        db.close()
+    elif args.command == "ftrace-scope":
+        db = Database(args.directory, setup=True, db_file=args.output)
+        ok = db.generate_ftrace_scope(args.trace, jobs=args.jobs)
+        db.close()
+        sys.exit(0 if ok else 1)
+    elif args.command == "ftrace-profile":
+        db = Database(args.directory, setup=True, db_file=args.output)
+        if db.import_ftrace_profile(args.trace, args.jobs) is not None:
+            for name, fp, sl, sc, calls, total, self_us, max_us in db.ftrace_hot_functions_db(args.order, args.top):
+                print(f"{fp}:{sl}:{sc}\t{name}\tcalls={calls}\ttotal={total:.3f}us\tself={self_us:.3f}us\tmax={max_us:.3f}us")
+        db.close()
+    elif args.command == "store":
+        store = SnapshotStore(args.store_dir or SnapshotStore.default_dir())
+        if args.action in ("save", "load", "drop") and not args.name:
+            parser.error(f"store {args.action} 需要指定清单名")
+        if args.action == "save":
+            db = Database(args.directory, setup=True, db_file=args.output)
+            store.save(args.name, db)
+            db.close()
+            if args.drop_local:
+                # 切回 DELETE 模式成功说明没有别的连接，-wal/-shm 已由 SQLite 自己删掉
+                conn = Database.release_db_file(db.db_path)
+                if conn is None:
+                    logger.warning(f"⚠️ 索引库 {db.db_path} 正在被使用，没有删除")
+                else:
+                    os.remove(db.db_path)
+                    conn.close()
+                    logger.info(f"🗑️ 已删除本地索引库 {db.db_path}，需要时用 store load {args.name} 回放")
+        elif args.action == "load":
+            # 回放之后再跑一次索引模式，只有内容不同的文件会被解析
+            db = Database(args.directory, setup=True, db_file=args.output)
+            store.load(args.name, db, lambda p: Database.cached_file_md5(Database.from_db_path(p)))
+            db.close()
+        elif args.action == "drop":
+            store.drop(args.name)
+        elif args.action == "gc":
+            store.gc()
+        else:
+            for name, files, unique, unique_bytes in store.list():
+                print(f"{name}\t{files} 个文件\t{unique} 个独占分片 ({unique_bytes / 1048576:.1f} MB)")
+        store.close()
     else:
-        db = Database(args.directory, setup=True)
-        db.run_index_mode(args.jobs)
+        shard = Database.parse_shard_spec(args.shard) if args.shard else None
+        output = args.output
+        if shard and not output:
+            output = Database.shard_db_name(args.directory, shard)
+        live_path = output
+        if args.rebuild:
+            # 中断后再次 --rebuild 会接着用已有的影子库，已完成的文件按 mtime 跳过
+            live_path = os.path.abspath(output or os.path.join(args.directory, "pyclangd_index.db"))
+            output = Database.shadow_db_name(live_path)
+            # 上一次建完还没被服务器换上的影子库要接着改，先撤掉就绪标记
+            if os.path.exists(Database.shadow_ready_name(output)):
+                os.remove(Database.shadow_ready_name(output))
+        db = Database(args.directory, setup=True, db_file=output)
+        profile = db.load_index_profile(args.include, args.exclude, args.scope, args.profile)
+        db.run_index_mode(args.jobs, shard=shard, two_phase=args.two_phase, profile=profile)
+        if args.rebuild:
+            db.publish_shadow(live_path)
+        db.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
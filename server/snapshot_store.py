@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# 索引快照仓库：多个工作区 / 多个版本共用，每个文件的索引行按内容寻址存一份
+#
+# store.db:
+#   shards(hash, refcount, data)           一个文件的全部索引行 (def / ref / inc)，zlib 压缩，
+#                                          按内容哈希去重：6.1 / 6.6 / vendor 树里没改过的文件共用同一个分片
+#   manifests(name, file_path, shard, ...) 每棵树 / 每个提交一份快照清单，只记录 文件 -> 分片 的映射，很轻
+# refcount 由触发器随清单增删自动维护，gc 只需删除 refcount = 0 的分片。
+#
+# 这是快照 (冷数据)，不服务查询：查询只走工作区里的 pyclangd_index.db，正在使用的每棵树各有一份完整的库。
+# 省下的是暂时不用的树：save --drop-local 存进仓库后删掉本地库，只剩一份清单；需要时 load 回来，
+# 内容一致的文件直接回放分片，只有本树独有/改动过的文件需要重新解析。
+# 磁盘占用 ≈ 正在使用的树各一份库 + 仓库 (所有树的去重分片，压缩后约等于一棵树的库加上各树独有的文件)。
+
+import os
+import json
+import zlib
+import hashlib
+import sqlite3
+import logging
+
+logger = logging.getLogger("PyClangd")
+
+
+class SnapshotStore:
+    def __init__(self, store_dir):
+        self.store_dir = os.path.abspath(store_dir)
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(self.store_dir, "store.db"), timeout=60.0)
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        self.conn.execute('PRAGMA synchronous=NORMAL;')
+        self._setup()
+
+    @staticmethod
+    def default_dir():
+        return os.environ.get("PYCLANGD_STORE_DIR") or os.path.join(
+            os.path.expanduser("~"), ".cache", "pyclangd", "snapshots")
+
+    def _setup(self):
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS shards (
+                hash TEXT PRIMARY KEY,
+                refcount INTEGER NOT NULL DEFAULT 0,
+                data BLOB
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS manifests (
+                name TEXT,
+                file_path TEXT,  -- 库内路径 (工作区相对路径)
+                shard TEXT,
+                md5 TEXT,
+                phase INTEGER,
+                PRIMARY KEY (name, file_path)
+            ) WITHOUT ROWID;
+
+            CREATE INDEX IF NOT EXISTS idx_manifest_shard ON manifests(shard);
+
+            CREATE TRIGGER IF NOT EXISTS manifest_ref_add AFTER INSERT ON manifests BEGIN
+                UPDATE shards SET refcount = refcount + 1 WHERE hash = NEW.shard;
+            END;
+            CREATE TRIGGER IF NOT EXISTS manifest_ref_del AFTER DELETE ON manifests BEGIN
+                UPDATE shards SET refcount = refcount - 1 WHERE hash = OLD.shard;
+            END;
+        ''')
+        self.conn.commit()
+
+    @staticmethod
+    def _pack(symbols):
+        # file_path 列由清单给出，分片里不重复存，这样同内容的文件在不同路径下也能共享
+        payload = json.dumps([r[1:] for r in symbols], separators=(",", ":"))
+        data = zlib.compress(payload.encode("utf-8"))
+        return hashlib.sha1(data).hexdigest(), data
+
+    @staticmethod
+    def _unpack(file_path, data):
+        return [(file_path, *r) for r in json.loads(zlib.decompress(data))]
+
+    def save(self, name, db):
+        """把工作区库 db 的当前内容存成名为 name 的清单，返回 (文件数, 新增分片数)"""
+        db.cursor.execute('SELECT file_path, md5, phase FROM files')
+        files = db.cursor.fetchall()
+
+        new_shards = 0
+        self.conn.execute('DELETE FROM manifests WHERE name = ?', (name,))
+        for file_path, md5, phase in files:
+            shard, data = SnapshotStore._pack(db.file_symbol_rows(file_path))
+            inserted = self.conn.execute('INSERT OR IGNORE INTO shards (hash, data) VALUES (?, ?)', (shard, data))
+            new_shards += inserted.rowcount
+            self.conn.execute('INSERT INTO manifests (name, file_path, shard, md5, phase) VALUES (?, ?, ?, ?, ?)',
+                              (name, file_path, shard, md5, phase))
+        self.conn.commit()
+        logger.info(f"📦 清单 [{name}] 已保存: {len(files)} 个文件，新增 {new_shards} 个分片")
+        return len(files), new_shards
+
+    def load(self, name, db, current_md5):
+        """
+        把清单 name 回放进工作区库 db：只回放磁盘上内容 (md5) 与清单一致的文件。
+        current_md5(file_path) 返回工作区里该文件当前的 md5。返回 (回放文件数, 跳过文件数)。
+        """
+        rows = self.conn.execute('''
+            SELECT m.file_path, m.md5, m.phase, s.data FROM manifests m JOIN shards s ON s.hash = m.shard
+            WHERE m.name = ?
+        ''', (name,)).fetchall()
+        if not rows:
+            raise KeyError(f"❌ 仓库里没有清单: {name}")
+
+        loaded = skipped = 0
+        for file_path, md5, phase, data in rows:
+            if current_md5(file_path) != md5:
+                skipped += 1  # 本树独有或改动过的文件，留给增量索引重新解析
+                continue
+            db.load_stored_file(file_path, md5, phase, SnapshotStore._unpack(file_path, data))
+            loaded += 1
+        db.conn.commit()
+        logger.info(f"📦 清单 [{name}] 已回放: {loaded} 个文件，{skipped} 个文件内容不同需要重新索引")
+        return loaded, skipped
+
+    def drop(self, name):
+        self.conn.execute('DELETE FROM manifests WHERE name = ?', (name,))
+        self.conn.commit()
+
+    def gc(self):
+        """删除没有任何清单引用的分片，返回删除数量"""
+        removed = self.conn.execute('DELETE FROM shards WHERE refcount <= 0').rowcount
+        self.conn.commit()
+        if removed:
+            self.conn.execute('VACUUM')
+        logger.info(f"🧹 回收 {removed} 个无引用分片")
+        return removed
+
+    def list(self):
+        """[(清单名, 文件数, 该清单独占的分片数, 独占分片的压缩后字节数)]"""
+        return self.conn.execute('''
+            SELECT m.name, COUNT(*), SUM(s.refcount = 1), TOTAL(CASE WHEN s.refcount = 1 THEN length(s.data) END)
+            FROM manifests m JOIN shards s ON s.hash = m.shard
+            GROUP BY m.name ORDER BY m.name
+        ''').fetchall()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.abspath(os.path.join(current_dir, ".."))
+sys.path.append(parent_dir)
+
+from database import Database
+
+# 按访问方式过滤引用：过滤条件先展开成命中的全部 access 取值，查询落在 refs 的 (usr_id, access) 主键前缀上
+
+def run_test():
+    print("=" * 60)
+    print("🧪 测试按访问方式过滤引用")
+    print("=" * 60)
+
+    success = True
+
+    # 1. 展开表：每个过滤条件命中的取值就是同时具备它那几位的全部组合
+    for name, mask in Database.ACCESS_FILTERS.items():
+        values = Database.access_values([name])
+        expected = [a for a in range(Database.ACCESS_ALL + 1) if a & mask == mask]
+        if values != expected:
+            print(f"❌ 错误：{name} 展开为 {values}，期望 {expected}")
+            success = False
+    write_or_call = Database.access_values(["write", "call"])
+    rmw = Database.access_values(["rmw"])
+    if Database.ACCESS_WRITE not in write_or_call or Database.ACCESS_CALL not in write_or_call \
+            or Database.ACCESS_READ in write_or_call or Database.ACCESS_WRITE in rmw \
+            or (Database.ACCESS_READ | Database.ACCESS_WRITE) not in rmw:
+        print("❌ 错误：多个过滤条件应取并集，rmw 只要读改写")
+        success = False
+    try:
+        Database.access_values(["bogus"])
+        print("❌ 错误：未知的过滤条件应当报错")
+        success = False
+    except ValueError:
+        pass
+    if success:
+        print("✅ 过滤条件展开成 access 取值正确，多个条件取并集，未知条件报错")
+
+    # 2. 按过滤条件查引用
+    workspace_dir = tempfile.mkdtemp(prefix="pyclangd_access_")
+    source = os.path.join(workspace_dir, "a.c")
+    with open(source, "w") as f:
+        f.write("x\n")
+    field = "c:@S@task@FI@state"
+
+    def ref(line, access):
+        return (source, line, 8, line, 13, field, "ref", "state", "REF_Field", None, access)
+
+    rows = [(source, 1, 6, 1, 9, "c:@F@foo", "def", "foo", "DEF_Function", None, 0),
+            (source, 2, 9, 2, 14, field, "def", "state", "DEF_Field", None, 0),
+            ref(4, Database.ACCESS_WRITE),
+            ref(5, Database.ACCESS_READ),
+            ref(6, Database.ACCESS_READ | Database.ACCESS_WRITE),
+            ref(7, Database.ACCESS_TYPE),
+            ref(8, Database.ACCESS_ADDR)]
+    db = Database(workspace_dir, setup=True)
+    db.save_parse_result(source, "m1", rows, [])
+
+    def lines(access=None):
+        return sorted(r[1] for r in db.lsp_references_db(source, 4, 9, access))
+
+    cases = [(["write"], [4, 6]), (["rmw"], [6]), (["read"], [5, 6]), (["type", "addr"], [7, 8]), (None, [2, 4, 5, 6, 7, 8])]
+    wrong = [(access, lines(access), expected) for access, expected in cases if lines(access) != expected]
+    if wrong:
+        for access, got, expected in wrong:
+            print(f"❌ 错误：过滤 {access} 得到第 {got} 行，期望 {expected}")
+        success = False
+    else:
+        print("✅ 过滤后只返回命中的引用 (不含定义)，不过滤时引用和定义都返回")
+
+    # 读改成写不能当成平移：重新解析后过滤结果跟着变
+    rows[3] = ref(5, Database.ACCESS_WRITE)
+    db.save_parse_result(source, "m2", rows, [])
+    if lines(["write"]) != [4, 5, 6] or lines(["read"]) != [6]:
+        print(f"❌ 错误：读改成写之后过滤结果为 write {lines(['write'])} / read {lines(['read'])}")
+        success = False
+    else:
+        print("✅ 访问方式变化后重新解析，过滤结果随之更新")
+    db.close()
+    shutil.rmtree(workspace_dir)
+
+    print("\n" + ("=" * 60))
+    if success:
+        print("🎉 测试通过: 按访问方式过滤引用结果正确！")
+    else:
+        print("💥 测试失败: 按访问方式过滤引用未达预期效果！")
+    print("=" * 60)
+
+    if not success:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    run_test()
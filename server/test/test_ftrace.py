@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import os
+import sys
+import random
+import shutil
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.abspath(os.path.join(current_dir, ".."))
+sys.path.append(parent_dir)
+
+import ftrace
+
+# function_graph 日志按字节切块并行扫描：相邻块不重不漏，调用栈跨块拼接，结果与块大小无关
+
+GRAPH_TRACE = """# tracer: function_graph
+#
+# CPU  DURATION                  FUNCTION CALLS
+# |     |   |                     |   |   |   |
+ 0)               |  do_sys_open() {
+ 0)               |    getname() {
+ 0)   0.500 us    |      kmem_cache_alloc();
+ 0)   1.000 us    |      strncpy_from_user.isra.0();
+ 0)   2.000 us    |    }
+ 1)               |  schedule() {
+ 1)   3.000 us    |    pick_next_task();
+ 0)               |    do_filp_open() {
+ 0)   4.000 us    |      path_openat();
+ 0)   5.000 us    |    }
+ 0)   ==========> |
+ 0)   0.250 us    |    irq_enter();
+ 0)   <========== |
+ 1) + 10.000 us   |  }
+ 0) + 12.000 us   |  } /* do_sys_open */
+"""
+
+def random_trace(seed, cpus=4, roots=150):
+    """随机的深调用树，多个 CPU 的行随机交错"""
+    rng = random.Random(seed)
+
+    def gen(out, cpu, depth):
+        name = f"f{rng.randrange(40)}"
+        if depth > 5 or rng.random() < 0.4:
+            duration = rng.randrange(1, 1000) / 100
+            out.append(f" {cpu})   {duration:.3f} us    |  {'  ' * depth}{name}();")
+            return duration
+        out.append(f" {cpu})               |  {'  ' * depth}{name}() {{")
+        child = sum(gen(out, cpu, depth + 1) for _ in range(rng.randrange(1, 4)))
+        duration = child + rng.randrange(0, 500) / 100
+        out.append(f" {cpu}) + {duration:.3f} us   |  {'  ' * depth}}}")
+        return duration
+
+    streams = {}
+    for cpu in range(cpus):
+        streams[cpu] = []
+        for _ in range(roots):
+            gen(streams[cpu], cpu, 0)
+    merged = []
+    while any(streams.values()):
+        cpu = rng.choice([c for c in streams if streams[c]])
+        n = rng.randrange(1, 6)
+        merged += streams[cpu][:n]
+        streams[cpu] = streams[cpu][n:]
+    return "\n".join(merged) + "\n"
+
+def rounded(stats):
+    return {key: [round(x, 6) for x in stat] for key, stat in stats.items()}
+
+def scan_with_chunk_size(path, chunk_size, jobs):
+    """(函数名, 函数耗时, 调用边耗时)"""
+    saved = ftrace.CHUNK_SIZE
+    ftrace.CHUNK_SIZE = chunk_size
+    try:
+        names = ftrace.collect_function_names(path, jobs)
+        funcs, edges = ftrace.collect_profile(path, jobs)
+    finally:
+        ftrace.CHUNK_SIZE = saved
+    return names, rounded(funcs), rounded(edges)
+
+def run_test():
+    work_dir = tempfile.mkdtemp(prefix="pyclangd_ftrace_")
+
+    print("=" * 60)
+    print("🧪 测试 ftrace 日志的分块扫描与调用栈拼接")
+    print("=" * 60)
+
+    success = True
+
+    # 1. read_chunk：任意块大小下，各块拼起来恰好是原文件 (块边界落在行首、行尾、行中间都一样)
+    data = b"a\n\nbcd\nefghij\n\nk\nlast line without newline"
+    sample = os.path.join(work_dir, "sample.trace")
+    with open(sample, "wb") as f:
+        f.write(data)
+    bad = [size for size in range(1, len(data) + 2)
+           if b"".join(ftrace.read_chunk(*chunk) for chunk in ftrace.split_chunks([sample], size)) != data]
+    if bad:
+        print(f"❌ 错误：块大小 {bad} 时各块拼起来与原文件不一致")
+        success = False
+    else:
+        print("✅ 任意块大小下相邻块不重不漏 (包括末尾没有换行的行)")
+
+    # 2. collect_function_names：出现过的函数名，编译器克隆归到原函数名下
+    graph = os.path.join(work_dir, "graph.trace")
+    with open(graph, "w") as f:
+        f.write(GRAPH_TRACE)
+    expected = {"do_sys_open", "getname", "kmem_cache_alloc", "strncpy_from_user", "schedule", "pick_next_task",
+                "do_filp_open", "path_openat", "irq_enter"}
+    names, funcs, edges = scan_with_chunk_size(graph, 1 << 20, 1)
+    if names != expected:
+        print(f"❌ 错误：扫出的函数名不对: 多了 {names - expected}，少了 {expected - names}")
+        success = False
+    else:
+        print("✅ 扫出的函数名与手写日志一致，foo.isra.0 归到 foo")
+
+    # 3. collect_profile：手算的结果
+    expected_funcs = {
+        "do_sys_open": [1, 12.0, 12.0 - 2.0 - 5.0 - 0.25, 12.0],
+        "getname": [1, 2.0, 0.5, 2.0],
+        "schedule": [1, 10.0, 7.0, 10.0],
+        "strncpy_from_user": [1, 1.0, 1.0, 1.0],
+    }
+    expected_edges = {
+        ("getname", "strncpy_from_user"): [1, 1.0, 1.0],
+        ("do_sys_open", "do_filp_open"): [1, 5.0, 5.0],
+        ("do_sys_open", "irq_enter"): [1, 0.25, 0.25],
+    }
+    wrong = [k for k, v in expected_funcs.items() if funcs.get(k) != v] + \
+            [k for k, v in expected_edges.items() if edges.get(k) != v]
+    if wrong:
+        print(f"❌ 错误：耗时统计不对: {wrong}")
+        success = False
+    else:
+        print("✅ 函数和调用边的次数 / 总耗时 / 自身耗时 / 最大耗时与手算一致")
+
+    # 4. 块大小不影响结果：块边界切在行中间时由 read_chunk 补齐，切在调用栈中间时由主进程按块顺序拼接
+    for name, path, sizes in (("手写日志", graph, range(5, 120, 7)),
+                              ("随机调用树", os.path.join(work_dir, "random.trace"), (1000, 4093, 65536))):
+        if name == "随机调用树":
+            with open(path, "w") as f:
+                f.write(random_trace(3))
+        reference = scan_with_chunk_size(path, 1 << 30, 1)
+        mismatched = [size for size in sizes if scan_with_chunk_size(path, size, 2) != reference]
+        if mismatched:
+            print(f"❌ 错误：{name}在块大小 {mismatched} 时扫描结果与不分块不一致")
+            success = False
+        else:
+            print(f"✅ {name}：不同块大小的函数名和耗时统计与不分块一致")
+
+    # 5. tracefs 目录：有 per_cpu 时只读每个 CPU 的 trace，不读顶层 trace 和 trace_pipe 这些
+    tracefs = os.path.join(work_dir, "tracefs")
+    for name in ("trace", "trace_pipe", "trace_marker", "per_cpu/cpu0/trace", "per_cpu/cpu1/trace",
+                 "per_cpu/cpu1/trace_pipe_raw", "instances/x/trace"):
+        os.makedirs(os.path.dirname(os.path.join(tracefs, name)), exist_ok=True)
+        open(os.path.join(tracefs, name), "w").close()
+    per_cpu = [os.path.join(tracefs, "per_cpu", cpu, "trace") for cpu in ("cpu0", "cpu1")]
+    if ftrace.trace_files(tracefs) != per_cpu or ftrace.trace_files(os.path.join(tracefs, "per_cpu")) != per_cpu:
+        print(f"❌ 错误：tracefs 目录选出的文件不对: {ftrace.trace_files(tracefs)}")
+        success = False
+    else:
+        shutil.rmtree(os.path.join(tracefs, "per_cpu"))
+        if ftrace.trace_files(tracefs) != [os.path.join(tracefs, "trace")]:
+            print(f"❌ 错误：没有 per_cpu 时应只读顶层 trace: {ftrace.trace_files(tracefs)}")
+            success = False
+        else:
+            print("✅ tracefs 目录只读 per_cpu/cpu*/trace，没有时读顶层 trace")
+
+    print("\n" + ("=" * 60))
+    if success:
+        print("🎉 测试通过: ftrace 日志分块扫描结果与块大小无关！")
+    else:
+        print("💥 测试失败: ftrace 日志分块扫描未达预期效果！")
+    print("=" * 60)
+
+    shutil.rmtree(work_dir)
+    if not success:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    run_test()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.abspath(os.path.join(current_dir, ".."))
+sys.path.append(parent_dir)
+
+from database import Database
+
+# trace 里只有函数名：两个文件里各有一个 static helper 时，靠索引的调用图认出是哪一个，分不出来的不入库
+
+def trace_text(callers):
+    lines = []
+    for caller in callers:
+        lines += [f" 0)               |  {caller}() {{",
+                  " 0)   1.000 us    |    helper();",
+                  " 0)   2.000 us    |    via_ptr();",
+                  " 0)   4.000 us    |  }"]
+    lines.append(" 0)   0.500 us    |  twice();")
+    return "\n".join(lines) + "\n"
+
+def index_rows(source, caller):
+    """source 里定义 caller 和 static helper / twice，caller 调用本文件的 helper；via_ptr 只经函数指针调用，调用图里没有"""
+    local = os.path.basename(source)
+    helper, twice, func = f"c:{local}@F@helper", f"c:{local}@F@twice", f"c:@F@{caller}"
+    rows = [(source, 1, 13, 1, 19, helper, "def", "helper", "DEF_Function"),
+            (source, 2, 13, 2, 18, twice, "def", "twice", "DEF_Function"),
+            (source, 3, 6, 3, 6 + len(caller), func, "def", caller, "DEF_Function"),
+            (source, 3, 20, 3, 26, helper, "ref", "helper", "REF_Function", func, Database.ACCESS_CALL)]
+    if caller == "caller_a":
+        rows.append((source, 4, 6, 4, 13, "c:@F@via_ptr", "def", "via_ptr", "DEF_Function"))
+    return rows
+
+def profile(db):
+    db.cursor.execute('SELECT usr, calls, total_us FROM ftrace_funcs JOIN usrs ON id = usr_id')
+    funcs = {usr: (calls, total) for usr, calls, total in db.cursor.fetchall()}
+    db.cursor.execute('''
+        SELECT a.usr, b.usr FROM ftrace_edges JOIN usrs a ON a.id = caller_id JOIN usrs b ON b.id = callee_id
+    ''')
+    return funcs, sorted(db.cursor.fetchall())
+
+def run_test():
+    print("=" * 60)
+    print("🧪 测试同名 static 函数的 ftrace 耗时归属")
+    print("=" * 60)
+
+    success = True
+    workspace_dir = tempfile.mkdtemp(prefix="pyclangd_ftrace_profile_")
+    a_c, b_c = os.path.join(workspace_dir, "a.c"), os.path.join(workspace_dir, "b.c")
+    for path in (a_c, b_c):
+        with open(path, "w") as f:
+            f.write("x\n")
+    db = Database(workspace_dir, setup=True)
+    db.save_parse_result(a_c, "ma", index_rows(a_c, "caller_a"), [])
+    db.save_parse_result(b_c, "mb", index_rows(b_c, "caller_b"), [])
+    trace = os.path.join(workspace_dir, "graph.trace")
+
+    # 1. 只有 caller_a 跑过：helper 只能是 a.c 里那个，不会给 b.c 的 helper 记耗时，也不会连出 caller_a -> b.c helper
+    with open(trace, "w") as f:
+        f.write(trace_text(["caller_a"]))
+    stats = db.import_ftrace_profile(trace, 1)
+    funcs, edges = profile(db)
+    expected_edges = [("c:@F@caller_a", "c:@F@via_ptr"), ("c:@F@caller_a", "c:a.c@F@helper")]
+    if funcs.get("c:a.c@F@helper") != (1, 1.0) or "c:b.c@F@helper" in funcs or edges != sorted(expected_edges):
+        print(f"❌ 错误：helper 的归属不对: {funcs} / {edges}")
+        success = False
+    else:
+        print("✅ 调用图里只有一对 调用者 -> 被调用者 时，耗时和边都记到那个定义上")
+    if "c:a.c@F@twice" in funcs or "c:b.c@F@twice" in funcs or stats["ambiguous"] != 1 or stats["ambiguous_edges"] != 0:
+        print(f"❌ 错误：调用图也分不出来的 twice 不应入库，并计入 ambiguous: {stats}")
+        success = False
+    else:
+        print("✅ 调用图也分不出来的同名函数不入库，计入 ambiguous")
+
+    # 2. 两个 caller 都跑过：两条边各自对上本文件的 helper，helper 合在一起的耗时分不开，不入库
+    with open(trace, "w") as f:
+        f.write(trace_text(["caller_a", "caller_b"]))
+    stats = db.import_ftrace_profile(trace, 1)
+    funcs, edges = profile(db)
+    helper_edges = [e for e in edges if e[1].endswith("@F@helper")]
+    if helper_edges != [("c:@F@caller_a", "c:a.c@F@helper"), ("c:@F@caller_b", "c:b.c@F@helper")] \
+            or any(usr.endswith("@F@helper") for usr in funcs) or stats["ambiguous"] != 2:
+        print(f"❌ 错误：两个 helper 都跑过时结果不对: {stats} / {funcs} / {edges}")
+        success = False
+    else:
+        print("✅ 两个同名定义都跑过时边各归各的，函数总耗时分不开，不入库")
+    db.close()
+    shutil.rmtree(workspace_dir)
+
+    print("\n" + ("=" * 60))
+    if success:
+        print("🎉 测试通过: 同名 static 函数的耗时没有被重复记账！")
+    else:
+        print("💥 测试失败: 同名 static 函数的耗时归属未达预期效果！")
+    print("=" * 60)
+
+    if not success:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    run_test()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+import os
+import sys
+import random
+import shutil
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.abspath(os.path.join(current_dir, ".."))
+sys.path.append(parent_dir)
+
+from database import Database
+from log_resolver import LogResolver
+
+# 日志行 -> printk 调用点：[file:line] 前缀、格式串模糊匹配、按消息形状记忆化
+
+FORMATS = [
+    ("drivers/mmc/core.c", 10, 5, "mmc: card %s removed\n"),
+    ("drivers/mmc/core.c", 20, 5, "error %d whilst initialising SD card\n"),
+    ("drivers/mmc/host.c", 7, 3, "error %d whilst initialising SD card\n"),
+    ("drivers/mmc/core.c", 30, 5, "mmc%d: new %s card at address %04x\n"),
+    ("drivers/mmc/core.c", 40, 5, "%s: %d\n"),
+    ("drivers/mmc/core.c", 50, 5, "100%% done: first line\nsecond line %u\n"),
+    # 字面量带数字的格式串：和下面的 %d 版本数字抹掉后形状相同
+    ("drivers/clk/clk.c", 60, 5, "clk: rate 100 Hz locked\n"),
+    ("drivers/clk/clk.c", 70, 5, "clk: rate %d Hz locked\n"),
+]
+KNOWN_FILES = ["drivers/mmc/core.c", "drivers/mmc/host.c", "drivers/clk/clk.c", "arch/x86/mmc/host.c"]
+
+CASES = [
+    ("[    1.234567] mmc: card mmc0:0001 removed", ("format", [("drivers/mmc/core.c", 10)])),
+    ("<3>[    2.000000] sdhci 7c4000.mmc: error -110 whilst initialising SD card",
+     ("format", [("drivers/mmc/core.c", 20), ("drivers/mmc/host.c", 7)])),
+    ("[    3.1] [T12] mmc0: new high speed SDHC card at address aaaa", ("format", [("drivers/mmc/core.c", 30)])),
+    ("Oct 19 10:00:00 host kernel: [    4.0] [drivers/mmc/core.c:30] mmc1: new x card at address 0001",
+     ("location", [("drivers/mmc/core.c", 30)])),
+    ("[    5.0] [../drivers/mmc/host.c:99] something unknown", ("location", [("drivers/mmc/host.c", 99)])),
+    ("[    6.0] 100% done: first line", ("format", [("drivers/mmc/core.c", 50)])),
+    ("[    6.0] second line 5", ("format", [("drivers/mmc/core.c", 50)])),
+    ("[    7.0] foo: 3", None),  # 没有锚点的宽泛格式串不参与模糊匹配
+    ("[    8.0] totally unrelated", None),
+    ("[    9.0] clk: rate 100 Hz locked", ("format", [("drivers/clk/clk.c", 60)])),
+    ("[    9.5] clk: rate 200 Hz locked", ("format", [("drivers/clk/clk.c", 70)])),
+]
+
+def summarize(result):
+    if result is None:
+        return None
+    how, sites = result
+    return how, sorted((path, line) for path, line, _, _ in sites)
+
+def run_test():
+    print("=" * 60)
+    print("🧪 测试日志反查源码")
+    print("=" * 60)
+
+    success = True
+    resolver = LogResolver(FORMATS, KNOWN_FILES)
+    wrong = [(line, summarize(resolver.resolve(line)), expected) for line, expected in CASES
+             if summarize(resolver.resolve(line)) != expected]
+    if wrong:
+        for line, got, expected in wrong:
+            print(f"❌ 错误：{line!r} -> {got}，期望 {expected}")
+        success = False
+    else:
+        print("✅ [file:line] 前缀、格式串匹配、多行格式串和 %% 都定位正确")
+
+    # 记忆化不能改变结果：任意顺序批量反查，每行都要和单独用一个新的 resolver 反查一致
+    lines = [line for line, _ in CASES] * 3
+    lines += [f"[   10.0] clk: rate {rate} Hz locked" for rate in (100, 5, 100, 1000, 100)]
+    lines += [f"[   11.0] sdhci mmc{i}: error -{i} whilst initialising SD card" for i in range(20)]
+    rng = random.Random(5)
+    for round_no in range(20):
+        rng.shuffle(lines)
+        memoized = LogResolver(FORMATS, KNOWN_FILES)
+        got = [summarize(r) for r in memoized.resolve_lines(lines)]
+        fresh = [summarize(LogResolver(FORMATS, KNOWN_FILES).resolve(line)) for line in lines]
+        if got != fresh:
+            bad = next(line for line, a, b in zip(lines, got, fresh) if a != b)
+            print(f"❌ 错误：第 {round_no} 轮记忆化后的结果与逐行重新匹配不一致: {bad!r}")
+            success = False
+            break
+    else:
+        print("✅ 任意顺序下记忆化的结果都与逐行重新匹配一致 (包括字面量带数字的格式串)")
+
+    memoized = LogResolver(FORMATS, KNOWN_FILES)
+    list(memoized.resolve_lines(f"[ {i}.0] sdhci mmc{i}: error -{i} whilst initialising SD card" for i in range(100)))
+    if len(memoized._memo) != 1:
+        print(f"❌ 错误：只是数值不同的 100 行应当共用一条记忆，实际 {len(memoized._memo)} 条")
+        success = False
+    else:
+        print("✅ 只是数值不同的消息共用一条记忆")
+
+    # 库里的格式串索引只在 logfmts 变化时重建，后台索引没有格式串的文件不会让它失效
+    workspace_dir = tempfile.mkdtemp(prefix="pyclangd_logres_")
+    os.makedirs(os.path.join(workspace_dir, "drivers"))
+    host, quiet = os.path.join(workspace_dir, "drivers/host.c"), os.path.join(workspace_dir, "drivers/quiet.c")
+    for path in (host, quiet):
+        with open(path, "w") as f:
+            f.write("x\n")
+
+    def log_row(line, fmt):
+        return (host, line, 3, line, 11, "c:@F@_dev_err", "log", "_dev_err", "LOGFMT", fmt, 0)
+
+    db = Database(workspace_dir, setup=True)
+    db.save_parse_result(host, "m1", [log_row(7, "error %d\n")], [])
+    first = db.log_resolver()
+    db.save_parse_result(quiet, "m2", [], [])
+    unchanged = db.log_resolver() is first
+    db.save_parse_result(host, "m3", [log_row(8, "other %d\n")], [])
+    second = db.log_resolver()
+    rebuilt = second is not first and summarize(second.resolve("other 1")) == ("format", [("drivers/host.c", 8)])
+    # 另一个连接 (例如 CLI 建库进程) 写入格式串也能察觉
+    other = Database(workspace_dir, setup=True)
+    other.save_parse_result(host, "m4", [log_row(9, "other %d\n")], [])
+    other.close()
+    rebuilt_elsewhere = db.log_resolver() is not second
+    if unchanged and rebuilt and rebuilt_elsewhere:
+        print("✅ 格式串索引只在 logfmts 变化时重建")
+    else:
+        print(f"❌ 错误：格式串索引缓存失效不对 (files 变化时复用 {unchanged}，logfmts 变化时重建 {rebuilt} / {rebuilt_elsewhere})")
+        success = False
+
+    # F12 只在日志文件上走日志反查：还没入库的源码 / 头文件 (扩展名或编译数据库认得出) 不算日志
+    log, fresh = os.path.join(workspace_dir, "dmesg.txt"), os.path.join(workspace_dir, "drivers/fresh.c")
+    for path in (log, fresh):
+        with open(path, "w") as f:
+            f.write("[    1.000000] other 1\n")
+    jumped = db.lsp_definition_db(log, 1, 18)
+    db.commands_map = {os.path.join(workspace_dir, "drivers/gen.inc"): {}}
+    classified = [db.is_log_file(p) for p in (log, fresh, os.path.join(workspace_dir, "include/new.h"),
+                                              os.path.join(workspace_dir, "drivers/gen.inc"), host)]
+    db.close()
+    shutil.rmtree(workspace_dir)
+    if [tuple(r[:2]) for r in jumped or []] == [(host, 9)] and classified == [True, False, False, False, False]:
+        print("✅ 日志文件上 F12 跳到打印处，源码、头文件和编译数据库里的文件不当作日志")
+    else:
+        print(f"❌ 错误：日志反查的文件判断不对: 跳转 {jumped}，判断 {classified}")
+        success = False
+
+    print("\n" + ("=" * 60))
+    if success:
+        print("🎉 测试通过: 日志行都能定位到打印它的代码！")
+    else:
+        print("💥 测试失败: 日志反查未达预期效果！")
+    print("=" * 60)
+
+    if not success:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    run_test()
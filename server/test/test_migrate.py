@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.abspath(os.path.join(current_dir, ".."))
+sys.path.append(parent_dir)
+
+from database import Database
+
+# 手工建出各个历史版本的表结构 (只建升级会碰到的表)，写几行数据后交给当前版本打开，检查升级结果
+
+def write_sources(workspace_dir):
+    for name in ("a.c", "a.h"):
+        with open(os.path.join(workspace_dir, name), "w") as f:
+            f.write("x\n")
+
+def build_v0(workspace_dir, db_path):
+    """最早的版本：inc/def/ref 混在 symbols 表里，路径是绝对路径，includes 没有位置列"""
+    a_c, a_h = os.path.join(workspace_dir, "a.c"), os.path.join(workspace_dir, "a.h")
+    conn = sqlite3.connect(db_path)
+    conn.executescript('''
+        CREATE TABLE symbols (file_path TEXT, s_line INTEGER, s_col INTEGER, e_line INTEGER, e_col INTEGER,
+                              usr TEXT, role TEXT, name TEXT, kind TEXT,
+                              UNIQUE(file_path, s_line, s_col, e_line, e_col, usr));
+        CREATE TABLE files (file_path TEXT PRIMARY KEY, mtime REAL, md5 TEXT);
+        CREATE TABLE includes (source_file TEXT, included_file TEXT, UNIQUE(source_file, included_file));
+    ''')
+    conn.executemany('INSERT INTO symbols VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+        (a_c, 1, 1, 1, 16, a_h, "inc", "a.h", "inc"),
+        (a_h, 1, 6, 1, 9, "c:@F@foo", "ref", "foo", "REF_Function"),
+        (a_c, 2, 6, 2, 9, "c:@F@foo", "def", "foo", "DEF_Function"),
+        (a_c, 3, 20, 3, 23, "c:@F@foo", "ref", "foo", "REF_Function"),
+    ])
+    conn.execute('INSERT INTO files VALUES (?, ?, ?)', (a_c, 1.0, "m"))
+    conn.execute('INSERT INTO files VALUES (?, NULL, ?)', (a_h, "h"))
+    conn.execute('INSERT INTO includes VALUES (?, ?)', (a_c, a_h))
+    conn.commit()
+    conn.close()
+
+def build_v3(workspace_dir, db_path):
+    """v3：symbols 拆成 defs / refs / includes，但 defs / refs 存的还是 USR 字符串"""
+    conn = sqlite3.connect(db_path)
+    conn.executescript('''
+        CREATE TABLE defs (usr TEXT, file_path TEXT, s_line INTEGER, s_col INTEGER, e_line INTEGER, e_col INTEGER,
+                           name TEXT, kind TEXT, PRIMARY KEY (usr, file_path, s_line, s_col, e_line, e_col)) WITHOUT ROWID;
+        CREATE TABLE refs (usr TEXT, file_path TEXT, s_line INTEGER, s_col INTEGER, e_line INTEGER, e_col INTEGER,
+                           name TEXT, kind TEXT, PRIMARY KEY (usr, file_path, s_line, s_col, e_line, e_col)) WITHOUT ROWID;
+        CREATE TABLE files (file_path TEXT PRIMARY KEY, mtime REAL, md5 TEXT, phase INTEGER);
+        CREATE TABLE includes (source_file TEXT, included_file TEXT, s_line INTEGER, s_col INTEGER, e_line INTEGER,
+                               e_col INTEGER, name TEXT, PRIMARY KEY (source_file, s_line, s_col, included_file)) WITHOUT ROWID;
+        PRAGMA user_version = 3;
+    ''')
+    conn.execute('INSERT INTO defs VALUES (?, ?, ?, ?, ?, ?, ?, ?)', ("c:@F@foo", "a.c", 2, 6, 2, 9, "foo", "DEF_Function"))
+    conn.executemany('INSERT INTO refs VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
+        ("c:@F@foo", "a.h", 1, 6, 1, 9, "foo", "REF_Function"),
+        ("c:@F@foo", "a.c", 3, 20, 3, 23, "foo", "REF_Function"),
+    ])
+    conn.execute('INSERT INTO files VALUES (?, ?, ?, ?)', ("a.c", 1.0, "m", Database.PHASE_FULL))
+    conn.execute('INSERT INTO includes VALUES (?, ?, ?, ?, ?, ?, ?)', ("a.c", "a.h", 1, 1, 1, 16, "a.h"))
+    conn.commit()
+    conn.close()
+
+def build_v6(workspace_dir, db_path):
+    """v6：64 位符号 ID、引用计数和调用图都有了，refs 还没有访问方式"""
+    conn = sqlite3.connect(db_path)
+    conn.create_function("usr_id", 1, Database.usr_id, deterministic=True)
+    conn.executescript('''
+        CREATE TABLE usrs (id INTEGER PRIMARY KEY, usr TEXT);
+        CREATE TABLE defs (usr_id INTEGER, file_path TEXT, s_line INTEGER, s_col INTEGER, e_line INTEGER, e_col INTEGER,
+                           name TEXT, kind TEXT, PRIMARY KEY (usr_id, file_path, s_line, s_col, e_line, e_col)) WITHOUT ROWID;
+        CREATE TABLE refs (usr_id INTEGER, file_path TEXT, s_line INTEGER, s_col INTEGER, e_line INTEGER, e_col INTEGER,
+                           name TEXT, kind TEXT, caller_id INTEGER,
+                           PRIMARY KEY (usr_id, file_path, s_line, s_col, e_line, e_col)) WITHOUT ROWID;
+        CREATE TABLE files (file_path TEXT PRIMARY KEY, mtime REAL, md5 TEXT, phase INTEGER);
+        CREATE TABLE includes (source_file TEXT, included_file TEXT, s_line INTEGER, s_col INTEGER, e_line INTEGER,
+                               e_col INTEGER, name TEXT, PRIMARY KEY (source_file, s_line, s_col, included_file)) WITHOUT ROWID;
+        CREATE TABLE refcounts (usr_id INTEGER PRIMARY KEY, refs INTEGER NOT NULL);
+        CREATE TABLE calls (caller_id INTEGER, callee_id INTEGER, sites INTEGER NOT NULL,
+                            PRIMARY KEY (caller_id, callee_id)) WITHOUT ROWID;
+        CREATE TRIGGER refcount_add AFTER INSERT ON refs BEGIN
+            INSERT INTO refcounts (usr_id, refs) VALUES (NEW.usr_id, 1) ON CONFLICT(usr_id) DO UPDATE SET refs = refs + 1;
+        END;
+        CREATE TRIGGER call_edge_add AFTER INSERT ON refs WHEN NEW.caller_id IS NOT NULL BEGIN
+            INSERT INTO calls (caller_id, callee_id, sites) VALUES (NEW.caller_id, NEW.usr_id, 1)
+            ON CONFLICT(caller_id, callee_id) DO UPDATE SET sites = sites + 1;
+        END;
+        PRAGMA user_version = 6;
+    ''')
+    conn.executemany('INSERT INTO usrs VALUES (usr_id(?), ?)', [("c:@F@foo",) * 2, ("c:@F@main",) * 2])
+    conn.executemany('INSERT INTO defs VALUES (usr_id(?), ?, ?, ?, ?, ?, ?, ?)', [
+        ("c:@F@foo", "a.c", 2, 6, 2, 9, "foo", "DEF_Function"),
+        ("c:@F@main", "a.c", 3, 5, 3, 9, "main", "DEF_Function"),
+    ])
+    conn.executemany('INSERT INTO refs VALUES (usr_id(?), ?, ?, ?, ?, ?, ?, ?, ?)', [
+        ("c:@F@foo", "a.h", 1, 6, 1, 9, "foo", "REF_Function", None),
+        ("c:@F@foo", "a.c", 3, 20, 3, 23, "foo", "REF_Function", Database.usr_id("c:@F@main")),
+    ])
+    conn.execute('INSERT INTO files VALUES (?, ?, ?, ?)', ("a.c", 1.0, "m", Database.PHASE_FULL))
+    conn.execute('INSERT INTO includes VALUES (?, ?, ?, ?, ?, ?, ?)', ("a.c", "a.h", 1, 1, 1, 16, "a.h"))
+    conn.commit()
+    conn.close()
+
+def check(db, label, expect_refs):
+    ok = True
+    db.cursor.execute('PRAGMA user_version')
+    version = db.cursor.fetchone()[0]
+    if version != Database.SCHEMA_VERSION:
+        print(f"❌ {label}: 升级后版本号为 {version}，期望 {Database.SCHEMA_VERSION}")
+        ok = False
+
+    db.cursor.execute("SELECT file_path, s_line, usr, role FROM symbols WHERE usr <> 'c:@F@main' ORDER BY role, file_path, s_line")
+    rows = db.cursor.fetchall()
+    expected = [("a.c", 2, "c:@F@foo", "def"), ("a.c", 1, "a.h", "inc"),
+                ("a.c", 3, "c:@F@foo", "ref"), ("a.h", 1, "c:@F@foo", "ref")]
+    if rows != expected:
+        print(f"❌ {label}: 升级后的行 {rows}，期望 {expected}")
+        ok = False
+
+    # 旧核心输出的原型没有 DECL_ 标记，升级后仍然算一次引用，重建索引后才准
+    db.cursor.execute("SELECT refs FROM refcounts WHERE usr_id = ?", (Database.usr_id("c:@F@foo"),))
+    row = db.cursor.fetchone()
+    refs = row[0] if row else 0
+    if refs != expect_refs:
+        print(f"❌ {label}: foo 的引用数为 {refs}，期望 {expect_refs}")
+        ok = False
+
+    usr = db.get_usr_at_location(os.path.join(db.workspace_dir, "a.c"), 3, 21)
+    if not usr or usr[1] != Database.usr_id("c:@F@foo"):
+        print(f"❌ {label}: 升级后按位置查不到符号: {usr}")
+        ok = False
+
+    db.cursor.execute("SELECT value FROM generations WHERE name = 'logfmts'")
+    if db.cursor.fetchone() is None:
+        print(f"❌ {label}: 升级后缺少修改代数表")
+        ok = False
+    if ok:
+        print(f"✅ {label}: 升级到 v{Database.SCHEMA_VERSION}，行、路径、引用数和查询都正确")
+    return ok
+
+def run_test():
+    print("=" * 60)
+    print("🧪 测试旧版本索引库的升级")
+    print("=" * 60)
+
+    success = True
+    for label, build in (("v0 (symbols 单表 + 绝对路径)", build_v0),
+                         ("v3 (USR 字符串)", build_v3),
+                         ("v6 (没有访问方式)", build_v6)):
+        workspace_dir = tempfile.mkdtemp(prefix="pyclangd_migrate_")
+        write_sources(workspace_dir)
+        build(workspace_dir, os.path.join(workspace_dir, "pyclangd_index.db"))
+        db = Database(workspace_dir, setup=True)
+        success &= check(db, label, 2)
+
+        if build is build_v0:
+            db.cursor.execute("SELECT phase FROM files WHERE file_path = 'a.c'")
+            if db.cursor.fetchone()[0] != Database.PHASE_FULL:
+                print("❌ v0: 旧库的源文件没有标记为完整解析")
+                success = False
+        if build is build_v6:
+            db.cursor.execute("SELECT sites FROM calls WHERE caller_id = ? AND callee_id = ?",
+                              (Database.usr_id("c:@F@main"), Database.usr_id("c:@F@foo")))
+            row = db.cursor.fetchone()
+            if not row or row[0] != 1:
+                print(f"❌ v6: 升级后调用图丢了: {row}")
+                success = False
+
+        # 升级后重新解析 a.c：调用换成带访问方式的新行，计数不能翻倍；
+        # 头文件里的行照旧 INSERT OR IGNORE，a.h 里旧的原型要到重建索引才换成 DECL_，仍算一次
+        a_c, a_h = os.path.join(workspace_dir, "a.c"), os.path.join(workspace_dir, "a.h")
+        db.save_parse_result(a_c, "m2", [
+            (a_c, 1, 1, 1, 16, a_h, "inc", "a.h", "inc"),
+            (a_h, 1, 6, 1, 9, "c:@F@foo", "ref", "foo", "DECL_Function", None, 0),
+            (a_c, 2, 6, 2, 9, "c:@F@foo", "def", "foo", "DEF_Function"),
+            (a_c, 3, 20, 3, 23, "c:@F@foo", "ref", "foo", "REF_Function", "c:@F@main", Database.ACCESS_CALL),
+        ], [(a_c, a_h)])
+        db.cursor.execute("SELECT refs FROM refcounts WHERE usr_id = ?", (Database.usr_id("c:@F@foo"),))
+        row = db.cursor.fetchone()
+        if not row or row[0] != 2:
+            print(f"❌ {label}: 重新解析后 foo 的引用数为 {row}，期望 2")
+            success = False
+        calls = db.lsp_references_db(a_c, 3, 21, ["call"])
+        if [(r[0], r[1]) for r in calls] != [(a_c, 3)]:
+            print(f"❌ {label}: 重新解析后按调用过滤得到 {calls}")
+            success = False
+        db.close()
+        shutil.rmtree(workspace_dir)
+
+    print("\n" + ("=" * 60))
+    if success:
+        print("🎉 测试通过: 各个旧版本的索引库都能正确升级！")
+    else:
+        print("💥 测试失败: 旧版本索引库升级未达预期效果！")
+    print("=" * 60)
+
+    if not success:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    run_test()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.abspath(os.path.join(current_dir, ".."))
+sys.path.append(parent_dir)
+
+from database import Database
+
+# 大纲按索引时记下的定义范围 (extent 行) 嵌套：结构体套成员，函数里的参数、局部变量不出现
+
+def fake_rows(source):
+    def d(line, col, usr, name, kind):
+        return (source, line, col, line, col + len(name), usr, "def", name, kind, None, 0)
+
+    def x(s_line, s_col, e_line, e_col, usr, name):
+        return (source, s_line, s_col, e_line, e_col, usr, "extent", name, "EXTENT", None, 0)
+
+    macro = "c:a.c@MAX"
+    return [
+        d(1, 9, macro, "MAX", "MACRO_DEF"), x(1, 9, 1, 30, macro, "MAX"),
+        d(3, 8, "c:@S@s", "s", "DEF_Record"), x(3, 1, 6, 2, "c:@S@s", "s"),
+        d(4, 9, "c:@S@s@FI@a", "a", "DEF_Field"), x(4, 5, 4, 10, "c:@S@s@FI@a", "a"),
+        d(5, 9, "c:@S@s@FI@b", "b", "DEF_Field"), x(5, 5, 5, 10, "c:@S@s@FI@b", "b"),
+        d(8, 5, "c:@F@foo", "foo", "DEF_Function"), x(8, 1, 12, 2, "c:@F@foo", "foo"),
+        d(8, 13, "c:a.c@F@foo@p", "p", "DEF_ParmVar"), d(9, 9, "c:a.c@F@foo@l", "l", "DEF_Var"),
+        d(14, 12, "c:@g", "g", "DEF_Var"), x(14, 1, 14, 13, "c:@g", "g"),
+    ]
+
+def shape(nodes):
+    return [(n[0], shape(n[4])) if n[4] else n[0] for n in nodes]
+
+def run_test():
+    workspace_dir = tempfile.mkdtemp(prefix="pyclangd_outline_")
+    source = os.path.join(workspace_dir, "a.c")
+    with open(source, "w") as f:
+        f.write("x\n")
+
+    print("=" * 60)
+    print("🧪 测试大纲按定义范围嵌套")
+    print("=" * 60)
+
+    db = Database(workspace_dir, setup=True)
+    db.save_parse_result(source, "m1", fake_rows(source), [])
+    success = True
+
+    tree = db.lsp_document_symbols_db(source)
+    expected = ["MAX", ("s", ["a", "b"]), "foo", "g"]
+    if shape(tree) != expected:
+        print(f"❌ 错误：大纲为 {shape(tree)}，期望 {expected}")
+        success = False
+    else:
+        print("✅ 成员嵌套在结构体下，参数和局部变量不出现")
+
+    foo = next(n for n in tree if n[0] == "foo")
+    if foo[2] != (8, 1, 12, 2) or foo[3] != (8, 5, 8, 8):
+        print(f"❌ 错误：foo 的范围 {foo[2]} / 名字范围 {foo[3]} 不对")
+        success = False
+    else:
+        print("✅ 节点范围是完整定义范围，名字范围是 def 行")
+
+    if db.lsp_document_symbols_db(source) is not tree:
+        print("❌ 错误：文件没有重新索引时大纲应当命中缓存")
+        success = False
+    db.save_parse_result(source, "m2", fake_rows(source)[:8], [])
+    if shape(db.lsp_document_symbols_db(source)) != ["MAX", ("s", ["a", "b"])]:
+        print("❌ 错误：重新索引后大纲没有更新")
+        success = False
+    else:
+        print("✅ 大纲按索引时的 md5 缓存，重新索引后失效")
+
+    # 没有范围表的旧库：平铺，但靠种类排除参数、局部变量这些
+    db.save_parse_result(source, "m3", fake_rows(source), [])
+    db.cursor.execute("DELETE FROM extents")
+    db.conn.commit()
+    db._file_cache.clear()
+    flat = shape(db.lsp_document_symbols_db(source))
+    if sorted(flat) != sorted(["MAX", "s", "a", "b", "foo", "l", "g"]) or "p" in flat:
+        print(f"❌ 错误：没有定义范围时的平铺大纲为 {flat}")
+        success = False
+    else:
+        print("✅ 没有定义范围的旧库退回平铺大纲并排除参数")
+    db.close()
+
+    print("\n" + ("=" * 60))
+    if success:
+        print("🎉 测试通过: 大纲嵌套正确！")
+    else:
+        print("💥 测试失败: 大纲未达预期效果！")
+    print("=" * 60)
+
+    shutil.rmtree(workspace_dir)
+    if not success:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    run_test()
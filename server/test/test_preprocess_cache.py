@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.abspath(os.path.join(current_dir, ".."))
+sys.path.append(parent_dir)
+
+from preprocess_cache import PreprocessCache, PreprocessedTU, invocation_end
+
+# 宏展开：clang -E 的输出按行标记对回源文件的行，跨行的宏调用整段取出；预处理结果按编译单元和编译参数缓存
+
+# a.c: 第 1 行 #include "m.h"，第 2 行 int main() {，第 3 行 int z = MAX(3,，第 4 行 4);，第 5 行 return z;
+OUTPUT = """# 1 "a.c"
+# 1 "<built-in>" 1
+# 1 "<command line>" 1
+# 1 "a.c" 2
+# 1 "./m.h" 1
+int h1;
+
+int h3 = (1 > 2 ? 1 : 2);
+# 2 "a.c" 2
+int main() {
+    int z = ((3) > (4) ? (3) : (4))
+                                   ;
+    return z;
+}
+"""
+
+SOURCE = [
+    'int x = FOO(a,\n',
+    '   "(", \')\', /* ) */ b);\n',
+    'int y;\n',
+    '#define M(x) \\\n',
+    '  x\n',
+    'z\n',
+]
+
+def run_test():
+    work_dir = tempfile.mkdtemp(prefix="pyclangd_pp_")
+    source, header = os.path.join(work_dir, "a.c"), os.path.join(work_dir, "m.h")
+    for path in (source, header):
+        with open(path, "w") as f:
+            f.write("x\n")
+
+    print("=" * 60)
+    print("🧪 测试宏展开的预处理缓存")
+    print("=" * 60)
+
+    success = True
+    tu = PreprocessedTU(OUTPUT, work_dir)
+    checks = [
+        ("头文件里的行", tu.expansion(header, 3), "int h3 = (1 > 2 ? 1 : 2);"),
+        ("跨两行的宏调用", tu.expansion(source, 3, 4), "int z = ((3) > (4) ? (3) : (4))\n;"),
+        ("宏调用之后的行", tu.expansion(source, 5), "return z;"),
+        ("#include 所在的行 (没有输出)", tu.expansion(source, 1), None),
+        ("超出文件末尾", tu.expansion(source, 99), None),
+    ]
+    for label, got, expected in checks:
+        if got != expected:
+            print(f"❌ 错误：{label} 展开为 {got!r}，期望 {expected!r}")
+            success = False
+    if success:
+        print("✅ 行标记对回源文件和头文件，跨行的宏调用整段取出")
+
+    spans = [(1, 2), (3, 3), (4, 5), (6, 6)]
+    wrong = [(line, invocation_end(SOURCE, line), end) for line, end in spans if invocation_end(SOURCE, line) != end]
+    if wrong or invocation_end(["FOO(\n"] * 5, 1, max_lines=2) != 2:
+        print(f"❌ 错误：宏调用的结束行不对 (行, 实际, 期望): {wrong}")
+        success = False
+    else:
+        print("✅ 宏调用的结束行跳过字符串、字符、注释里的括号，跟随续行符，有上限")
+
+    runs = []
+    md5 = {source: "1", header: "1"}
+
+    def run():
+        runs.append(1)
+        return OUTPUT
+
+    cache = PreprocessCache(max_entries=2)
+    cache.get(source, work_dir, ["-DX"], run, md5.get)
+    cache.get(source, work_dir, ["-DX"], run, md5.get)
+    hit = len(runs) == 1
+    cache.get(source, work_dir, ["-DY"], run, md5.get)
+    args_miss = len(runs) == 2
+    md5[header] = "2"
+    cache.get(source, work_dir, ["-DX"], run, md5.get)
+    header_miss = len(runs) == 3
+    if not (hit and args_miss and header_miss):
+        print(f"❌ 错误：缓存命中不对 (相同参数命中 {hit}，参数变化重跑 {args_miss}，头文件变化重跑 {header_miss})")
+        success = False
+    else:
+        print("✅ 参数相同且依赖文件没变时复用，编译参数或头文件变化时重新预处理")
+
+    print("\n" + ("=" * 60))
+    if success:
+        print("🎉 测试通过: 宏展开的预处理缓存正确！")
+    else:
+        print("💥 测试失败: 宏展开的预处理缓存未达预期效果！")
+    print("=" * 60)
+
+    shutil.rmtree(work_dir)
+    if not success:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    run_test()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.abspath(os.path.join(current_dir, ".."))
+sys.path.append(parent_dir)
+
+from database import Database
+
+# 语义着色直接由索引里的 def / ref 行编码：宏和函数分得开，写入处带 modification，前向声明带 declaration
+
+def fake_rows(source):
+    macro = "c:a.c@MAX"
+    param = "c:a.c@F@foo@x"
+    return [
+        (source, 1, 9, 1, 12, macro, "def", "MAX", "MACRO_DEF", None, 0),
+        (source, 3, 5, 3, 8, "c:@F@foo", "def", "foo", "DEF_Function", None, 0),
+        (source, 3, 13, 3, 14, param, "def", "x", "DEF_ParmVar", None, 0),
+        (source, 4, 5, 4, 6, param, "ref", "x", "REF_ParmVar", None, Database.ACCESS_WRITE),
+        (source, 4, 9, 4, 12, macro, "ref", "MAX", "MACRO_USE", None, 0),
+        (source, 4, 13, 4, 14, param, "ref", "x", "REF_ParmVar", None, Database.ACCESS_READ),
+        (source, 6, 6, 6, 9, "c:@F@bar", "ref", "bar", "DECL_Function", None, 0),
+    ]
+
+def decode(data):
+    """LSP 的相对编码还原成 [(行, 列, 长度, 类型, 修饰)] (0 起始)"""
+    tokens, line, col = [], 0, 0
+    for i in range(0, len(data), 5):
+        d_line, d_col, length, token_type, modifiers = data[i:i + 5]
+        line += d_line
+        col = col + d_col if d_line == 0 else d_col
+        modifier_names = [m for bit, m in enumerate(Database.SEMANTIC_TOKEN_MODIFIERS) if modifiers & (1 << bit)]
+        tokens.append((line, col, length, Database.SEMANTIC_TOKEN_TYPES[token_type], modifier_names))
+    return tokens
+
+def run_test():
+    workspace_dir = tempfile.mkdtemp(prefix="pyclangd_semtok_")
+    source = os.path.join(workspace_dir, "a.c")
+    with open(source, "w") as f:
+        f.write("x\n")
+
+    print("=" * 60)
+    print("🧪 测试由索引生成语义着色")
+    print("=" * 60)
+
+    db = Database(workspace_dir, setup=True)
+    rows = fake_rows(source)
+    db.save_parse_result(source, "m1", rows, [])
+    success = True
+
+    md5, data = db.semantic_tokens_db(source)
+    expected = [
+        (0, 8, 3, "macro", ["definition"]),
+        (2, 4, 3, "function", ["definition"]),
+        (2, 12, 1, "parameter", ["definition"]),
+        (3, 4, 1, "parameter", ["modification"]),
+        (3, 8, 3, "macro", []),
+        (3, 12, 1, "parameter", []),
+        (5, 5, 3, "function", ["declaration"]),
+    ]
+    if md5 != "m1" or decode(data) != expected:
+        print(f"❌ 错误：着色结果 {decode(data)}，期望 {expected}")
+        success = False
+    else:
+        print("✅ 宏、函数、参数分得开，定义 / 写入 / 前向声明的修饰位正确")
+
+    # 同一位置既有定义又有引用时只着一次色，定义优先
+    dup = Database.encode_semantic_tokens([(1, 1, 4, "DEF_Function", True, 0), (1, 1, 4, "REF_Function", False, 4)])
+    if decode(dup) != [(0, 0, 3, "function", ["definition"])]:
+        print(f"❌ 错误：同一位置的重复记号没有去重: {decode(dup)}")
+        success = False
+    else:
+        print("✅ 同一位置只着一次色，定义优先")
+
+    if db.semantic_tokens_db(source)[1] is not data:
+        print("❌ 错误：文件没有重新索引时着色结果应当命中缓存")
+        success = False
+    db.save_parse_result(source, "m2", rows[:-1], [])
+    md5_2, data_2 = db.semantic_tokens_db(source)
+    if md5_2 != "m2" or data_2 != data[:-5]:
+        print("❌ 错误：重新索引后着色结果没有更新")
+        success = False
+    else:
+        print("✅ 着色结果按索引时的 md5 缓存，重新索引后失效")
+
+    # 增量着色的差分在服务端 (依赖 pygls)，环境里没有时跳过
+    try:
+        from pyclangd_server import semantic_tokens_edit
+    except (ImportError, SystemExit):
+        semantic_tokens_edit = None
+        print("⚠️ 没有 pygls，跳过 semantic_tokens_edit 的检查")
+    if semantic_tokens_edit:
+        edits_ok = True
+        for old, new in ((data, data_2), (data_2, data), (data, data), ([1, 2, 3, 4], [1, 9, 4])):
+            start, delete_count, inserted = semantic_tokens_edit(old, new)
+            if old[:start] + inserted + old[start + delete_count:] != new:
+                print(f"❌ 错误：增量编辑 {(start, delete_count, inserted)} 不能把 {old} 变成 {new}")
+                edits_ok = success = False
+        if edits_ok:
+            print("✅ 增量着色的编辑能把旧数据还原成新数据")
+    db.close()
+
+    print("\n" + ("=" * 60))
+    if success:
+        print("🎉 测试通过: 语义着色结果正确！")
+    else:
+        print("💥 测试失败: 语义着色未达预期效果！")
+    print("=" * 60)
+
+    shutil.rmtree(workspace_dir)
+    if not success:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    run_test()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import tempfile
+import multiprocessing
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.abspath(os.path.join(current_dir, ".."))
+sys.path.append(parent_dir)
+
+from database import Database
+
+SHARD_COUNT = 3
+FILE_COUNT = 12
+
+# 模拟 PyClangd-Core 的输出：每个源文件都包含同一个头文件，头文件里的符号会在每个分片里重复出现
+def fake_parse_result(source_file, header_file):
+    symbols = [
+        (source_file, 1, 1, 1, 11, header_file, "inc", "common.h", "inc"),
+        (source_file, 3, 6, 3, 9, "c:@F@" + os.path.basename(source_file)[:-2], "def", "foo", "DEF_Function"),
+        (source_file, 4, 5, 4, 16, "c:@F@shared", "ref", "shared", "REF_Function"),
+        (header_file, 1, 6, 1, 12, "c:@F@shared", "def", "shared", "DEF_Function"),
+    ]
+    includes = [(source_file, header_file)]
+    return symbols, includes
+
+def shard_worker(workspace_dir, shard, files, header_file):
+    """每个进程独立写一个分片库，相当于一台构建机跑 --shard i/N"""
+    db = Database(workspace_dir, setup=True, db_file=Database.shard_db_name(workspace_dir, shard))
+    for source_file in files:
+        if not db.in_shard(source_file, shard):
+            continue
+        symbols, includes = fake_parse_result(source_file, header_file)
+        db.save_parse_result(source_file, db.get_file_md5(source_file), symbols, includes)
+    db.close()
+
+def run_test():
+    workspace_dir = tempfile.mkdtemp(prefix="pyclangd_shard_")
+    header_file = os.path.join(workspace_dir, "common.h")
+    with open(header_file, "w") as f:
+        f.write("void shared(void);\n")
+
+    files = []
+    for i in range(FILE_COUNT):
+        source_file = os.path.join(workspace_dir, f"file{i}.c")
+        with open(source_file, "w") as f:
+            f.write(f'#include "common.h"\n\nvoid foo{i}(void) {{\n    shared();\n}}\n')
+        files.append(source_file)
+
+    print("=" * 60)
+    print(f"🧪 测试分片索引与合并: {FILE_COUNT} 个文件, {SHARD_COUNT} 个分片")
+    print("=" * 60)
+
+    success = True
+
+    # 分片必须不重不漏
+    owners = [[s for s in range(1, SHARD_COUNT + 1) if Database(workspace_dir).in_shard(f, (s, SHARD_COUNT))] for f in files]
+    if all(len(o) == 1 for o in owners):
+        print("✅ 每个文件恰好属于一个分片")
+    else:
+        print(f"❌ 错误：分片划分不唯一 {owners}")
+        success = False
+
+    processes = []
+    for s in range(1, SHARD_COUNT + 1):
+        p = multiprocessing.Process(target=shard_worker, args=(workspace_dir, (s, SHARD_COUNT), files, header_file))
+        p.start()
+        processes.append(p)
+    for p in processes:
+        p.join()
+
+    db = Database(workspace_dir, setup=True)
+    merged = db.merge_shards(db.find_shard_dbs())
+    if merged != SHARD_COUNT:
+        print(f"❌ 错误：只合并了 {merged} 个分片")
+        success = False
+
+    db.cursor.execute("SELECT COUNT(*) FROM symbols WHERE file_path = ?", (Database.to_db_path(header_file),))
+    header_rows = db.cursor.fetchone()[0]
+    if header_rows == 1:
+        print("✅ 头文件符号已跨分片去重")
+    else:
+        print(f"❌ 错误：头文件符号重复 {header_rows} 行")
+        success = False
+
+    db.cursor.execute("SELECT COUNT(DISTINCT file_path) FROM symbols WHERE role = 'def' AND file_path != ?", (Database.to_db_path(header_file),))
+    source_count = db.cursor.fetchone()[0]
+    db.cursor.execute("SELECT COUNT(*) FROM includes")
+    include_count = db.cursor.fetchone()[0]
+    if source_count == FILE_COUNT and include_count == FILE_COUNT:
+        print("✅ 所有源文件的符号和包含关系都已合并")
+    else:
+        print(f"❌ 错误：源文件 {source_count}/{FILE_COUNT}, includes {include_count}/{FILE_COUNT}")
+        success = False
+
+    # 重复合并应当是幂等的
+    db.merge_shards(db.find_shard_dbs())
+    db.cursor.execute("SELECT COUNT(*) FROM symbols")
+    total_rows = db.cursor.fetchone()[0]
+    if total_rows == FILE_COUNT * 3 + 1:
+        print("✅ 重复合并结果不变")
+    else:
+        print(f"❌ 错误：重复合并后行数为 {total_rows}")
+        success = False
+    db.close()
+
+    print("\n" + ("=" * 60))
+    if success:
+        print("🎉 测试通过: 分片索引可以正确合并！")
+    else:
+        print("💥 测试失败: 分片合并未达预期效果！")
+    print("=" * 60)
+
+    shutil.rmtree(workspace_dir)
+    if not success:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    run_test()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.abspath(os.path.join(current_dir, ".."))
+sys.path.append(parent_dir)
+
+from database import Database
+
+# 结构体布局：库里按 bit 存，查询时换成 pahole 的口径 (字节偏移 / 大小 / 空洞，位域另给 bit)
+
+# struct s { char a; /* 3 字节空洞 */ int b; union { char c:3; short d; }; /* 2 字节填充 */ };  共 12 字节
+RAW = {"size": 12, "align": 4, "union": 0, "padding": 16,
+       "fields": [["a", "char", 0, 8, 24], ["b", "int", 32, 32, 0],
+                  ["", "union (anonymous)", 64, 16, 0, [["c", "char", 64, 3, 0], ["d", "short", 64, 16, 0]]]]}
+
+def run_test():
+    print("=" * 60)
+    print("🧪 测试结构体布局")
+    print("=" * 60)
+
+    success = True
+    layout = Database.format_layout(RAW)
+    a, b, anon = layout["fields"]
+    checks = [
+        ("总大小 / 对齐", (layout["size"], layout["align"], layout["union"]), (12, 4, False)),
+        ("空洞汇总", (layout["holes"], layout["sum_holes"], layout["bit_holes"]), (1, 3, 0)),
+        ("尾部填充", (layout["padding"], layout["bit_padding"], layout["cachelines"]), (2, 0, 1)),
+        ("成员 a", (a["offset"], a["size"], a.get("hole")), (0, 1, 3)),
+        ("成员 b", (b["offset"], b["size"], "hole" in b), (4, 4, False)),
+        ("位域 c", (anon["fields"][0].get("bit_offset"), anon["fields"][0].get("bits")), (0, 3)),
+        ("匿名联合体", (anon["offset"], anon["size"], len(anon["fields"])), (8, 2, 2)),
+    ]
+    for label, got, expected in checks:
+        if got != expected:
+            print(f"❌ 错误：{label} 为 {got}，期望 {expected}")
+            success = False
+    if success:
+        print("✅ 偏移、大小、空洞、位域和尾部填充都换算成 pahole 的口径")
+
+    # 入库后按位置和按名字都能查到，头文件平移后布局跟着平移
+    workspace_dir = tempfile.mkdtemp(prefix="pyclangd_layout_")
+    source, header = os.path.join(workspace_dir, "a.c"), os.path.join(workspace_dir, "h.h")
+    for path in (source, header):
+        with open(path, "w") as f:
+            f.write("x\n")
+
+    def layout_row(line):
+        return (header, line, 8, line, 9, "c:@S@s", "layout", "s", "LAYOUT", json.dumps(RAW, separators=(",", ":")), 0)
+
+    db = Database(workspace_dir, setup=True)
+    db.save_parse_result(source, "m1", [
+        (header, 1, 8, 1, 9, "c:@S@s", "def", "s", "DEF_Record", None, 0), layout_row(1),
+        (source, 3, 8, 3, 9, "c:@S@s", "ref", "s", "REF_Record", None, Database.ACCESS_TYPE),
+    ], [(source, header)])
+    by_location = db.struct_layout_db(source, 3, 8)
+    by_name = db.struct_layout_db(name="s")
+    if not by_location or by_location[0][3] != layout or not by_name or by_name[0][1] != header:
+        print(f"❌ 错误：按位置 / 按名字查布局失败: {by_location} / {by_name}")
+        success = False
+    else:
+        print("✅ 按引用位置和按名字都能查到布局")
+
+    db.save_parse_result(header, "m2", [(header, 2, 8, 2, 9, "c:@S@s", "def", "s", "DEF_Record", None, 0), layout_row(2)], [])
+    db.cursor.execute("SELECT COUNT(*) FROM layouts")
+    count = db.cursor.fetchone()[0]
+    if db.struct_layout_db(name="s")[0][2] != 2 or count != 1:
+        print(f"❌ 错误：头文件平移后布局位置或行数不对 (共 {count} 行)")
+        success = False
+    else:
+        print("✅ 头文件平移后布局只平移不重复")
+    db.close()
+    shutil.rmtree(workspace_dir)
+
+    print("\n" + ("=" * 60))
+    if success:
+        print("🎉 测试通过: 结构体布局正确！")
+    else:
+        print("💥 测试失败: 结构体布局未达预期效果！")
+    print("=" * 60)
+
+    if not success:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    run_test()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import random
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.abspath(os.path.join(current_dir, ".."))
+sys.path.append(parent_dir)
+
+from database import Database
+
+# 重新解析一个文件时只写变化的行：中间插几行时后面的符号平移 (UPDATE s_line)，不删了重插；
+# 平移顺序撞上主键时退回整文件重写。结果必须和整文件重写完全一致
+
+def stored_rows(db, db_path):
+    db.cursor.execute('SELECT file_path, s_line, s_col, e_line, e_col, usr, role, name, kind FROM symbols WHERE file_path = ?',
+                      (db_path,))
+    return sorted(db.cursor.fetchall())
+
+def expected_rows(rows):
+    stored, _ = Database.to_stored_rows(rows, [])
+    unique = {}
+    for r in stored:
+        # 与 INSERT OR IGNORE 一致：同一位置同一 USR 同一访问方式只留先出现的那行
+        unique.setdefault(r[:7] + (Database.row_access(r),), r)
+    return sorted(r[:9] for r in unique.values())
+
+def run_test():
+    workspace_dir = tempfile.mkdtemp(prefix="pyclangd_diff_")
+    source = os.path.join(workspace_dir, "a.c")
+    with open(source, "w") as f:
+        f.write("x\n")
+
+    print("=" * 60)
+    print("🧪 测试重新解析时的行级差分")
+    print("=" * 60)
+
+    db = Database(workspace_dir, setup=True)
+    rewrites = []
+    delete_file_rows = db.delete_file_rows
+    db.delete_file_rows = lambda db_path: rewrites.append(db_path) or delete_file_rows(db_path)
+    success = True
+
+    # 1. 同一个符号连续几行被引用，文件开头插入一行：后面的行全部下移一行，必须从下往上改
+    def ref(line, usr="c:@F@foo"):
+        return (source, line, 5, line, 8, usr, "ref", "foo", "REF_Function")
+    old = [(source, 1, 6, 1, 9, "c:@F@foo", "def", "foo", "DEF_Function")] + [ref(line) for line in range(2, 12)]
+    new = [(source, 2, 6, 2, 9, "c:@F@foo", "def", "foo", "DEF_Function")] + [ref(line + 1) for line in range(2, 12)]
+    deletes, shifts, inserts = Database.diff_symbol_rows(Database.to_stored_rows(old, [])[0], Database.to_stored_rows(new, [])[0])
+    if deletes or inserts or len(shifts) != 11:
+        print(f"❌ 错误：插入一行后应全部是平移，实际删除 {len(deletes)} / 平移 {len(shifts)} / 新增 {len(inserts)}")
+        success = False
+    elif [s[2][1] for s in shifts if s[2][6] == "ref"] != list(range(11, 1, -1)):
+        print("❌ 错误：下移的行没有按从下往上的顺序平移")
+        success = False
+    else:
+        print("✅ 插入一行后只产生平移，且下移的行从下往上改")
+
+    db.save_parse_result(source, "m1", old, [])
+    db.save_parse_result(source, "m2", new, [])
+    if stored_rows(db, "a.c") != expected_rows(new) or rewrites:
+        print(f"❌ 错误：平移后的库内容不对，或者退回了整文件重写 ({len(rewrites)} 次)")
+        success = False
+    else:
+        print("✅ 连续平移不撞主键，库内容与新解析结果一致")
+
+    # 上移：删掉开头一行
+    db.save_parse_result(source, "m3", old, [])
+    if stored_rows(db, "a.c") != expected_rows(old) or rewrites:
+        print("❌ 错误：上移后的库内容不对，或者退回了整文件重写")
+        success = False
+    else:
+        print("✅ 上移的行从上往下改，库内容一致")
+
+    # 2. 同一位置同一 USR 的两行 (kind 不同所以稳定键不同) 互换行号：任何顺序都会撞主键，退回整文件重写
+    swap_old = [(source, 5, 5, 5, 8, "c:@F@bar", "ref", "bar", "REF_Function"),
+                (source, 6, 5, 6, 8, "c:@F@bar", "ref", "bar", "REF_Var")]
+    swap_new = [(source, 6, 5, 6, 8, "c:@F@bar", "ref", "bar", "REF_Function"),
+                (source, 5, 5, 5, 8, "c:@F@bar", "ref", "bar", "REF_Var")]
+    db.save_parse_result(source, "m4", swap_old, [])
+    rewrites.clear()
+    db.save_parse_result(source, "m5", swap_new, [])
+    if not rewrites:
+        print("❌ 错误：互换行号应当撞上主键并退回整文件重写")
+        success = False
+    elif stored_rows(db, "a.c") != expected_rows(swap_new):
+        print(f"❌ 错误：退回整文件重写后的库内容不对: {stored_rows(db, 'a.c')}")
+        success = False
+    else:
+        print("✅ 平移撞上主键时退回整文件重写，库内容一致")
+
+    # 3. 随机改动：差分写入的结果必须和整文件重写一致，引用计数也必须和全量重算一致
+    rng = random.Random(7)
+    for round_no in range(200):
+        rows = []
+        for _ in range(rng.randint(0, 40)):
+            line, col = rng.randint(1, 30), rng.randint(1, 3)
+            usr = f"c:@F@u{rng.randint(0, 3)}"
+            role = rng.choice(["def", "ref"])
+            if role == "ref":
+                rows.append((source, line, col, line + rng.randint(0, 1), col + 2, usr, role, "u",
+                             rng.choice(["REF_Function", "DECL_Function"]),
+                             None, rng.choice([0, Database.ACCESS_READ, Database.ACCESS_CALL])))
+            else:
+                rows.append((source, line, col, line + rng.randint(0, 1), col + 2, usr, role, "u", "DEF_Function"))
+        db.save_parse_result(source, f"r{round_no}", rows, [])
+        if stored_rows(db, "a.c") != expected_rows(rows):
+            print(f"❌ 错误：第 {round_no} 轮随机改动后库内容与新解析结果不一致")
+            success = False
+            break
+    else:
+        print("✅ 200 轮随机改动后库内容都与新解析结果一致")
+
+    db.cursor.execute("SELECT usr_id, refs FROM refcounts ORDER BY usr_id")
+    incremental = db.cursor.fetchall()
+    Database.rebuild_refcounts(db.cursor)
+    db.cursor.execute("SELECT usr_id, refs FROM refcounts ORDER BY usr_id")
+    if db.cursor.fetchall() != incremental:
+        print("❌ 错误：差分写入后的引用数与全量重算不一致")
+        success = False
+    else:
+        print("✅ 差分写入后的引用数与全量重算一致")
+    db.close()
+
+    print("\n" + ("=" * 60))
+    if success:
+        print("🎉 测试通过: 行级差分与整文件重写结果一致！")
+    else:
+        print("💥 测试失败: 行级差分未达预期效果！")
+    print("=" * 60)
+
+    shutil.rmtree(workspace_dir)
+    if not success:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    run_test()
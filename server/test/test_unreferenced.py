@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.abspath(os.path.join(current_dir, ".."))
+sys.path.append(parent_dir)
+
+from database import Database
+
+# 模拟 PyClangd-Core 的输出：头文件里的原型是 DECL_Function 行 (按引用入库)，真正的调用是 REF_Function 行
+def fake_results(workspace_dir):
+    header = os.path.join(workspace_dir, "api.h")
+    impl = os.path.join(workspace_dir, "api.c")
+    user = os.path.join(workspace_dir, "user.c")
+    with open(header, "w") as f:
+        f.write("#define USED_MACRO 1\n#define DEAD_MACRO 2\nvoid used_fn(void);\nvoid dead_fn(void);\n")
+    with open(impl, "w") as f:
+        f.write('#include "api.h"\nvoid used_fn(void) {}\nvoid dead_fn(void) {}\n')
+    with open(user, "w") as f:
+        f.write('#include "api.h"\nint main(void) { used_fn(); return USED_MACRO; }\n')
+
+    header_rows = [
+        (header, 1, 9, 1, 19, "c:api.h@USED_MACRO", "def", "USED_MACRO", "MACRO_DEF"),
+        (header, 2, 9, 2, 19, "c:api.h@DEAD_MACRO", "def", "DEAD_MACRO", "MACRO_DEF"),
+        (header, 3, 6, 3, 13, "c:@F@used_fn", "ref", "used_fn", "DECL_Function"),
+        (header, 4, 6, 4, 13, "c:@F@dead_fn", "ref", "dead_fn", "DECL_Function"),
+    ]
+    impl_rows = [
+        (impl, 1, 1, 1, 18, header, "inc", "api.h", "inc"),
+        (impl, 2, 6, 2, 13, "c:@F@used_fn", "def", "used_fn", "DEF_Function"),
+        (impl, 3, 6, 3, 13, "c:@F@dead_fn", "def", "dead_fn", "DEF_Function"),
+    ] + header_rows
+    user_rows = [
+        (user, 1, 1, 1, 18, header, "inc", "api.h", "inc"),
+        (user, 2, 5, 2, 9, "c:@F@main", "def", "main", "DEF_Function"),
+        (user, 2, 18, 2, 25, "c:@F@used_fn", "ref", "used_fn", "REF_Function"),
+        (user, 2, 39, 2, 49, "c:api.h@USED_MACRO", "ref", "USED_MACRO", "MACRO_USE"),
+    ] + header_rows
+    return [(impl, impl_rows, [(impl, header)]), (user, user_rows, [(user, header)])]
+
+def run_test():
+    workspace_dir = tempfile.mkdtemp(prefix="pyclangd_unref_")
+
+    print("=" * 60)
+    print("🧪 测试零引用查找: 头文件里的原型不算引用")
+    print("=" * 60)
+
+    db = Database(workspace_dir, setup=True)
+    for source_file, rows, includes in fake_results(workspace_dir):
+        db.save_parse_result(source_file, db.get_file_md5(source_file), rows, includes)
+
+    success = True
+    found = {name for _, _, _, _, name in db.iter_unreferenced_defs(["function", "macro"])}
+    expected = {"dead_fn", "DEAD_MACRO", "main"}
+    if found == expected:
+        print("✅ 只在头文件里声明过、从未被调用的函数被报告为零引用")
+    else:
+        print(f"❌ 错误：零引用结果 {sorted(found)}，期望 {sorted(expected)}")
+        success = False
+
+    db.cursor.execute("SELECT refs FROM refcounts WHERE usr_id = ?", (Database.usr_id("c:@F@used_fn"),))
+    row = db.cursor.fetchone()
+    if row and row[0] == 1:
+        print("✅ 引用数只计调用，不计原型")
+    else:
+        print(f"❌ 错误：used_fn 的引用数为 {row}")
+        success = False
+
+    # 触发器维护的计数必须和整体重算一致
+    db.cursor.execute("SELECT usr_id, refs FROM refcounts ORDER BY usr_id")
+    incremental = db.cursor.fetchall()
+    Database.rebuild_refcounts(db.cursor)
+    db.cursor.execute("SELECT usr_id, refs FROM refcounts ORDER BY usr_id")
+    if db.cursor.fetchall() == incremental:
+        print("✅ 增量维护的引用数与全量重算一致")
+    else:
+        print("❌ 错误：增量维护的引用数与全量重算不一致")
+        success = False
+    db.close()
+
+    print("\n" + ("=" * 60))
+    if success:
+        print("🎉 测试通过: 零引用查找不受原型声明影响！")
+    else:
+        print("💥 测试失败: 零引用查找未达预期效果！")
+    print("=" * 60)
+
+    shutil.rmtree(workspace_dir)
+    if not success:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    run_test()